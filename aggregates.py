@@ -0,0 +1,126 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import config
+
+RACE_LABELS = ['White', 'Black', 'Hispanic', 'AAPI', 'Other']
+ACTIVITY_LABELS = ['Searched', 'Frisked', 'ContrabandFound', 'Citation', 'Warning']
+
+# last axis of every count array: total stops, then one count per activity
+MEASURES = ['stops'] + ACTIVITY_LABELS
+# year of the stops whose date is missing or cannot be parsed
+UNKNOWN_YEAR = -1
+
+STORE_PATH = os.path.join(config.DATA_DIR, 'tract_counts.npz')
+
+
+def empty_counts(n_tracts):
+    '''
+    zeroed count array for one year
+    input: number of tracts
+    output: (n_tracts, races, measures) int64 array
+    '''
+    return np.zeros((n_tracts, len(RACE_LABELS), len(MEASURES)), dtype='int64')
+
+
+class TractCounts:
+    '''
+    additive stop counts per tract x year x race x activity
+    input: tract ids, dict of year -> (n_tracts, races, measures) counts, ids of merged batches
+
+    these are sufficient statistics for the scatter page: percentages are derived on read,
+    and a new batch of stops only touches the years it contains. stops without a date are kept
+    under UNKNOWN_YEAR, so reading every year still counts every stop.
+    '''
+
+    def __init__(self, tract_ids, years=None, batches=None):
+        self.tract_ids = np.asarray(tract_ids)
+        self.years = dict(years or {})
+        self.batches = list(batches or [])
+
+    def merge(self, batch_counts, batch_id=None):
+        '''
+        add a batch of counts
+        input: dict of year -> count array, optional batch id (a batch id is only merged once)
+        output: True if the batch was merged
+        '''
+        if batch_id is not None:
+            if batch_id in self.batches:
+                return False
+            self.batches.append(batch_id)
+        for year, counts in batch_counts.items():
+            year = int(year)
+            if year in self.years:
+                self.years[year] += counts
+            else:
+                self.years[year] = np.array(counts, dtype='int64')
+        return True
+
+    def total(self, years=None):
+        '''
+        counts summed over years
+        input: years to include (default: all)
+        output: (n_tracts, races, measures) array
+        '''
+        out = empty_counts(len(self.tract_ids))
+        for year in self.years if years is None else years:
+            if year in self.years:
+                out += self.years[year]
+        return out
+
+    def percentages(self, years=None):
+        '''
+        normalized per-tract race and activity percentages
+        input: years to include (default: all)
+        output: dataframe with TractID, NumStops, StopsPct<race>, StopsPctBIPOC and StopsPct<activity>
+        '''
+        counts = self.total(years).astype('float64')
+        by_race = counts[:, :, 0]
+        stops = by_race.sum(axis=1)
+        activities = counts[:, :, 1:].sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            race_pct = 100.0 * by_race / stops[:, None]
+            activity_pct = 100.0 * activities / stops[:, None]
+        out = pd.DataFrame({'TractID': self.tract_ids, 'NumStops': stops.astype('int64')})
+        for j, label in enumerate(RACE_LABELS):
+            out['StopsPct' + label] = race_pct[:, j]
+        out['StopsPctBIPOC'] = 100.0 - race_pct[:, RACE_LABELS.index('White')]
+        for j, label in enumerate(ACTIVITY_LABELS):
+            out['StopsPct' + label] = activity_pct[:, j]
+        return out
+
+    def save(self, path=STORE_PATH):
+        '''
+        write the counts to an npz file
+        input: path
+        output: none
+        '''
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        arrays = {f'year_{year}': counts for year, counts in self.years.items()}
+        tmp_path = path + '.part.npz'
+        np.savez_compressed(tmp_path, tract_ids=self.tract_ids, batches=np.array(self.batches, dtype=str), **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=STORE_PATH):
+        '''
+        read counts written by save()
+        input: path
+        output: TractCounts
+        '''
+        with np.load(path) as f:
+            years = {int(key[5:]): f[key] for key in f.files if key.startswith('year_')}
+            return cls(f['tract_ids'], years, f['batches'].tolist())
+
+
+def load_store(path=STORE_PATH):
+    '''
+    the persisted tract counts, if there are any
+    input: path
+    output: TractCounts or None
+    '''
+    if not os.path.exists(path):
+        return None
+    return TractCounts.load(path)
@@ -0,0 +1,237 @@
+'''
+render every map and plot variant to static files, without a streamlit session
+
+usage: python batch.py [--out exports] [--pages race time scatter] [--workers N]
+                       [--stop-layer clusters|bins] [--bin-shape hex|square] [--bin-resolution medium]
+
+    race      page 2's map for every demographic variable          race_map/<variable>.html
+    time      page 3's map for every hour                          time_map/hour_<hh>.html
+    scatter   the scatter page's plot for every race / race and    scatter/<x>__<y>.html and .json
+              race / stop activity pair
+
+variants are rendered by the pages' own builders (generate_map_for_race, generate_map, build_plot),
+imported with prewarm.load_page, and fanned out over a process pool. the data they share (census tracts,
+the tract geojson, the marker payload or bins, the stops split by hour, the tract aggregate and its fits)
+is loaded once, in this process, before the pool starts: workers are forked from it and read those arrays
+copy-on-write, so nothing is reloaded or sent to them but the variant. where fork is not available each
+worker loads the data itself.
+
+every file is written atomically and listed, with its size and render time, in <out>/manifest.json.
+'''
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+import prewarm
+
+# output -> page file
+PAGES = {
+    'race': '2_StopByRaceMap.py',
+    'time': '3_StopByTimeMap.py',
+    'scatter': '4_StopScatterPlot.py',
+}
+# marker colours of the scatter page's race and stop activity plots (its colour pickers' defaults)
+SCATTER_COLORS = {'race': '#039A3E', 'activity': '#1AA5E0'}
+
+# pages and data shared by every variant; set before the pool starts (or by each worker, without fork)
+_context = None
+
+
+def load(pages, options):
+    '''
+    import the pages and load the data their variants share
+    input: outputs to render (keys of PAGES), render options (stop_layer, bin_shape, bin_resolution)
+    output: context dict, one entry per output plus the options and partition selection
+    '''
+    import catalog
+    import config
+    import hourly
+    import shared_data
+
+    selection = catalog.default_selection() if config.BACKEND == 'partitioned' else None
+    context = {'options': options, 'selection': selection}
+    if 'race' in pages:
+        page = prewarm.load_page(PAGES['race'])
+        census_gdf = page.get_census()
+        variables = page.demographic_variables(census_gdf)
+        census_gdf['NumStops'] = page.get_tract_stop_counts(None, selection)
+        clusters = options['stop_layer'] == 'clusters'
+        context['race'] = {
+            'page': page,
+            'census': census_gdf,
+            'variables': variables,
+            'geojson': page.get_tract_geojson(),
+            'payload': page.get_marker_payload(None, selection) if clusters else None,
+            'bins': None if clusters else page.get_bins(options['bin_shape'], options['bin_resolution'], None, selection),
+        }
+    if 'time' in pages:
+        page = prewarm.load_page(PAGES['time'])
+        partitions = page.get_partitions(selection)
+        if not isinstance(partitions, hourly.HourPartitions):
+            # the sqlite and partitioned readers fetch one hour per call; fetch every hour here, so no
+            # database connection or open file crosses the fork
+            partitions = {hour: partitions.get(hour) for hour in range(hourly.HOURS)}
+        context['time'] = {'page': page, 'census': shared_data.view('census'), 'partitions': partitions}
+    if 'scatter' in pages:
+        page = prewarm.load_page(PAGES['scatter'])
+        tract_counts = page.get_tract_counts()
+        # every stop year, as the page selects by default
+        years = tuple(sorted(tract_counts.years)) if tract_counts is not None and tract_counts.years else None
+        context['scatter'] = {'page': page, 'data': page.get_data(years), 'fits': page.get_regression(years)}
+    return context
+
+
+def variants(context):
+    '''
+    every variant to render
+    input: context from load()
+    output: list of (output, variant keyword arguments)
+    '''
+    import hourly
+
+    tasks = []
+    if 'race' in context:
+        tasks += [('race', {'demographic_var': var}) for var in context['race']['variables']]
+    if 'time' in context:
+        tasks += [('time', {'time_of_day': hour}) for hour in range(hourly.HOURS)]
+    if 'scatter' in context:
+        page, columns = context['scatter']['page'], context['scatter']['data'].columns
+        pairs = [('race', 'TractPct' + x, 'StopsPct' + y) for x in page.RACE_OPTIONS for y in page.RACE_OPTIONS]
+        pairs += [('activity', 'TractPct' + x, 'StopsPct' + y) for x in page.RACE_OPTIONS for y in page.ACTIVITY_OPTIONS]
+        tasks += [('scatter', {'plot': plot, 'x_axis_val': x, 'y_axis_val': y})
+                  for plot, x, y in pairs if x in columns and y in columns]
+    return tasks
+
+
+def _slug(name):
+    return re.sub(r'[^\w.-]+', '_', str(name))
+
+
+def _write(out_dir, path, text):
+    # atomic, so an interrupted run never leaves a truncated file behind
+    full_path = os.path.join(out_dir, path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    tmp_path = full_path + '.part'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, full_path)
+    return {'path': path, 'bytes': os.path.getsize(full_path)}
+
+
+def render_race(context, out_dir, demographic_var):
+    data, options = context['race'], context['options']
+    m = data['page'].generate_map_for_race(data['census'], None, demographic_var, options['stop_layer'], options['bin_shape'],
+                                           options['bin_resolution'], _geojson=data['geojson'],
+                                           _marker_payload=data['payload'], _bins=data['bins'])
+    return {'files': [_write(out_dir, f'race_map/{_slug(demographic_var)}.html', m.get_root().render())]}
+
+
+def render_time(context, out_dir, time_of_day):
+    data, options = context['time'], context['options']
+    m = data['page'].generate_map(data['census'], data['partitions'], 'PctBlack', time_of_day, options['stop_layer'],
+                                  options['bin_shape'], options['bin_resolution'])
+    return {'files': [_write(out_dir, f'time_map/hour_{time_of_day:02d}.html', m.get_root().render())]}
+
+
+def render_scatter(context, out_dir, plot, x_axis_val, y_axis_val):
+    data = context['scatter']
+    page = data['page']
+    figure, n_points, fit = page.build_plot(data['data'], data['fits'], x_axis_val, y_axis_val, SCATTER_COLORS[plot],
+                                            page.PERCENT_TICKS)
+    name = f'scatter/{_slug(x_axis_val)}__{_slug(y_axis_val)}'
+    files = [_write(out_dir, name + '.html', figure.to_html(include_plotlyjs='cdn', full_html=True)),
+             _write(out_dir, name + '.json', figure.to_json())]
+    return {'files': files, 'points': n_points, 'fit': fit}
+
+
+RENDERERS = {'race': render_race, 'time': render_time, 'scatter': render_scatter}
+
+
+def _init_worker(pages, options):
+    # a forked worker already has the parent's context; a spawned one loads its own
+    global _context
+    if _context is None:
+        _context = load(pages, options)
+
+
+def _render(task):
+    output, variant, out_dir = task
+    start = time.perf_counter()
+    entry = RENDERERS[output](_context, out_dir, **variant)
+    return {'output': output, 'variant': variant, **entry, 'seconds': time.perf_counter() - start}
+
+
+def render_all(out_dir, pages=tuple(PAGES), options=None, workers=None):
+    '''
+    render every variant of the given outputs and write the manifest
+    input: output directory, outputs (keys of PAGES), render options (see load()), processes (None for
+           every core)
+    output: manifest dict
+    '''
+    import config
+
+    global _context
+    options = {'stop_layer': 'clusters', 'bin_shape': 'hex', 'bin_resolution': 'medium', **(options or {})}
+    start = time.perf_counter()
+    _context = load(pages, options)
+    load_seconds = time.perf_counter() - start
+
+    tasks = [(output, variant, out_dir) for output, variant in variants(_context)]
+    workers = max(1, min(workers or os.cpu_count() or 1, len(tasks)))
+    start = time.perf_counter()
+    if workers > 1:
+        fork = 'fork' in multiprocessing.get_all_start_methods()
+        mp_context = multiprocessing.get_context('fork' if fork else 'spawn')
+        with ProcessPoolExecutor(workers, mp_context=mp_context, initializer=_init_worker,
+                                 initargs=(list(pages), options)) as executor:
+            entries = list(executor.map(_render, tasks))
+    else:
+        entries = [_render(task) for task in tasks]
+    render_seconds = time.perf_counter() - start
+
+    manifest = {
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'backend': config.BACKEND,
+        'selection': _context['selection'],
+        'options': options,
+        'workers': workers,
+        'load_seconds': load_seconds,
+        'render_seconds': render_seconds,
+        'outputs': entries,
+    }
+    _write(out_dir, 'manifest.json', json.dumps(manifest, indent=2))
+    return manifest
+
+
+def main():
+    import binning
+
+    parser = argparse.ArgumentParser(description='Render every map and plot variant to static HTML/JSON files.')
+    parser.add_argument('--out', default='exports', help='output directory')
+    parser.add_argument('--pages', nargs='+', choices=list(PAGES), default=list(PAGES), help='outputs to render')
+    parser.add_argument('--workers', type=int, help='processes (default: every core)')
+    parser.add_argument('--stop-layer', choices=['clusters', 'bins'], default='clusters', help='how the maps show stops')
+    parser.add_argument('--bin-shape', choices=['hex', 'square'], default='hex')
+    parser.add_argument('--bin-resolution', choices=list(binning.RESOLUTIONS), default='medium')
+    args = parser.parse_args()
+
+    import streamlit.logger
+
+    # the pages' caches warn on every call made outside a streamlit session
+    streamlit.logger.set_log_level('error')
+    options = {'stop_layer': args.stop_layer, 'bin_shape': args.bin_shape, 'bin_resolution': args.bin_resolution}
+    manifest = render_all(args.out, args.pages, options, args.workers)
+    n_files = sum(len(entry['files']) for entry in manifest['outputs'])
+    print(f"{n_files} files for {len(manifest['outputs'])} variants written to {args.out} "
+          f"(load {manifest['load_seconds']:.1f} s, render {manifest['render_seconds']:.1f} s on {manifest['workers']} processes)",
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+'''
+time the first render of each page in a fresh process
+
+usage: python -m benchmarks.coldstart [--stops 100000] [--tracts 400] [--repeat 3] [--prewarm]
+                                      [--data-dir DIR] [--out coldstart.json]
+
+every page is run headless (streamlit's AppTest) in a new process, as the first visitor after a deploy
+would: module imports, dataset loads and the default map are all paid by that run. with --prewarm, the
+process runs prewarm.warm() first (as `python prewarm.py --serve` does at server start) and its time is
+reported separately. the synthetic data and its parquet caches are built once beforehand, so downloads
+are not timed.
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.run import ROOT, environment
+
+# page script -> labels of checkboxes to tick after the first run (to reach the default map)
+PAGES = {
+    'main.py': [],
+    'pages/2_StopByRaceMap.py': ['Generate Map'],
+    'pages/3_StopByTimeMap.py': [],
+    'pages/4_StopScatterPlot.py': [],
+}
+
+
+def first_render(page, checks, prewarm):
+    '''
+    render a page once, headless, in this (fresh) process
+    input: page script path (relative to the repo), checkbox labels to tick afterwards, whether to pre-warm first
+    output: dict of seconds for prewarm, first render and the follow-up render (None where not run)
+    '''
+    import streamlit.logger
+    from streamlit.testing.v1 import AppTest
+
+    streamlit.logger.set_log_level('error')
+    timings = {'prewarm': None, 'render': None, 'after_checks': None}
+    if prewarm:
+        import prewarm as prewarm_module
+
+        start = time.perf_counter()
+        prewarm_module.warm()
+        timings['prewarm'] = time.perf_counter() - start
+    app = AppTest.from_file(os.path.join(ROOT, page), default_timeout=600)
+    start = time.perf_counter()
+    app.run()
+    timings['render'] = time.perf_counter() - start
+    if app.exception:
+        raise RuntimeError(f'{page}: {app.exception[0].value}')
+    if checks:
+        for checkbox in app.checkbox:
+            if checkbox.label in checks:
+                checkbox.check()
+        start = time.perf_counter()
+        app.run()
+        timings['after_checks'] = time.perf_counter() - start
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the first render of each page in a fresh process.')
+    parser.add_argument('--stops', type=int, default=100_000, help='number of synthetic stops')
+    parser.add_argument('--tracts', type=int, default=400, help='number of synthetic census tracts')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3, help='fresh processes per page')
+    parser.add_argument('--prewarm', action='store_true', help='run prewarm.warm() before the first render')
+    parser.add_argument('--data-dir', help='where synthetic data is kept between runs (default: a temp dir)')
+    parser.add_argument('--out', default='coldstart.json', help='json results file')
+    parser.add_argument('--worker', nargs=2, metavar=('PAGE', 'OUT'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        page, out = args.worker
+        with open(out, 'w') as f:
+            json.dump(first_render(page, PAGES[page], args.prewarm), f)
+        return
+
+    from benchmarks import synthetic
+
+    data_dir = args.data_dir or os.path.join(tempfile.gettempdir(), 'stopstats-benchmark',
+                                             f'{args.stops}-{args.tracts}-{args.seed}')
+    synthetic.generate(data_dir, args.stops, args.tracts, args.seed)
+    env = dict(os.environ, STOPSTATS_DATA_DIR=data_dir, PYTHONPATH=ROOT)
+    for name in ('census', 'stops', 'tracts'):
+        env.pop('STOPSTATS_' + name.upper() + '_CSV', None)
+    # build the parquet caches once, so the timed runs only read them
+    subprocess.run([sys.executable, '-c', 'import datastore\nfor name in ("census", "stops", "tracts"): datastore.parquet_path(name)'],
+                   cwd=ROOT, env=env, check=True)
+
+    results = []
+    timings_path = os.path.join(data_dir, 'coldstart.json')
+    for page in PAGES:
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-m', 'benchmarks.coldstart', '--worker', page, timings_path]
+                           + (['--prewarm'] if args.prewarm else []), cwd=ROOT, env=env, check=True)
+            process = time.perf_counter() - start
+            with open(timings_path) as f:
+                timings = json.load(f)
+            results.append({'page': page, 'prewarm': args.prewarm, 'process': process, **timings})
+            print(f"  {page:32s} render {timings['render']:7.3f} s"
+                  + (f"  after checks {timings['after_checks']:7.3f} s" if timings['after_checks'] is not None else '')
+                  + (f"  (prewarm {timings['prewarm']:.3f} s)" if args.prewarm else ''), file=sys.stderr)
+
+    with open(args.out, 'w') as f:
+        json.dump({'environment': environment(), 'stops': args.stops, 'tracts': args.tracts, 'results': results}, f, indent=2)
+    print(f'results written to {args.out}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+'''
+check fetch.py against a local http server
+
+usage: python -m benchmarks.fetchcheck [--data-dir DIR]
+
+a ThreadingHTTPServer on a free local port plays the remote source: it sends ETags, answers conditional
+requests with 304, honours Range / If-Range with 206, and can be told to drop a connection part way, to
+answer with an html page instead of the csv, or to go away. each behaviour of fetch.fetch() is checked in
+turn:
+
+    - a first fetch downloads the csv and records its sha256
+    - revalidation: a conditional request that gets a 304 keeps the mirror
+    - resume: a connection dropped part way is retried from the bytes already on disk (Range / If-Range)
+    - html rejection: an html page is never mirrored; the existing mirror is kept, else SourceError
+    - offline: with the server gone the mirror is used as it is; without one the error is raised
+
+nothing leaves the machine. the mirror goes to a temporary data directory unless --data-dir is given.
+'''
+import argparse
+import hashlib
+import http.server
+import os
+import sys
+import tempfile
+import threading
+
+CSV = b'TractID,NumStops\n' + b'53033000100,12\n' * 200_000
+HTML = b'<!DOCTYPE html><html><body>Google Drive can&#39;t scan this file for viruses.</body></html>'
+# bytes sent before a dropped connection is cut
+DROP_AFTER = 1000
+
+
+class SourceServer(http.server.ThreadingHTTPServer):
+    '''
+    local stand-in for a source csv host
+    input: none (listens on a free port of 127.0.0.1)
+
+    body and version make the ETag; drop (cut the next response short), html (answer with an html page)
+    switch on the failures to check, and requests logs the headers fetch sent.
+    '''
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SourceHandler)
+        self.body, self.version = CSV, 1
+        self.drop = self.html = False
+        self.requests = []
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_port}/stops.csv'
+
+    @property
+    def etag(self):
+        return f'"v{self.version}"'
+
+    def publish(self, body):
+        # a new version of the source
+        self.body, self.version = body, self.version + 1
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class SourceHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append({key: self.headers.get(key) for key in ('If-None-Match', 'Range', 'If-Range')})
+        if server.html:
+            self._send(200, HTML, {'Content-Type': 'text/html; charset=utf-8'})
+            return
+        if self.headers.get('If-None-Match') == server.etag:
+            self._send(304, b'', {'ETag': server.etag})
+            return
+        body, headers = server.body, {'Content-Type': 'text/csv', 'ETag': server.etag}
+        status, start = 200, 0
+        if self.headers.get('Range') and self.headers.get('If-Range') == server.etag:
+            start = int(self.headers['Range'].split('=')[1].rstrip('-'))
+            status = 206
+            headers['Content-Range'] = f'bytes {start}-{len(body) - 1}/{len(body)}'
+        drop, server.drop = server.drop, False
+        self._send(status, body[start:], headers, cut=DROP_AFTER if drop else None)
+
+    def _send(self, status, body, headers, cut=None):
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        if status != 304:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body[:cut])
+        if cut is not None:
+            self.wfile.flush()
+            self.close_connection = True
+
+
+def sha256(body):
+    return hashlib.sha256(body).hexdigest()
+
+
+def expect(condition, what):
+    if not condition:
+        raise AssertionError(what)
+
+
+def run_checks(server):
+    '''
+    run every check against the server, printing one line per check
+    input: SourceServer
+    output: None (raises AssertionError at the first failed check)
+    '''
+    import fetch
+
+    # retries in milliseconds rather than seconds
+    fetch.BACKOFF = 0.01
+    name, url = 'stops', server.url
+    meta_path = fetch.mirror_path(name) + '.meta.json'
+
+    path, digest = fetch.fetch(name, url, revalidate_after=0)
+    expect(digest == sha256(CSV) and open(path, 'rb').read() == CSV, 'first fetch: mirror differs from the source')
+    print('first fetch: downloaded', len(CSV), 'bytes')
+
+    server.requests.clear()
+    checked = fetch.read_meta(name)['checked']
+    path, digest = fetch.fetch(name, url, revalidate_after=0)
+    expect(server.requests[0]['If-None-Match'] == server.etag, 'revalidation: request was not conditional')
+    expect(digest == sha256(CSV) and fetch.read_meta(name)['checked'] > checked, 'revalidation: mirror not kept')
+    server.requests.clear()
+    fetch.fetch(name, url)
+    expect(not server.requests, 'revalidation: a freshly checked mirror should not be requested')
+    print('revalidation: 304 kept the mirror; a fresh mirror was used without a request')
+
+    updated = CSV.replace(b',12\n', b',13\n')
+    server.publish(updated)
+    server.drop = True
+    server.requests.clear()
+    path, digest = fetch.fetch(name, url, revalidate_after=0)
+    expect(digest == sha256(updated) and open(path, 'rb').read() == updated, 'resume: mirror differs from the source')
+    expect(len(server.requests) == 2, f'resume: expected 2 requests, got {len(server.requests)}')
+    retry = server.requests[1]
+    expect(retry['Range'] == f'bytes={DROP_AFTER}-' and retry['If-Range'] == server.etag,
+           f'resume: retry asked for {retry}')
+    print(f'resume: dropped after {DROP_AFTER} bytes, resumed with Range {retry["Range"]}')
+
+    server.html = True
+    path, digest = fetch.fetch(name, url, revalidate_after=0)
+    expect(digest == sha256(updated) and open(path, 'rb').read() == updated, 'html page: mirror was replaced')
+    expect(not os.path.exists(path + '.part'), 'html page: partial download left behind')
+    try:
+        fetch.fetch('html', url)
+        raise AssertionError('html page: fetched without a mirror')
+    except fetch.SourceError:
+        pass
+    expect(not os.path.exists(fetch.mirror_path('html')), 'html page: mirrored')
+    server.html = False
+    print('html page: rejected; the mirror was kept, and without one SourceError was raised')
+
+    server.stop()
+    path, digest = fetch.fetch(name, url, revalidate_after=0)
+    expect(digest == sha256(updated), 'offline: mirror not used')
+    os.remove(meta_path)
+    try:
+        fetch.fetch(name, url)
+        raise AssertionError('offline: fetched without a server or a mirror')
+    except fetch.TRANSIENT:
+        pass
+    print('offline: the mirror was used; without one the error was raised')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check fetch.py against a local HTTP server.')
+    parser.add_argument('--data-dir', help='data directory for the mirror (default: a temporary one)')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        # config reads the data directory at import
+        os.environ['STOPSTATS_DATA_DIR'] = args.data_dir or tmp
+        server = SourceServer()
+        try:
+            run_checks(server)
+        except AssertionError as error:
+            print('FAILED', error, file=sys.stderr)
+            return 1
+        finally:
+            if server.socket.fileno() != -1:
+                server.stop()
+    print('all fetch checks passed')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,206 @@
+'''
+time the app's hot paths on synthetic data
+
+usage: python -m benchmarks.run [--sizes 10000 100000 1000000] [--tracts 400] [--repeat 3]
+                                [--data-dir DIR] [--out results.json]
+
+each size gets its own synthetic data directory (see benchmarks/synthetic.py) and runs in a fresh process,
+since the app reads STOPSTATS_DATA_DIR at import and keeps datasets in per-process caches. nothing is
+downloaded. results go to a json file so runs can be compared.
+'''
+import argparse
+import datetime
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from prewarm import load_page
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(fn, repeat):
+    '''
+    time a callable
+    input: callable returning a payload size in bytes (or None), number of runs
+    output: dict with every run's seconds, the fastest and median run, and the last payload size
+    '''
+    seconds = []
+    size = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        size = fn()
+        seconds.append(time.perf_counter() - start)
+    ordered = sorted(seconds)
+    return {'seconds': seconds, 'min': ordered[0], 'median': ordered[len(ordered) // 2], 'bytes': size}
+
+
+def html_size(m):
+    return len(m.get_root().render().encode())
+
+
+def cases():
+    '''
+    benchmark cases for the data in STOPSTATS_DATA_DIR
+    input: none
+    output: list of (name, callable) in run order
+    '''
+    import branca
+    import folium
+
+    import choropleth
+    import datastore
+    import hourly
+    import regression
+    import scatter
+    import shared_data
+
+    race_map = load_page('2_StopByRaceMap.py', 'stop_by_race_map')
+    time_map = load_page('3_StopByTimeMap.py', 'stop_by_time_map')
+    scatter_plot = load_page('4_StopScatterPlot.py', 'stop_scatter_plot')
+
+    def build_parquet(name):
+        def run():
+            for path in glob.glob(os.path.join(datastore.config.CACHE_DIR, name + '-*.parquet')):
+                os.remove(path)
+            return os.path.getsize(datastore.build(name, datastore.config.local_source(name) or datastore.fetch.mirror_path(name)))
+        return run
+
+    def get_data(page):
+        def run():
+            # drop the per-process copies so every run loads from parquet
+            shared_data._frames.clear()
+            shared_data._derived.clear()
+            page.get_data()
+        return run
+
+    census_gdf, stop_gdf = race_map.get_data()
+    demographic_var = 'PctBlack'
+    colormap = branca.colormap.LinearColormap(
+        vmin=census_gdf[demographic_var].quantile(0.05), vmax=census_gdf[demographic_var].quantile(0.95),
+        colors=['white', 'red'], caption=demographic_var)
+    geojson = choropleth.tract_geojson(census_gdf)
+
+    def choropleth_map():
+        m = folium.Map(location=[47.4405, -121.8836], zoom_start=9, prefer_canvas=True)
+        race_map.generate_choropleth_map(census_gdf, demographic_var, colormap, geojson).add_to(m)
+        return html_size(m)
+
+    def marker_cluster():
+        m = folium.Map(location=[47.4405, -121.8836], zoom_start=9, prefer_canvas=True)
+        race_map.generate_marker_cluster(stop_gdf).add_to(m)
+        return html_size(m)
+
+    time_census, time_stops = time_map.get_data()
+    partitions = hourly.HourPartitions(time_stops)
+
+    def hour_partitions():
+        hourly.HourPartitions(time_stops)
+
+    def hourly_map():
+        return html_size(time_map.generate_map(time_census, partitions, demographic_var, 17))
+
+    def ols_trendline():
+        # the race plot's default pair, fitted from scratch
+        x_axis_val, y_axis_val = 'TractPctWhite', 'StopsPctWhite'
+        dataframe = shared_data.view('tracts')
+        fits = regression.PairwiseOLS(dataframe)
+        plot, _ = scatter.build_scatter(dataframe, x_axis_val, y_axis_val)
+        scatter_plot.add_trendline(plot, dataframe, x_axis_val, y_axis_val, fits.fit(x_axis_val, y_axis_val))
+        return len(plot.to_json().encode())
+
+    return [
+        *[(f'build_parquet[{name}]', build_parquet(name)) for name in ('census', 'stops', 'tracts')],
+        ('get_data[StopByRaceMap]', get_data(race_map)),
+        ('get_data[StopByTimeMap]', get_data(time_map)),
+        ('get_data[StopScatterPlot]', get_data(scatter_plot)),
+        ('generate_choropleth_map', choropleth_map),
+        ('generate_marker_cluster', marker_cluster),
+        ('hour_partitions', hour_partitions),
+        ('generate_map[StopByTimeMap]', hourly_map),
+        ('ols_trendline', ols_trendline),
+    ]
+
+
+def run_cases(repeat):
+    '''
+    run every case against the data in STOPSTATS_DATA_DIR
+    input: runs per case
+    output: dict of case name -> timing (see measure())
+    '''
+    import streamlit.logger
+
+    # bare-mode streamlit warns about the missing script context on every cached call
+    streamlit.logger.set_log_level('error')
+    return {name: measure(fn, repeat) for name, fn in cases()}
+
+
+def environment():
+    import numpy
+    import pandas
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'commit': commit or None,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'numpy': numpy.__version__,
+        'pandas': pandas.__version__,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the app on synthetic data.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000], help='numbers of stops')
+    parser.add_argument('--tracts', type=int, default=400, help='number of census tracts')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per case')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', help='where synthetic data is kept between runs (default: a temp dir)')
+    parser.add_argument('--out', default='benchmark.json', help='json results file')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        # child process: STOPSTATS_DATA_DIR is already set, timings go to the file named by --worker
+        with open(args.worker, 'w') as f:
+            json.dump(run_cases(args.repeat), f)
+        return
+
+    from benchmarks import synthetic
+
+    data_dir = args.data_dir or os.path.join(tempfile.gettempdir(), 'stopstats-benchmark')
+    results = []
+    for size in args.sizes:
+        size_dir = os.path.join(data_dir, f'{size}-{args.tracts}-{args.seed}')
+        print(f'{size:,} stops: generating data', file=sys.stderr)
+        synthetic.generate(size_dir, size, args.tracts, args.seed)
+        print(f'{size:,} stops: running', file=sys.stderr)
+        env = dict(os.environ, STOPSTATS_DATA_DIR=size_dir, PYTHONPATH=ROOT)
+        for name in ('census', 'stops', 'tracts'):
+            env.pop('STOPSTATS_' + name.upper() + '_CSV', None)
+        timings_path = os.path.join(size_dir, 'timings.json')
+        subprocess.run([sys.executable, '-m', 'benchmarks.run', '--worker', timings_path, '--repeat', str(args.repeat)],
+                       cwd=ROOT, env=env, check=True)
+        with open(timings_path) as f:
+            timings = json.load(f)
+        for case, timing in timings.items():
+            results.append({'stops': size, 'tracts': args.tracts, 'case': case, **timing})
+            print(f"  {case:32s} {timing['median']:9.4f} s", file=sys.stderr)
+
+    with open(args.out, 'w') as f:
+        json.dump({'environment': environment(), 'repeat': args.repeat, 'results': results}, f, indent=2)
+    print(f'results written to {args.out}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
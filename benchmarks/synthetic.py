@@ -0,0 +1,191 @@
+'''
+synthetic census tracts and traffic stops in the app's source csv layout
+
+usage: python -m benchmarks.synthetic OUT_DIR [--stops 1000000] [--tracts 400] [--seed 0]
+
+writes OUT_DIR/raw/{census,stops,tracts}.csv, so STOPSTATS_DATA_DIR=OUT_DIR points the app at them.
+stops are written chunk by chunk and can run to tens of millions of rows.
+'''
+import argparse
+import json
+import math
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+# king county, roughly
+BOUNDS = (-122.5, 47.1, -121.2, 47.8)
+# (lon, lat) of the dense areas most stops fall around
+HOTSPOTS = [(-122.33, 47.61), (-122.20, 47.61), (-122.23, 47.38), (-122.31, 47.32), (-122.12, 47.67)]
+HOTSPOT_SHARE = 0.7
+HOTSPOT_SPREAD = 0.05
+
+# stanford open policing values and (approximate) washington state patrol shares
+SUBJECT_RACES = ['white', 'black', 'hispanic', 'asian/pacific islander', 'other', 'unknown']
+RACE_SHARES = [0.68, 0.06, 0.10, 0.08, 0.03, 0.05]
+OUTCOMES = ['citation', 'warning', 'arrest', None]
+OUTCOME_SHARES = [0.45, 0.40, 0.03, 0.12]
+# relative stop volume by hour of day
+HOUR_WEIGHTS = np.array([3, 2, 2, 1, 1, 2, 4, 7, 8, 7, 6, 6, 6, 6, 7, 8, 8, 7, 5, 4, 4, 4, 4, 3], dtype='float64')
+
+CENSUS_COLUMNS = ['TractID', 'TotalPop', 'PctWhite', 'PctBlack', 'PctHispanic', 'PctAAPI', 'PctOther', 'PctBIPOC',
+                  'MedianAge', 'MedianIncome', 'PctMale', 'PctBachelors', 'PctPoverty', 'geometry']
+STOP_COLUMNS = ['date_time', 'subject_age', 'subject_race', 'subject_sex', 'search_conducted', 'frisk_performed',
+                'contraband_found', 'citation_issued', 'warning_issued', 'outcome', 'geometry']
+
+
+def census_frame(n_tracts, seed=0):
+    '''
+    census tracts on a regular grid over BOUNDS
+    input: number of tracts, random seed
+    output: dataframe in the census csv layout (geometry as wkt)
+    '''
+    rng = np.random.default_rng(seed)
+    side = math.ceil(math.sqrt(n_tracts))
+    xs = np.linspace(BOUNDS[0], BOUNDS[2], side + 1)
+    ys = np.linspace(BOUNDS[1], BOUNDS[3], side + 1)
+    i, j = np.divmod(np.arange(n_tracts), side)
+    x0, x1, y0, y1 = xs[i], xs[i + 1], ys[j], ys[j + 1]
+    geometry = [f'POLYGON (({a} {c}, {b} {c}, {b} {d}, {a} {d}, {a} {c}))' for a, b, c, d in zip(x0, x1, y0, y1)]
+
+    # white, black, hispanic, aapi, other shares of each tract, summing to 100
+    races = rng.dirichlet([6.0, 0.8, 1.2, 1.2, 0.5], n_tracts) * 100
+    census = pd.DataFrame({
+        'TractID': 53033000100 + np.arange(n_tracts) * 100,
+        'TotalPop': rng.integers(1_000, 9_000, n_tracts),
+        'PctWhite': races[:, 0],
+        'PctBlack': races[:, 1],
+        'PctHispanic': races[:, 2],
+        'PctAAPI': races[:, 3],
+        'PctOther': races[:, 4],
+        'PctBIPOC': 100 - races[:, 0],
+        'MedianAge': rng.normal(38, 6, n_tracts).round(1),
+        'MedianIncome': rng.lognormal(11.4, 0.4, n_tracts).round(),
+        'PctMale': rng.normal(50, 3, n_tracts),
+        'PctBachelors': rng.uniform(10, 80, n_tracts),
+        'PctPoverty': rng.gamma(2.0, 5.0, n_tracts),
+        'geometry': geometry,
+    })
+    # a few tracts without estimates, as in the acs data
+    missing = rng.choice(n_tracts, max(1, n_tracts // 100), replace=False)
+    census.loc[missing, ['MedianAge', 'MedianIncome']] = np.nan
+    return census[CENSUS_COLUMNS]
+
+
+def stop_chunk(n, rng, year=2018):
+    '''
+    one chunk of synthetic stops
+    input: number of stops, numpy generator, year
+    output: dataframe in the stop csv layout (geometry as wkt)
+    '''
+    hotspot = rng.random(n) < HOTSPOT_SHARE
+    centres = np.asarray(HOTSPOTS)[rng.integers(len(HOTSPOTS), size=n)]
+    lon = np.where(hotspot, rng.normal(centres[:, 0], HOTSPOT_SPREAD), rng.uniform(BOUNDS[0], BOUNDS[2], n))
+    lat = np.where(hotspot, rng.normal(centres[:, 1], HOTSPOT_SPREAD), rng.uniform(BOUNDS[1], BOUNDS[3], n))
+    lon = np.clip(lon, BOUNDS[0], BOUNDS[2])
+    lat = np.clip(lat, BOUNDS[1], BOUNDS[3])
+
+    days = rng.integers(0, 365, n)
+    hours = rng.choice(24, n, p=HOUR_WEIGHTS / HOUR_WEIGHTS.sum())
+    minutes = rng.integers(0, 60, n)
+    date_time = (pd.Timestamp(year=year, month=1, day=1)
+                 + pd.to_timedelta(days * 1440 + hours * 60 + minutes, unit='min'))
+
+    searched = rng.random(n) < 0.04
+    outcome = np.asarray(OUTCOMES, dtype=object)[rng.choice(len(OUTCOMES), n, p=OUTCOME_SHARES)]
+    age = rng.normal(38, 14, n).clip(16, 90).round()
+    age[rng.random(n) < 0.01] = np.nan
+    points = pd.Series(lon).map('{:.6f}'.format) + ' ' + pd.Series(lat).map('{:.6f}'.format)
+    return pd.DataFrame({
+        'date_time': date_time.strftime('%Y-%m-%d %H:%M:%S'),
+        'subject_age': age,
+        'subject_race': np.asarray(SUBJECT_RACES)[rng.choice(len(SUBJECT_RACES), n, p=RACE_SHARES)],
+        'subject_sex': np.where(rng.random(n) < 0.68, 'male', 'female'),
+        'search_conducted': searched,
+        'frisk_performed': searched & (rng.random(n) < 0.3),
+        'contraband_found': searched & (rng.random(n) < 0.35),
+        'citation_issued': outcome == 'citation',
+        'warning_issued': outcome == 'warning',
+        'outcome': outcome,
+        'geometry': ('POINT (' + points + ')').to_numpy(),
+    })[STOP_COLUMNS]
+
+
+def write_stops(path, n_stops, seed=0, chunk_size=1_000_000):
+    '''
+    write synthetic stops to a csv without holding them all in memory
+    input: output path, number of stops, random seed, rows per chunk
+    output: none
+    '''
+    rng = np.random.default_rng(seed + 1)
+    for start in range(0, n_stops, chunk_size):
+        chunk = stop_chunk(min(chunk_size, n_stops - start), rng)
+        chunk.to_csv(path, mode='w' if start == 0 else 'a', header=start == 0, index=False)
+
+
+def tract_frame(census, stops_path, workers=None):
+    '''
+    tract aggregate for the synthetic stops, built by the stop pipeline
+    input: census dataframe from census_frame(), stop csv path, processes
+    output: dataframe in the tract aggregate csv layout
+    '''
+    import pipeline
+
+    census_gdf = gpd.GeoDataFrame(census.drop(columns='geometry'),
+                                  geometry=gpd.GeoSeries.from_wkt(census['geometry']), crs='EPSG:4326')
+    tracts = pipeline.build_tract_aggregate(pipeline.read_stop_chunks(stops_path), census_gdf, workers=workers)
+    tracts = tracts.rename(columns={'TotalPop': 'Population',
+                                    **{f'Pct{race}': f'TractPct{race}'
+                                       for race in ['White', 'Black', 'Hispanic', 'AAPI', 'Other', 'BIPOC']}})
+    tracts['County'] = 'King'
+    # tract polygons as wkt, last, as in the real aggregate
+    tracts['geometry'] = tracts['TractID'].map(census.set_index('TractID')['geometry'])
+    return tracts
+
+
+def generate(out_dir, n_stops, n_tracts=400, seed=0, chunk_size=1_000_000, workers=None):
+    '''
+    write the three source csvs, unless the same data is already there
+    input: data directory, number of stops, number of tracts, random seed, stop rows per chunk, processes
+    output: dict of dataset name -> csv path
+    '''
+    raw_dir = os.path.join(out_dir, 'raw')
+    paths = {name: os.path.join(raw_dir, name + '.csv') for name in ('census', 'stops', 'tracts')}
+    # 'layout' changes whenever a generated csv does, so older data directories are rewritten
+    params = {'stops': n_stops, 'tracts': n_tracts, 'seed': seed, 'layout': 2}
+    params_path = os.path.join(raw_dir, 'synthetic.json')
+    try:
+        with open(params_path) as f:
+            if json.load(f) == params and all(os.path.exists(path) for path in paths.values()):
+                return paths
+    except (OSError, ValueError):
+        pass
+
+    os.makedirs(raw_dir, exist_ok=True)
+    census = census_frame(n_tracts, seed)
+    census.to_csv(paths['census'], index=False)
+    write_stops(paths['stops'], n_stops, seed, chunk_size)
+    tract_frame(census, paths['stops'], workers).to_csv(paths['tracts'], index=False)
+    with open(params_path, 'w') as f:
+        json.dump(params, f)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write synthetic census, stop and tract csvs.')
+    parser.add_argument('out', help='data directory (csvs go to OUT/raw/)')
+    parser.add_argument('--stops', type=int, default=1_000_000, help='number of stops')
+    parser.add_argument('--tracts', type=int, default=400, help='number of census tracts')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--chunk-size', type=int, default=1_000_000, help='stops generated per chunk')
+    parser.add_argument('--workers', type=int, default=None, help='processes for the tract join')
+    args = parser.parse_args()
+
+    for name, path in generate(args.out, args.stops, args.tracts, args.seed, args.chunk_size, args.workers).items():
+        print(f'{name}: {path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+import stoptable
+
+# cell size (degrees of latitude) for each resolution
+RESOLUTIONS = {'coarse': 0.04, 'medium': 0.02, 'fine': 0.01}
+
+# stop columns broken down per bin, with the label used in the tooltip
+BREAKDOWNS = [
+    ('subject_race', 'Race'),
+    ('search_conducted', 'Search Conducted'),
+    ('outcome', 'Outcome'),
+]
+
+# keeps (q, r) cell indices packable into one int64
+_OFFSET = 1 << 30
+SQRT3 = math.sqrt(3.0)
+
+
+class Binner:
+    '''
+    assigns points to hexagon or square cells
+    input: shape ('hex' or 'square'), cell size in degrees of latitude, reference latitude
+
+    longitude is scaled by cos(reference latitude) so cells are roughly regular on the ground.
+    '''
+
+    def __init__(self, shape='hex', size=RESOLUTIONS['medium'], ref_lat=47.5):
+        if shape not in ('hex', 'square'):
+            raise ValueError(f'unknown bin shape: {shape}')
+        self.shape = shape
+        self.size = size
+        self.kx = math.cos(math.radians(ref_lat))
+
+    def cells(self, lon, lat):
+        '''
+        cell indices for points
+        input: longitude, latitude arrays
+        output: q, r integer arrays
+        '''
+        x = np.asarray(lon, dtype='float64') * self.kx
+        y = np.asarray(lat, dtype='float64')
+        if self.shape == 'square':
+            return np.floor(x / self.size).astype('int64'), np.floor(y / self.size).astype('int64')
+        # pointy-top axial coordinates, then cube rounding
+        qf = (SQRT3 / 3.0 * x - y / 3.0) / self.size
+        rf = (2.0 / 3.0 * y) / self.size
+        sf = -qf - rf
+        q, r, s = np.rint(qf), np.rint(rf), np.rint(sf)
+        dq, dr, ds = np.abs(q - qf), np.abs(r - rf), np.abs(s - sf)
+        fix_q = (dq > dr) & (dq > ds)
+        fix_r = ~fix_q & (dr > ds)
+        q = np.where(fix_q, -r - s, q)
+        r = np.where(fix_r, -q - s, r)
+        return q.astype('int64'), r.astype('int64')
+
+    def polygons(self, q, r):
+        '''
+        cell outlines
+        input: q, r integer arrays
+        output: array (n, vertices + 1, 2) of closed lon/lat rings
+        '''
+        q = np.asarray(q, dtype='float64')[:, None]
+        r = np.asarray(r, dtype='float64')[:, None]
+        if self.shape == 'square':
+            dx = np.array([0, 1, 1, 0, 0], dtype='float64')
+            dy = np.array([0, 0, 1, 1, 0], dtype='float64')
+            x = (q + dx) * self.size
+            y = (r + dy) * self.size
+        else:
+            angles = np.radians(30.0 + 60.0 * np.arange(7))
+            x = self.size * SQRT3 * (q + r / 2.0) + self.size * np.cos(angles)
+            y = self.size * 1.5 * r + self.size * np.sin(angles)
+        return np.stack([x / self.kx, y], axis=-1)
+
+    def centers(self, q, r):
+        '''
+        cell centres
+        input: q, r integer arrays
+        output: longitude, latitude arrays
+        '''
+        q = np.asarray(q, dtype='float64')
+        r = np.asarray(r, dtype='float64')
+        if self.shape == 'square':
+            x, y = (q + 0.5) * self.size, (r + 0.5) * self.size
+        else:
+            x, y = self.size * SQRT3 * (q + r / 2.0), self.size * 1.5 * r
+        return x / self.kx, y
+
+
+def pack(q, r):
+    return ((q + _OFFSET) << 32) | (r + _OFFSET)
+
+
+def unpack(keys):
+    return (keys >> 32) - _OFFSET, (keys & 0xFFFFFFFF) - _OFFSET
+
+
+class BinAggregate:
+    '''
+    running per-bin stop counts and breakdowns
+    input: Binner, list of (column, label) breakdowns
+
+    add() can be called once per chunk of stops; memory grows with the number of occupied
+    bins and categories, not with the number of stops.
+    '''
+
+    def __init__(self, binner, breakdowns=BREAKDOWNS):
+        self.binner = binner
+        self.breakdowns = breakdowns
+        self.keys = np.empty(0, dtype='int64')
+        self.counts = np.empty(0, dtype='int64')
+        self.categories = {column: [] for column, _ in breakdowns}
+        self.tables = {column: np.empty((0, 0), dtype='int64') for column, _ in breakdowns}
+
+    def _grow_bins(self, keys):
+        new = np.setdiff1d(keys, self.keys, assume_unique=True)
+        if new.size == 0:
+            return
+        merged = np.union1d(self.keys, new)
+        rows = np.searchsorted(merged, self.keys)
+        counts = np.zeros(len(merged), dtype='int64')
+        counts[rows] = self.counts
+        self.counts = counts
+        for column, table in self.tables.items():
+            grown = np.zeros((len(merged), table.shape[1]), dtype='int64')
+            grown[rows] = table
+            self.tables[column] = grown
+        self.keys = merged
+
+    def _codes(self, column, values):
+        # map a chunk's values onto the running category list for this column
+        local_codes, uniques = pd.factorize(values, use_na_sentinel=False)
+        categories = self.categories[column]
+        lookup = {str(value): i for i, value in enumerate(categories)}
+        mapping = np.empty(len(uniques), dtype='int64')
+        for i, value in enumerate(uniques):
+            label = str(value)
+            if label not in lookup:
+                lookup[label] = len(categories)
+                categories.append(label)
+            mapping[i] = lookup[label]
+        table = self.tables[column]
+        if table.shape[1] < len(categories):
+            grown = np.zeros((table.shape[0], len(categories)), dtype='int64')
+            grown[:, :table.shape[1]] = table
+            self.tables[column] = grown
+        return mapping[local_codes]
+
+    def add(self, lon, lat, columns):
+        '''
+        add a chunk of stops
+        input: longitude, latitude arrays, dict of breakdown column -> values
+        output: none
+        '''
+        keys = pack(*self.binner.cells(lon, lat))
+        self._grow_bins(np.unique(keys))
+        rows = np.searchsorted(self.keys, keys)
+        n = len(self.keys)
+        self.counts += np.bincount(rows, minlength=n)
+        for column, _ in self.breakdowns:
+            codes = self._codes(column, columns[column])
+            width = len(self.categories[column])
+            self.tables[column] += np.bincount(rows * width + codes, minlength=n * width).reshape(n, width)
+
+    def add_frame(self, stop_gdf, chunk_size=500_000):
+        '''
+        add a stop geodataframe in chunks
+        input: stop frame (see stoptable), rows per chunk
+        output: self
+        '''
+        for start in range(0, len(stop_gdf), chunk_size):
+            chunk = stop_gdf.iloc[start:start + chunk_size]
+            self.add(*stoptable.coordinates(chunk),
+                     {column: chunk[column] for column, _ in self.breakdowns})
+        return self
+
+    def subset(self, mask):
+        '''
+        some of the bins
+        input: boolean mask (or index array) over the bins
+        output: BinAggregate with those bins, sharing this one's binner and categories
+        '''
+        out = BinAggregate(self.binner, self.breakdowns)
+        out.keys = self.keys[mask]
+        out.counts = self.counts[mask]
+        out.categories = {column: list(categories) for column, categories in self.categories.items()}
+        out.tables = {column: table[mask] for column, table in self.tables.items()}
+        return out
+
+    def summaries(self, top=3):
+        '''
+        short text breakdown per bin
+        input: number of categories to list
+        output: dict of label -> list of strings, one per bin
+        '''
+        out = {}
+        for column, label in self.breakdowns:
+            table = self.tables[column]
+            categories = np.array(self.categories[column], dtype=object)
+            shares = table / np.maximum(self.counts, 1)[:, None]
+            order = np.argsort(-table, axis=1)[:, :top]
+            texts = []
+            for i in range(len(self.keys)):
+                texts.append(', '.join(f'{categories[j]} {shares[i, j]:.0%}' for j in order[i] if table[i, j]))
+            out[label] = texts
+        return out
+
+
+def bin_stops(stop_gdf, shape='hex', resolution='medium'):
+    '''
+    bin stops for one of the named resolutions
+    input: stop geodataframe, bin shape, resolution name (see RESOLUTIONS)
+    output: BinAggregate
+    '''
+    return BinAggregate(Binner(shape, RESOLUTIONS[resolution])).add_frame(stop_gdf)
+
+
+def bins_layer(aggregate, name='Stops (binned)'):
+    '''
+    polygon layer for binned stops, shaded by count
+    input: BinAggregate
+    output: folium GeoJson layer
+    '''
+    # folium is only needed to draw; binning itself (and the pages' bin settings) do without it
+    import folium
+    from folium.features import GeoJsonTooltip
+
+    q, r = unpack(aggregate.keys)
+    rings = aggregate.binner.polygons(q, r)
+    counts = aggregate.counts
+
+    # log-scaled white -> dark blue, computed for all bins at once
+    level = np.log1p(counts) / max(np.log1p(counts.max()), 1.0) if len(counts) else counts
+    rgb = np.rint(np.array([255, 255, 255]) + level[:, None] * (np.array([8, 48, 107]) - 255)).astype(int)
+    fills = ['#%02x%02x%02x' % tuple(c) for c in rgb]
+
+    summaries = aggregate.summaries()
+    features = []
+    for i in range(len(counts)):
+        properties = {'Stops': int(counts[i]), 'fill': fills[i]}
+        for label, texts in summaries.items():
+            properties[label] = texts[i]
+        features.append({
+            'type': 'Feature',
+            'geometry': {'type': 'Polygon', 'coordinates': [rings[i].round(6).tolist()]},
+            'properties': properties,
+        })
+
+    return folium.GeoJson(
+        {'type': 'FeatureCollection', 'features': features},
+        name=name,
+        style_function=lambda x: {
+            'fillColor': x['properties']['fill'],
+            'color': 'gray',
+            'weight': 0.5,
+            'fillOpacity': 0.6,
+        },
+        tooltip=GeoJsonTooltip(fields=['Stops'] + [label for _, label in aggregate.breakdowns]),
+    )
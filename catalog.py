@@ -0,0 +1,263 @@
+'''
+partitioned stop dataset covering many states, agencies and years
+
+usage: python catalog.py STOPS_CSV --state WA --agency statewide [--chunk-size 500000]
+
+stops are stored as parquet under data/stops/state=<state>/agency=<agency>/year=<year>/ and listed in
+data/stops/catalog.json. readers pick files from the catalog (partition pruning), read only the columns they
+ask for, and push hour / race / outcome filters down to the parquet reader. files are sorted by hour, so an
+hour filter skips most row groups.
+'''
+import argparse
+import json
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+import config
+import instrument
+import stoptable
+
+STORE_DIR = os.path.join(config.DATA_DIR, 'stops')
+CATALOG_PATH = os.path.join(STORE_DIR, 'catalog.json')
+ROW_GROUP_SIZE = 50_000
+
+# stop columns kept in the partitions besides date_time / hour / lng / lat
+STOP_COLUMNS = ['subject_age', 'subject_race', 'subject_sex', 'search_conducted', 'frisk_performed',
+                'contraband_found', 'citation_issued', 'warning_issued', 'outcome']
+FLAG_COLUMNS = ['search_conducted', 'frisk_performed', 'contraband_found', 'citation_issued', 'warning_issued']
+
+_lock = threading.Lock()
+
+
+def load_catalog(path=CATALOG_PATH):
+    '''
+    partitions in the store
+    input: catalog path
+    output: dataframe with state, agency, year, path (relative to the store), rows and source per file
+    '''
+    try:
+        with open(path) as f:
+            entries = json.load(f)
+    except (OSError, ValueError):
+        entries = []
+    return pd.DataFrame(entries, columns=['state', 'agency', 'year', 'path', 'rows', 'source'])
+
+
+def _save_catalog(catalog, path=CATALOG_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.part'
+    with open(tmp_path, 'w') as f:
+        json.dump(catalog.to_dict('records'), f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def available(path=CATALOG_PATH):
+    return os.path.exists(path)
+
+
+def _stop_table(chunk):
+    '''
+    partition columns for a chunk of raw stops
+    input: stop dataframe (date_time or date + time columns; lng/lat or wkt geometry)
+    output: dataframe with date_time, hour, lng, lat and STOP_COLUMNS
+    '''
+    import pipeline
+
+    if 'date_time' in chunk.columns:
+        date_time = pd.to_datetime(chunk['date_time'], errors='coerce')
+    else:
+        date_time = pd.to_datetime(chunk['date'].astype(str) + ' ' + chunk['time'].fillna('00:00:00').astype(str),
+                                   errors='coerce')
+    lng, lat = pipeline.stop_coordinates(chunk)
+    table = pd.DataFrame({
+        'date_time': date_time.to_numpy(),
+        'hour': date_time.dt.hour.fillna(-1).astype('int8').to_numpy(),
+        'lng': lng,
+        'lat': lat,
+    })
+    for column in STOP_COLUMNS:
+        values = chunk[column] if column in chunk.columns else pd.Series(None, index=chunk.index, dtype=object)
+        if column in FLAG_COLUMNS:
+            values = values.astype('boolean')
+        elif column == 'subject_age':
+            values = pd.to_numeric(values, errors='coerce')
+        else:
+            values = values.astype(object).where(values.notna(), None)
+        table[column] = values.to_numpy()
+    return table
+
+
+def ingest(chunks, state, agency, source, store_dir=STORE_DIR):
+    '''
+    add raw stops to the store, one file per chunk and year
+    input: iterator of stop dataframes, state code, agency name, source id (e.g. the csv hash)
+    output: number of stops added (0 when that source is already in the catalog)
+    '''
+    catalog_path = os.path.join(store_dir, 'catalog.json')
+    with _lock:
+        catalog = load_catalog(catalog_path)
+        if source in set(catalog['source']):
+            return 0
+        entries = []
+        for n, chunk in enumerate(chunks):
+            table = _stop_table(chunk)
+            years = pd.DatetimeIndex(table['date_time']).year
+            for year in np.unique(years[~np.isnan(years)]).astype(int):
+                part = table[years == year].sort_values('hour', kind='stable')
+                relative = os.path.join(f'state={state}', f'agency={agency}', f'year={year}', f'{source[:16]}-{n:05d}.parquet')
+                path = os.path.join(store_dir, relative)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                pq.write_table(pa.Table.from_pandas(part, preserve_index=False), path + '.part', row_group_size=ROW_GROUP_SIZE)
+                os.replace(path + '.part', path)
+                entries.append({'state': state, 'agency': agency, 'year': int(year), 'path': relative,
+                                'rows': len(part), 'source': source})
+        catalog = pd.concat([catalog, pd.DataFrame(entries, columns=catalog.columns)], ignore_index=True)
+        _save_catalog(catalog, catalog_path)
+    return sum(entry['rows'] for entry in entries)
+
+
+def select(states=None, agencies=None, years=None, catalog=None):
+    '''
+    catalog rows for a selection (None selects everything)
+    input: states, agencies, years, catalog (default: load_catalog())
+    output: dataframe of the matching files
+    '''
+    catalog = load_catalog() if catalog is None else catalog
+    mask = np.ones(len(catalog), dtype=bool)
+    for column, values in (('state', states), ('agency', agencies), ('year', years)):
+        if values is not None:
+            mask &= catalog[column].isin(list(values)).to_numpy()
+    return catalog[mask]
+
+
+def _filter(hours=None, races=None, outcomes=None):
+    expression = None
+    for column, values in (('hour', hours), ('subject_race', races), ('outcome', outcomes)):
+        if values is None:
+            continue
+        values = list(values)
+        present = [value for value in values if value is not None]
+        condition = pc.field(column).isin(present)
+        if len(present) < len(values):
+            condition = condition | pc.field(column).is_null()
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def read(states=None, agencies=None, years=None, columns=None, hours=None, races=None, outcomes=None,
+         store_dir=STORE_DIR):
+    '''
+    stops for a selection, reading only the files, columns and rows needed
+    input: partition selection (states, agencies, years), stop columns to return (default: all),
+           filters pushed down to the reader (hours, subject races, outcomes; None in a list matches missing values)
+    output: stop frame in stoptable's compact layout, with a time_of_day column
+    '''
+    files = select(states, agencies, years, load_catalog(os.path.join(store_dir, 'catalog.json')))
+    columns = STOP_COLUMNS + ['date_time'] if columns is None else [c for c in columns if c in STOP_COLUMNS + ['date_time']]
+    with instrument.stage('catalog_read', files=len(files)) as record:
+        if len(files):
+            dataset = ds.dataset([os.path.join(store_dir, path) for path in files['path']], format='parquet')
+            table = dataset.to_table(columns=['lng', 'lat', 'hour'] + columns, filter=_filter(hours, races, outcomes))
+            frame = table.to_pandas()
+        else:
+            frame = pd.DataFrame(columns=['lng', 'lat', 'hour'] + columns)
+        record['rows'] = len(frame)
+    return stoptable.compact(frame.rename(columns={'hour': 'time_of_day'}))
+
+
+def hour_counts(states=None, agencies=None, years=None, races=None, outcomes=None, store_dir=STORE_DIR):
+    '''
+    stops per hour of the day for a selection, reading only the hour column
+    output: integer array of length 24
+    '''
+    files = select(states, agencies, years, load_catalog(os.path.join(store_dir, 'catalog.json')))
+    if not len(files):
+        return np.zeros(24, dtype='int64')
+    dataset = ds.dataset([os.path.join(store_dir, path) for path in files['path']], format='parquet')
+    hours = dataset.to_table(columns=['hour'], filter=_filter(races=races, outcomes=outcomes))['hour'].to_numpy()
+    return np.bincount(hours[hours >= 0], minlength=24)
+
+
+def distinct(column, states=None, agencies=None, years=None, store_dir=STORE_DIR):
+    '''
+    distinct non-missing values of a stop column (e.g. 'subject_race') in a selection, reading only that column
+    '''
+    files = select(states, agencies, years, load_catalog(os.path.join(store_dir, 'catalog.json')))
+    if not len(files):
+        return []
+    dataset = ds.dataset([os.path.join(store_dir, path) for path in files['path']], format='parquet')
+    values = pc.unique(dataset.to_table(columns=[column])[column]).drop_null()
+    return sorted(values.to_pylist())
+
+
+class HourReader:
+    '''
+    stand-in for hourly.HourPartitions that reads one hour of a selection at a time
+    input: (states, years) selection, stop columns to return
+    '''
+
+    def __init__(self, selection=None, columns=None):
+        self.states, self.years = selection or (None, None)
+        self.columns = columns
+        self.counts = hour_counts(self.states, years=self.years)
+
+    def get(self, hour):
+        return read(self.states, years=self.years, columns=self.columns, hours=[hour])
+
+
+def default_selection(catalog=None):
+    '''
+    selection partition_selector() starts from: the first state and its latest year
+    input: catalog (default: load_catalog())
+    output: (states, years) tuples
+    '''
+    catalog = load_catalog() if catalog is None else catalog
+    states = sorted(catalog['state'].unique())[:1]
+    years = sorted(catalog.loc[catalog['state'].isin(states), 'year'].unique().tolist())[-1:]
+    return tuple(states), tuple(years)
+
+
+def partition_selector():
+    '''
+    sidebar state and year pickers over the catalog
+    input: none
+    output: (states, years) tuples to pass to read() / HourReader
+    '''
+    import streamlit as st
+
+    catalog = load_catalog()
+    default_states, default_years = default_selection(catalog)
+    state_options = sorted(catalog['state'].unique())
+    states = st.sidebar.multiselect('State', state_options, default=default_states)
+    year_options = sorted(catalog.loc[catalog['state'].isin(states), 'year'].unique().tolist())
+    years = st.sidebar.multiselect('Year', year_options, default=[year for year in default_years if year in year_options])
+    selected = select(states, years=years, catalog=catalog)
+    st.sidebar.caption(f"{int(selected['rows'].sum()):,} stops in {len(selected)} files")
+    return tuple(states), tuple(years)
+
+
+def main():
+    import datastore
+    import pipeline
+
+    parser = argparse.ArgumentParser(description='Add a raw stop csv to the partitioned stop store.')
+    parser.add_argument('stops', help='raw stop csv (date_time or date/time columns, lng/lat or wkt geometry)')
+    parser.add_argument('--state', required=True, help='two letter state code, e.g. WA')
+    parser.add_argument('--agency', default='statewide', help='agency name, e.g. statewide or seattle')
+    parser.add_argument('--chunk-size', type=int, default=500_000, help='stops per file')
+    args = parser.parse_args()
+
+    added = ingest(pipeline.read_stop_chunks(args.stops, args.chunk_size), args.state.upper(), args.agency,
+                   datastore.file_hash(args.stops))
+    print('already in the catalog' if added == 0 else f'{added:,} stops added')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import numpy as np
+from branca.element import MacroElement, Template
+
+_HEX = np.array([f'{i:02x}' for i in range(256)])
+
+
+def fill_colors(colormap, values):
+    '''
+    colormap colours for every value at once
+    input: branca LinearColormap, array of values (nan for no data)
+    output: array of '#rrggbbaa' strings, 'transparent' where the value is missing
+    '''
+    values = np.asarray(values, dtype='float64')
+    index = np.asarray(colormap.index, dtype='float64')
+    colors = np.asarray(colormap.colors, dtype='float64')
+    clipped = np.clip(values, index[0], index[-1])
+    # piecewise-linear between the colormap stops, per channel (same result as colormap(x))
+    rgba = np.stack([np.interp(clipped, index, colors[:, j]) for j in range(4)], axis=-1)
+    channels = np.floor(np.nan_to_num(rgba) * 255.9999).astype('int64')
+    hexes = np.char.add('#', _HEX[channels[:, 0]])
+    for j in range(1, 4):
+        hexes = np.char.add(hexes, _HEX[channels[:, j]])
+    return np.where(np.isnan(values), 'transparent', hexes)
+
+
+def tract_geojson(census_gdf, id_column='TractID'):
+    '''
+    serialize tract geometry once, without any demographic columns
+    input: census geodataframe
+    output: geojson string; feature i carries its row position as property i
+    '''
+    shapes = census_gdf[[id_column, 'geometry']].copy()
+    shapes['i'] = np.arange(len(shapes))
+    return shapes.to_json(drop_id=True)
+
+
+class StyledGeoJson(MacroElement):
+    '''
+    tract layer styled from per-tract arrays
+    input: geojson string from tract_geojson(), fill colours and values (one per tract, in row order),
+           name of the variable shown in the popup
+
+    the geometry string is inserted as-is; only the colour and value arrays depend on the variable,
+    so switching variables never re-serializes the tracts.
+    '''
+    _template = Template(u'''
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = (function(){
+                var colors = {{ this.colors|tojson }};
+                var values = {{ this.values|tojson }};
+                var layer = L.geoJson({{ this.geojson }}, {
+                    style: function(feature) {
+                        return {fillColor: colors[feature.properties.i], color: 'black', weight: 1, fillOpacity: 0.4};
+                    },
+                    onEachFeature: function(feature, layer) {
+                        var value = values[feature.properties.i];
+                        layer.bindPopup(
+                            '<div style="background-color: yellow;"><table>'
+                            + '<tr><th>Tract</th><td>' + feature.properties.{{ this.id_column }} + '</td></tr>'
+                            + '<tr><th>' + {{ this.variable|tojson }} + '</th><td>'
+                            + (isNaN(value) ? '' : value.toLocaleString()) + '</td></tr>'
+                            + '</table></div>'
+                        );
+                    }
+                });
+                layer.addTo({{ this._parent.get_name() }});
+                return layer;
+            })();
+        {% endmacro %}''')
+
+    def __init__(self, geojson, colors, values, variable, id_column='TractID'):
+        super().__init__()
+        self._name = 'StyledGeoJson'
+        # embedded raw in a <script>; keep '</' from closing the tag
+        self.geojson = geojson.replace('</', '<\\/')
+        self.colors = np.asarray(colors).tolist()
+        # nan is dumped as the NaN literal, which is valid in the script
+        self.values = np.asarray(values, dtype='float64').tolist()
+        self.variable = variable
+        self.id_column = id_column
+
+
+def choropleth_layer(geojson, census_gdf, variable, colormap):
+    '''
+    choropleth of one demographic variable over the pre-serialized tracts
+    input: geojson string from tract_geojson(), census geodataframe (same row order), variable, colormap
+    output: StyledGeoJson layer
+    '''
+    values = census_gdf[variable].to_numpy(dtype='float64')
+    return StyledGeoJson(geojson, fill_colors(colormap, values), values, variable)
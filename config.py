@@ -0,0 +1,53 @@
+import os
+
+# root of the local data directory (raw csv mirror + columnar cache)
+DATA_DIR = os.environ.get(
+    'STOPSTATS_DATA_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'),
+)
+RAW_DIR = os.path.join(DATA_DIR, 'raw')
+CACHE_DIR = os.path.join(DATA_DIR, 'cache')
+# content-addressed results shared by every app process on the host (sharedcache.py), and its size bound
+# in megabytes (0 turns it off)
+SHARED_CACHE_DIR = os.path.join(CACHE_DIR, 'shared')
+SHARED_CACHE_MB = float(os.environ.get('STOPSTATS_SHARED_CACHE_MB', 1024))
+# seconds the mirror of a remote source is used before the server is asked whether it changed (fetch.py)
+REVALIDATE_AFTER = float(os.environ.get('STOPSTATS_REVALIDATE_AFTER', 24 * 3600))
+# where the map pages get their stops: 'memory' (shared dataframes), 'sqlite' (database.py queries)
+# or 'partitioned' (the state / agency / year store in catalog.py)
+BACKEND = os.environ.get('STOPSTATS_BACKEND', 'memory')
+
+
+def drive_url(share_url):
+    '''
+    turn a google drive share link into a direct download link
+    input: share url (https://drive.google.com/file/d/<id>/view?usp=sharing)
+    output: download url
+    '''
+    return 'https://drive.google.com/uc?id=' + share_url.split('/')[-2]
+
+
+# source csvs for every dataset the pages use
+SOURCES = {
+    'census': drive_url('https://drive.google.com/file/d/1kt7EPrEK5T22ryGcmanxRY67AIr9Gyjq/view?usp=sharing'),
+    'stops': drive_url('https://drive.google.com/file/d/1nK5givbyegb7w9rSNLbEr-hdmXxKEnFb/view?usp=sharing'),
+    'tracts': drive_url('https://drive.google.com/file/d/1PHSheaSfnMgZ03j76hSf9DU8lUjDZ3ka/view?usp=sharing'),
+}
+
+
+def local_source(name):
+    '''
+    find a local csv for a dataset, if there is one
+    input: dataset name
+    output: path to the csv, or None
+
+    STOPSTATS_<NAME>_CSV (e.g. STOPSTATS_STOPS_CSV) takes precedence over data/raw/<name>.csv. a csv
+    fetch.py mirrored there (it has a <name>.csv.meta.json beside it) is not a local csv.
+    '''
+    path = os.environ.get('STOPSTATS_' + name.upper() + '_CSV')
+    if path:
+        return path
+    path = os.path.join(RAW_DIR, name + '.csv')
+    if os.path.exists(path) and not os.path.exists(path + '.meta.json'):
+        return path
+    return None
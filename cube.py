@@ -0,0 +1,198 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import config
+import sharedcache
+from aggregates import RACE_LABELS
+
+CUBE_DIR = os.path.join(config.CACHE_DIR, 'cube')
+
+DAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+OUTCOMES = ['citation', 'warning', 'arrest', 'other']
+
+# cube axes, in order, with their labels (tract labels are the tract ids)
+AXES = ['tract', 'hour', 'dow', 'month', 'race', 'outcome']
+LABELS = {
+    'hour': list(range(24)),
+    'dow': DAYS,
+    'month': MONTHS,
+    'race': RACE_LABELS,
+    'outcome': OUTCOMES,
+}
+# rollups kept per cube
+MAX_ROLLUPS = 64
+
+
+def _fit_dtype(max_count):
+    # smallest unsigned type holding every cell; most cells of a fine-grained cube are tiny
+    for dtype in ('uint8', 'uint16', 'uint32'):
+        if max_count <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype('uint64')
+
+
+def outcome_codes(outcome):
+    '''
+    index into OUTCOMES for each stop
+    input: outcome series
+    output: integer array (anything unlisted or missing is 'other')
+    '''
+    lookup = {value: i for i, value in enumerate(OUTCOMES)}
+    other = OUTCOMES.index('other')
+    codes, uniques = pd.factorize(outcome)
+    mapped = np.array([lookup.get(value, other) for value in uniques] + [other], dtype='int64')
+    return mapped[codes]
+
+
+class TemporalCube:
+    '''
+    dense stop counts by tract x hour x day of week x month x race x outcome
+    input: tract ids, counts array (n_tracts, 24, 7, 12, races, outcomes; unsigned, as small as the counts allow)
+
+    counts are additive, so batches of stops are added with add(). rollup() sums the cube down to the
+    axes a view needs; results are memoized, so a view that has been drawn once is a dictionary lookup.
+    '''
+
+    def __init__(self, tract_ids, counts=None):
+        self.tract_ids = np.asarray(tract_ids)
+        shape = (len(self.tract_ids),) + tuple(len(LABELS[axis]) for axis in AXES[1:])
+        self.counts = np.zeros(shape, dtype='uint8') if counts is None else counts
+        self._tract_index = {tract_id: i for i, tract_id in enumerate(self.tract_ids.tolist())}
+        self._rollups = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, tract, date_time, race, outcome):
+        '''
+        count a batch of stops
+        input: tract index per stop (-1 outside every tract), stop timestamps, race codes (RACE_LABELS
+               index), outcome codes (OUTCOMES index)
+        output: none
+        '''
+        date_time = pd.DatetimeIndex(date_time)
+        keep = (tract >= 0) & ~date_time.isna()
+        index = np.ravel_multi_index(
+            (tract[keep], date_time.hour[keep], date_time.dayofweek[keep], date_time.month[keep] - 1,
+             race[keep], outcome[keep]),
+            self.counts.shape)
+        # only the cells the batch touches are updated, widening the counts' type if one would overflow
+        cells, n = np.unique(index, return_counts=True)
+        flat = self.counts.reshape(-1)
+        total = flat[cells].astype('uint64') + n
+        dtype = _fit_dtype(total.max() if len(total) else 0)
+        if dtype.itemsize > self.counts.dtype.itemsize:
+            self.counts = self.counts.astype(dtype)
+            flat = self.counts.reshape(-1)
+        flat[cells] = total
+        with self._lock:
+            self._rollups.clear()
+
+    def rollup(self, keep=('hour', 'dow'), tracts=None, **filters):
+        '''
+        counts summed over every axis not kept
+        input: axes to keep (in cube order), tract ids to include, and per axis a list of labels to include
+               (e.g. race=['Black'], dow=['Sat', 'Sun'], hour=range(18, 24))
+        output: array with one dimension per kept axis
+        '''
+        key = (tuple(keep), None if tracts is None else tuple(tracts),
+               tuple(sorted((axis, tuple(values)) for axis, values in filters.items() if values is not None)))
+        with self._lock:
+            if key in self._rollups:
+                self._rollups.move_to_end(key)
+                return self._rollups[key]
+        counts = self.counts
+        if tracts is not None:
+            counts = counts.take([self._tract_index[tract] for tract in tracts if tract in self._tract_index], axis=0)
+        for axis, values in filters.items():
+            if values is not None:
+                labels = LABELS[axis]
+                counts = counts.take([labels.index(value) for value in values], axis=AXES.index(axis))
+        result = counts.sum(axis=tuple(i for i, axis in enumerate(AXES) if axis not in keep), dtype='int64')
+        result.setflags(write=False)
+        with self._lock:
+            self._rollups[key] = result
+            while len(self._rollups) > MAX_ROLLUPS:
+                self._rollups.popitem(last=False)
+        return result
+
+    def frame(self, keep=('hour', 'dow'), tracts=None, **filters):
+        '''
+        two-axis rollup as a labelled dataframe
+        input: as rollup(), with exactly two axes kept
+        output: dataframe indexed by the first axis, one column per label of the second
+        '''
+        rows, columns = keep
+        labels = {'tract': self.tract_ids.tolist() if tracts is None else [t for t in tracts if t in self._tract_index],
+                  **LABELS, **{axis: list(values) for axis, values in filters.items() if values is not None}}
+        return pd.DataFrame(self.rollup(keep, tracts, **filters), index=labels[rows], columns=labels[columns])
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = sharedcache.tmp_path(path) + '.npz'
+        np.savez_compressed(tmp_path, tract_ids=self.tract_ids, counts=self.counts)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f['tract_ids'], f['counts'])
+
+
+def build_cube(stop_gdf, census_gdf, chunk_size=1_000_000):
+    '''
+    cube for a stop dataset
+    input: stop frame (see stoptable) with date_time, subject_race and outcome, census geodataframe
+    output: TemporalCube
+    '''
+    import shapely
+
+    import pipeline
+    import stoptable
+
+    cube = TemporalCube(census_gdf['TractID'].to_numpy())
+    tree = shapely.STRtree(census_gdf.geometry.values)
+    for start in range(0, len(stop_gdf), chunk_size):
+        chunk = stop_gdf.iloc[start:start + chunk_size]
+        tract = pipeline.assign_tracts(*stoptable.coordinates(chunk), tree)
+        cube.add(tract, chunk['date_time'], pipeline.race_codes(chunk['subject_race']), outcome_codes(chunk['outcome']))
+    return cube
+
+
+def shared_cube(selection=None):
+    '''
+    cube over the shared stop dataset (or a selection of the partitioned store), cached on disk and keyed
+    by the files it was built from
+    input: (states, years) selection of the partitioned store, None for the shared stop dataset
+    output: TemporalCube
+    '''
+    import datastore
+    import shared_data
+
+    census_key = os.path.splitext(os.path.basename(datastore.parquet_path('census')))[0]
+    if selection is None:
+        stops_key = os.path.splitext(os.path.basename(datastore.parquet_path('stops')))[0]
+    else:
+        import catalog
+
+        states, years = selection
+        files = catalog.select(states, years=years)
+        stops_key = hashlib.sha256('\n'.join(sorted(files['path'])).encode()).hexdigest()[:16]
+    path = os.path.join(CUBE_DIR, f'{census_key}_{stops_key}.npz')
+    # one process on the host builds each cube; the others wait and load it
+    with sharedcache.file_lock(path + '.lock'):
+        try:
+            return TemporalCube.load(path)
+        except OSError:
+            pass
+        if selection is None:
+            stop_gdf = shared_data.get('stops')
+        else:
+            stop_gdf = catalog.read(states, years=years, columns=['date_time', 'subject_race', 'outcome'])
+        cube = build_cube(stop_gdf, shared_data.get('census'))
+        cube.save(path)
+    return cube
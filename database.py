@@ -0,0 +1,326 @@
+'''
+embedded sqlite database implementing the TrafficStops / CensusTracts / HappenIn schema
+
+    TrafficStops(StopID, DateTime, Hour, Latitude, Longitude, SubjectAge, SubjectRace, SubjectSex, SearchConducted,
+                 FriskPerformed, ContrabandFound, CitationIssued, WarningIssued, Outcome)
+    CensusTracts(TractID, <census attributes>, Geometry)
+    HappenIn(StopID, TractID)
+
+the database is built from the cached parquet datasets (stops are streamed in batches) and rebuilt whenever
+they change. HappenIn is filled with an STRtree point-in-polygon join while building, so queries never need
+spatial sql. pages ask for filtered / aggregated results and only those rows are materialized.
+'''
+import os
+import sqlite3
+import threading
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import shapely
+
+import config
+import instrument
+import sharedcache
+import stoptable
+
+DB_PATH = os.path.join(config.CACHE_DIR, 'stopstats.sqlite')
+
+# TrafficStops column -> stop dataframe column the pages use
+STOP_COLUMNS = {
+    'DateTime': 'date_time',
+    'SubjectAge': 'subject_age',
+    'SubjectRace': 'subject_race',
+    'SubjectSex': 'subject_sex',
+    'SearchConducted': 'search_conducted',
+    'FriskPerformed': 'frisk_performed',
+    'ContrabandFound': 'contraband_found',
+    'CitationIssued': 'citation_issued',
+    'WarningIssued': 'warning_issued',
+    'Outcome': 'outcome',
+}
+FLAG_COLUMNS = ['SearchConducted', 'FriskPerformed', 'ContrabandFound', 'CitationIssued', 'WarningIssued']
+
+SCHEMA = '''
+CREATE TABLE Meta (Key TEXT PRIMARY KEY, Value TEXT);
+CREATE TABLE TrafficStops (
+    StopID INTEGER PRIMARY KEY,
+    DateTime TEXT,
+    Hour INTEGER,
+    Latitude REAL,
+    Longitude REAL,
+    SubjectAge REAL,
+    SubjectRace TEXT,
+    SubjectSex TEXT,
+    SearchConducted INTEGER,
+    FriskPerformed INTEGER,
+    ContrabandFound INTEGER,
+    CitationIssued INTEGER,
+    WarningIssued INTEGER,
+    Outcome TEXT
+);
+CREATE TABLE HappenIn (
+    StopID INTEGER PRIMARY KEY REFERENCES TrafficStops (StopID),
+    TractID INTEGER NOT NULL REFERENCES CensusTracts (TractID)
+);
+'''
+INDEXES = '''
+CREATE INDEX TrafficStopsDateTime ON TrafficStops (DateTime);
+CREATE INDEX TrafficStopsHour ON TrafficStops (Hour);
+CREATE INDEX TrafficStopsSubjectRace ON TrafficStops (SubjectRace);
+CREATE INDEX HappenInTractID ON HappenIn (TractID);
+'''
+
+_build_lock = threading.Lock()
+_ready = set()
+_local = threading.local()
+
+
+def source_key():
+    '''
+    identity of the data the database is built from
+    input: none
+    output: string that changes whenever the census or stop source changes
+    '''
+    import datastore
+
+    return '_'.join(os.path.splitext(os.path.basename(datastore.parquet_path(name)))[0]
+                    for name in ('census', 'stops'))
+
+
+def _sql_type(dtype):
+    if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_integer_dtype(dtype):
+        return 'INTEGER'
+    if pd.api.types.is_float_dtype(dtype):
+        return 'REAL'
+    return 'TEXT'
+
+
+def _write_tracts(connection, census_gdf, id_column='TractID'):
+    attributes = census_gdf.drop(columns=[id_column, census_gdf.geometry.name])
+    columns = ', '.join(f'"{column}" {_sql_type(dtype)}' for column, dtype in attributes.dtypes.items())
+    connection.execute(f'CREATE TABLE CensusTracts (TractID INTEGER PRIMARY KEY, {columns}, Geometry BLOB)')
+    rows = pd.DataFrame({'TractID': census_gdf[id_column].to_numpy()})
+    rows = pd.concat([rows, attributes.reset_index(drop=True)], axis=1)
+    rows['Geometry'] = shapely.to_wkb(census_gdf.geometry.values)
+    placeholders = ', '.join('?' * len(rows.columns))
+    connection.executemany(f'INSERT INTO CensusTracts VALUES ({placeholders})',
+                           rows.astype(object).where(rows.notna(), None).itertuples(index=False, name=None))
+
+
+def _stop_rows(batch, first_id):
+    '''
+    TrafficStops rows for one parquet batch of stops
+    input: stop dataframe (see stoptable), StopID of its first row
+    output: dataframe in TrafficStops column order
+    '''
+    lng, lat = stoptable.coordinates(batch)
+    date_time = pd.to_datetime(batch['date_time'])
+    rows = pd.DataFrame({
+        'StopID': np.arange(first_id, first_id + len(batch)),
+        'DateTime': date_time.dt.strftime('%Y-%m-%d %H:%M:%S'),
+        'Hour': date_time.dt.hour,
+        'Latitude': lat,
+        'Longitude': lng,
+    })
+    for column, source in STOP_COLUMNS.items():
+        if column == 'DateTime':
+            continue
+        values = batch[source] if source in batch.columns else pd.Series(None, index=batch.index, dtype=object)
+        if column in FLAG_COLUMNS:
+            values = values.astype('boolean').astype('Int64')
+        rows[column] = values.to_numpy()
+    return rows
+
+
+def build(path=DB_PATH, batch_size=200_000):
+    '''
+    build the database from the cached census and stop datasets
+    input: database path, stops per batch
+    output: path
+    '''
+    import datastore
+    import pipeline
+
+    key = source_key()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = sharedcache.tmp_path(path)
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    connection = sqlite3.connect(tmp_path)
+    try:
+        connection.executescript('PRAGMA journal_mode = OFF; PRAGMA synchronous = OFF;' + SCHEMA)
+        census_gdf = datastore.load('census')
+        with instrument.stage('db_tracts'):
+            _write_tracts(connection, census_gdf)
+        tree = shapely.STRtree(census_gdf.geometry.values)
+        tract_ids = census_gdf['TractID'].to_numpy()
+
+        stop_id = 0
+        stops = pq.ParquetFile(datastore.parquet_path('stops'))
+        for record_batch in stops.iter_batches(batch_size=batch_size):
+            with instrument.stage('db_stops'):
+                rows = _stop_rows(record_batch.to_pandas(), stop_id)
+                placeholders = ', '.join('?' * len(rows.columns))
+                connection.executemany(f'INSERT INTO TrafficStops VALUES ({placeholders})',
+                                       rows.astype(object).where(rows.notna(), None).itertuples(index=False, name=None))
+                tract = pipeline.assign_tracts(rows['Longitude'].to_numpy(), rows['Latitude'].to_numpy(), tree)
+                inside = tract >= 0
+                connection.executemany('INSERT INTO HappenIn VALUES (?, ?)',
+                                       zip(rows['StopID'].to_numpy()[inside].tolist(), tract_ids[tract[inside]].tolist()))
+            stop_id += len(rows)
+        with instrument.stage('db_indexes'):
+            connection.executescript(INDEXES + 'ANALYZE;')
+        connection.execute('INSERT INTO Meta VALUES (?, ?)', ('source', key))
+        connection.commit()
+    finally:
+        connection.close()
+    os.replace(tmp_path, path)
+    return path
+
+
+def _built_key(path):
+    if not os.path.exists(path):
+        return None
+    try:
+        connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    except sqlite3.Error:
+        return None
+    try:
+        row = connection.execute("SELECT Value FROM Meta WHERE Key = 'source'").fetchone()
+        return row[0] if row else None
+    except sqlite3.Error:
+        return None
+    finally:
+        connection.close()
+
+
+def ensure(path=DB_PATH):
+    '''
+    database path, building or rebuilding it if the source data changed
+    input: database path
+    output: path
+
+    checked once per process, like the datasets shared_data keeps in memory.
+    '''
+    if path in _ready:
+        return path
+    # one process on the host builds; the others wait for it and find the database current
+    with _build_lock, sharedcache.file_lock(path + '.lock'):
+        if path not in _ready:
+            if _built_key(path) != source_key():
+                with instrument.stage('db_build'):
+                    build(path)
+            _ready.add(path)
+    return path
+
+
+def connect(path=DB_PATH):
+    '''
+    read-only connection for this thread
+    input: database path
+    output: sqlite3 connection
+    '''
+    connections = _local.__dict__.setdefault('connections', {})
+    if path not in connections:
+        connections[path] = sqlite3.connect(f'file:{ensure(path)}?mode=ro', uri=True)
+    return connections[path]
+
+
+def _filters(hour=None, races=None, outcomes=None, tracts=None):
+    '''
+    where clause and parameters for the common stop filters
+    input: hour (0-23), subject races, outcomes, tract ids (None in a list matches missing values)
+    output: sql fragment (empty or starting with WHERE), parameter list
+    '''
+    clauses, params = [], []
+    if hour is not None:
+        clauses.append('s.Hour = ?')
+        params.append(int(hour))
+    for column, values in (('s.SubjectRace', races), ('s.Outcome', outcomes), ('h.TractID', tracts)):
+        if values is None:
+            continue
+        values = list(values)
+        present = [value for value in values if value is not None]
+        options = []
+        if present:
+            options.append(f"{column} IN ({', '.join('?' * len(present))})")
+            params.extend(present)
+        if len(present) < len(values):
+            options.append(f'{column} IS NULL')
+        clauses.append('(' + (' OR '.join(options) or '0') + ')')
+    return ('WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+
+def stop_frame(columns=None, hour=None, races=None, outcomes=None, tracts=None):
+    '''
+    stops matching the filters, in the layout of the stop dataset
+    input: stop dataframe columns to return (default: all), filters as in _filters()
+    output: stop frame in stoptable's compact layout, with a time_of_day column
+    '''
+    names = {source: column for column, source in STOP_COLUMNS.items()}
+    columns = list(STOP_COLUMNS.values()) if columns is None else [column for column in columns if column in names]
+    where, params = _filters(hour, races, outcomes, tracts)
+    join = 'LEFT JOIN HappenIn h ON h.StopID = s.StopID' if tracts is not None else ''
+    select = ', '.join(['s.Longitude', 's.Latitude', 's.Hour'] + [f's.{names[column]}' for column in columns])
+    with instrument.stage('db_query') as record:
+        frame = pd.read_sql_query(f'SELECT {select} FROM TrafficStops s {join} {where} ORDER BY s.StopID',
+                                  connect(), params=params)
+        record['rows'] = len(frame)
+    frame.columns = ['lng', 'lat', 'time_of_day'] + columns
+    return stoptable.compact(frame)
+
+
+def tract_counts(hour=None, races=None, outcomes=None):
+    '''
+    number of stops in every tract
+    input: filters as in _filters()
+    output: series indexed by TractID (tracts without stops are left out)
+    '''
+    where, params = _filters(hour, races, outcomes)
+    with instrument.stage('db_query'):
+        frame = pd.read_sql_query(f'SELECT h.TractID, COUNT(*) AS NumStops FROM HappenIn h '
+                                  f'JOIN TrafficStops s ON s.StopID = h.StopID {where} GROUP BY h.TractID',
+                                  connect(), params=params)
+    return frame.set_index('TractID')['NumStops']
+
+
+def hour_counts(races=None, outcomes=None):
+    '''
+    number of stops in every hour of the day
+    input: filters as in _filters()
+    output: integer array of length 24
+    '''
+    where, params = _filters(races=races, outcomes=outcomes)
+    rows = connect().execute(f'SELECT s.Hour, COUNT(*) FROM TrafficStops s {where} GROUP BY s.Hour', params).fetchall()
+    counts = np.zeros(24, dtype='int64')
+    for hour, count in rows:
+        if hour is not None:
+            counts[hour] = count
+    return counts
+
+
+def distinct(column):
+    '''
+    distinct values of a TrafficStops column (e.g. 'SubjectRace'), missing values last
+    '''
+    if column not in STOP_COLUMNS:
+        raise KeyError(column)
+    rows = connect().execute(f'SELECT DISTINCT {column} FROM TrafficStops ORDER BY {column} IS NULL, {column}').fetchall()
+    return [row[0] for row in rows]
+
+
+class HourQuery:
+    '''
+    stand-in for hourly.HourPartitions that queries one hour at a time
+    input: stop dataframe columns to return, other filters as in _filters()
+    '''
+
+    def __init__(self, columns=None, races=None, outcomes=None):
+        self.columns = columns
+        self.races = races
+        self.outcomes = outcomes
+        self.counts = hour_counts(races, outcomes)
+
+    def get(self, hour):
+        return stop_frame(self.columns, hour=hour, races=self.races, outcomes=self.outcomes)
@@ -0,0 +1,155 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import geopandas as gpd
+import pandas as pd
+
+import config
+import fetch
+import instrument
+import sharedcache
+
+LOGGER = logging.getLogger('stopstats.datastore')
+
+# how each source csv is typed when it is turned into parquet; 'compact' datasets are stored in
+# stoptable's layout (lng/lat floats instead of geometry), and 'version' changes with the stored layout
+DATASETS = {
+    'census': {'geometry': True, 'parse_dates': []},
+    'stops': {'geometry': False, 'compact': True, 'parse_dates': ['date_time'], 'version': 2},
+    'tracts': {'geometry': False, 'parse_dates': []},
+}
+
+
+def file_hash(path, block_size=1 << 20):
+    '''
+    sha256 of a file's contents
+    input: path
+    output: hex digest
+    '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _manifest_path(name):
+    return os.path.join(config.CACHE_DIR, name + '.json')
+
+
+def _parquet_path(name, digest):
+    version = DATASETS[name].get('version', 1)
+    suffix = f'-v{version}' if version > 1 else ''
+    return os.path.join(config.CACHE_DIR, f'{name}-{digest[:16]}{suffix}.parquet')
+
+
+def _cached_parquet(name):
+    # parquet built from the last csv we saw for this dataset, if it is still on disk
+    try:
+        with open(_manifest_path(name)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    path = _parquet_path(name, manifest['sha256'])
+    return path if os.path.exists(path) else None
+
+
+def build(name, csv_path, digest=None):
+    '''
+    convert a source csv into a typed parquet file keyed by the csv's content hash
+    input: dataset name, path to csv, its sha256 if already known (e.g. from the fetch mirror)
+    output: path to parquet file
+    '''
+    spec = DATASETS[name]
+    if digest is None:
+        with instrument.stage('hash_csv', dataset=name):
+            digest = file_hash(csv_path)
+    path = _parquet_path(name, digest)
+    if not os.path.exists(path):
+        with instrument.stage('read_csv', dataset=name):
+            df = pd.read_csv(csv_path, parse_dates=spec['parse_dates'])
+        os.makedirs(config.CACHE_DIR, exist_ok=True)
+        tmp_path = sharedcache.tmp_path(path)
+        if spec['geometry']:
+            # vectorized wkt parse, stored as wkb (geoparquet)
+            with instrument.stage('parse_wkt', dataset=name):
+                geometry = gpd.GeoSeries.from_wkt(df.pop('geometry'), crs='EPSG:4326')
+            with instrument.stage('write_parquet', dataset=name):
+                gpd.GeoDataFrame(df, geometry=geometry).to_parquet(tmp_path, index=False)
+        else:
+            if spec.get('compact'):
+                import stoptable
+
+                with instrument.stage('compact', dataset=name):
+                    df = stoptable.compact(df)
+            with instrument.stage('write_parquet', dataset=name):
+                df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+    manifest_path = _manifest_path(name)
+    tmp_path = sharedcache.tmp_path(manifest_path)
+    with open(tmp_path, 'w') as f:
+        json.dump({'sha256': digest, 'source': csv_path}, f)
+    os.replace(tmp_path, manifest_path)
+    return path
+
+
+def parquet_path(name):
+    '''
+    locate (building if needed) the parquet file for a dataset
+    input: dataset name
+    output: path to parquet file
+
+    a local csv wins; otherwise the remote csv's mirror is used (see fetch.py: revalidated at most every
+    config.REVALIDATE_AFTER seconds, so a rebuild only follows a change at the source). when the source
+    can be neither fetched nor found in the mirror, the last built parquet is reused. app processes
+    sharing the data directory take turns, so one builds while the others wait and then reuse its files.
+    '''
+    with sharedcache.file_lock(os.path.join(config.CACHE_DIR, name + '.lock')):
+        csv_path, digest = config.local_source(name), None
+        if csv_path is None:
+            try:
+                csv_path, digest = fetch.fetch(name)
+            except fetch.TRANSIENT + (fetch.SourceError,) as error:
+                path = _cached_parquet(name)
+                if path is None:
+                    raise
+                LOGGER.warning('%s: source unavailable (%r); using the last built %s', name, error, path)
+                return path
+        return build(name, csv_path, digest)
+
+
+_prepared = {}
+_prepared_lock = threading.Lock()
+
+
+def prepare(*names):
+    '''
+    locate (fetching and building if needed) the parquet files of several datasets at once, so their
+    downloads and builds overlap instead of running one after another; once per process
+    input: dataset names
+    output: dict of name -> path to parquet file
+    '''
+    missing = [name for name in dict.fromkeys(names) if name not in _prepared]
+    if missing:
+        with ThreadPoolExecutor(len(missing)) as executor:
+            paths = dict(zip(missing, executor.map(parquet_path, missing)))
+        with _prepared_lock:
+            _prepared.update(paths)
+    return {name: _prepared[name] for name in names}
+
+
+def load(name):
+    '''
+    load a dataset from the columnar cache
+    input: dataset name ('census', 'stops' or 'tracts')
+    output: geodataframe for geometry datasets, dataframe otherwise
+    '''
+    path = parquet_path(name)
+    with instrument.stage('read_parquet', dataset=name):
+        if DATASETS[name]['geometry']:
+            return gpd.read_parquet(path)
+        return pd.read_parquet(path)
@@ -0,0 +1,257 @@
+'''
+disparity tests with bootstrap confidence intervals
+
+    hit_rates()          outcome test: share of searches that found contraband, by race (and group)
+    veil_of_darkness()   are minority drivers a smaller share of stops after dark, at the same clock time?
+    slope_interval()     ols gradient with a pairs bootstrap interval (the race plot's trendlines)
+
+replicates are drawn in batches; every batch is one vectorized draw (binomial / multinomial counts or a
+matrix of resampling weights) rather than a python loop per replicate, and batches run on a process pool
+when there is more than one. batch seeds come from one SeedSequence, so results do not depend on the
+number of workers.
+
+the pool is created once per process and reused by every call. its workers are started by a forkserver
+(or spawned, where there is none), never forked from the caller: the app server runs many threads, and a
+fork taken while one of them holds a lock can deadlock the child.
+'''
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import pandas as pd
+
+from aggregates import RACE_LABELS
+
+# replicates drawn per batch (one vectorized draw, one pool task)
+BATCH_SIZE = 500
+# zenith of the sun at civil dusk, and at sunset (refraction and the solar disc included)
+DUSK_ZENITH = 96.0
+SUNSET_ZENITH = 90.833
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _shared_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _pool = ProcessPoolExecutor(os.cpu_count() or 1, mp_context=multiprocessing.get_context(method))
+        return _pool
+
+
+def _replicate_batch(args):
+    replicate, data, size, seed = args
+    return replicate(data, np.random.default_rng(seed), size)
+
+
+def replicates(replicate, data, n, seed=0, workers=1):
+    '''
+    draw replicate statistics in seeded batches, on the shared process pool when there is more than one batch
+    input: replicate(data, rng, size) -> (size, k) array of replicate statistics (a module level function,
+           so it can be sent to a worker), its data, number of replicates, seed, processes (1 draws in this
+           process; anything else, or None, uses the shared pool of one process per core)
+    output: (n, k) array
+    '''
+    global _pool
+    sizes = [min(BATCH_SIZE, n - start) for start in range(0, n, BATCH_SIZE)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks = [(replicate, data, size, batch_seed) for size, batch_seed in zip(sizes, seeds)]
+    if workers != 1 and len(tasks) > 1 and (os.cpu_count() or 1) > 1:
+        pool = _shared_pool()
+        try:
+            return np.concatenate(list(pool.map(_replicate_batch, tasks)))
+        except BrokenProcessPool:
+            # a worker died (e.g. killed for memory); start a new pool next time and draw these here
+            with _pool_lock:
+                if _pool is pool:
+                    _pool = None
+    return np.concatenate([_replicate_batch(task) for task in tasks])
+
+
+def bootstrap(replicate, data, n_boot=1000, level=0.95, seed=0, workers=1):
+    '''
+    percentile bootstrap interval
+    input: replicate function and its data (see replicates()), number of replicates, interval level, seed,
+           processes (None for every core)
+    output: (low, high) arrays of length k
+    '''
+    draws = replicates(replicate, data, n_boot, seed, workers)
+    alpha = (1 - level) / 2
+    with np.errstate(invalid='ignore'):
+        low, high = np.nanquantile(draws, [alpha, 1 - alpha], axis=0)
+    return low, high
+
+
+def _rate_replicates(data, rng, size):
+    # resampling the searches within each cell: the number of hits is binomial
+    searched, hits = data
+    rate = np.divide(hits, searched, out=np.zeros(len(searched)), where=searched > 0)
+    draws = rng.binomial(searched, rate, size=(size, len(searched)))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return draws / searched
+
+
+def hit_rates(searched, contraband, race, group=None, n_boot=1000, level=0.95, seed=0, workers=1):
+    '''
+    outcome test: contraband hit rate of searches by race, optionally within groups (tract, county, agency)
+    input: search_conducted and contraband_found flags, race codes (RACE_LABELS index, see
+           pipeline.race_codes), group label per stop (None for one group), bootstrap settings
+    output: dataframe with group, race, searches, hits, hit_rate, low, high (cells without searches are dropped)
+
+    a lower hit rate for one race suggests officers search that race on weaker evidence.
+    '''
+    # missing flags count as not searched / nothing found
+    searched = pd.Series(searched).fillna(False).to_numpy(dtype=bool)
+    found = searched & pd.Series(contraband).fillna(False).to_numpy(dtype=bool)
+    if group is None:
+        group_codes, groups = np.zeros(len(searched), dtype='int64'), pd.Index(['All'])
+    else:
+        group_codes, groups = pd.factorize(np.asarray(group), sort=True)
+    n_races = len(RACE_LABELS)
+    keep = group_codes >= 0
+    cell = group_codes[keep] * n_races + np.asarray(race)[keep]
+    size = len(groups) * n_races
+    n_searched = np.bincount(cell, weights=searched[keep], minlength=size).astype('int64')
+    n_hits = np.bincount(cell, weights=found[keep], minlength=size).astype('int64')
+    low, high = bootstrap(_rate_replicates, (n_searched, n_hits), n_boot, level, seed, workers)
+    frame = pd.DataFrame({
+        'group': np.repeat(np.asarray(groups), n_races),
+        'race': np.tile(RACE_LABELS, len(groups)),
+        'searches': n_searched,
+        'hits': n_hits,
+        'hit_rate': np.divide(n_hits, n_searched, out=np.full(size, np.nan), where=n_searched > 0),
+        'low': low,
+        'high': high,
+    })
+    return frame[frame['searches'] > 0].reset_index(drop=True)
+
+
+def _slope_replicates(data, rng, size):
+    # pairs bootstrap: each replicate reweights the points by how often they were drawn
+    x, y = data
+    n = len(x)
+    weights = rng.multinomial(n, np.full(n, 1 / n), size=size).astype('float64')
+    sw, sx, sy = weights.sum(axis=1), weights @ x, weights @ y
+    sxx, sxy = weights @ (x * x), weights @ (x * y)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return ((sw * sxy - sx * sy) / (sw * sxx - sx ** 2))[:, None]
+
+
+def slope_interval(x, y, n_boot=1000, level=0.95, seed=0, workers=1):
+    '''
+    ols gradient of y on x with a pairs bootstrap interval
+    input: x and y arrays (rows where either is missing are dropped), bootstrap settings
+    output: dict with slope, low, high and n
+    '''
+    x, y = np.asarray(x, dtype='float64'), np.asarray(y, dtype='float64')
+    present = ~(np.isnan(x) | np.isnan(y))
+    # centred, to keep the sums well conditioned (the slope is unchanged)
+    x, y = x[present] - x[present].mean(), y[present] - y[present].mean()
+    slope = float((x * y).sum() / (x * x).sum()) if len(x) > 1 else float('nan')
+    low, high = bootstrap(_slope_replicates, (x, y), n_boot, level, seed, workers)
+    return {'slope': slope, 'low': float(low[0]), 'high': float(high[0]), 'n': int(len(x))}
+
+
+def sun_times(date_time, lng, lat, zenith=DUSK_ZENITH, timezone='America/Los_Angeles'):
+    '''
+    local clock time at which the sun sets to a given zenith (NOAA's approximate solar position)
+    input: stop timestamps (local, naive), longitude and latitude arrays, zenith in degrees, time zone of the
+           timestamps
+    output: minutes after local midnight (nan where the sun never reaches that zenith)
+    '''
+    date_time = pd.DatetimeIndex(date_time)
+    gamma = 2 * np.pi / 365 * (date_time.dayofyear.to_numpy() - 1)
+    equation_of_time = 229.18 * (0.000075 + 0.001868 * np.cos(gamma) - 0.032077 * np.sin(gamma)
+                                 - 0.014615 * np.cos(2 * gamma) - 0.040849 * np.sin(2 * gamma))
+    declination = (0.006918 - 0.399912 * np.cos(gamma) + 0.070257 * np.sin(gamma) - 0.006758 * np.cos(2 * gamma)
+                   + 0.000907 * np.sin(2 * gamma) - 0.002697 * np.cos(3 * gamma) + 0.00148 * np.sin(3 * gamma))
+    lat = np.radians(np.asarray(lat, dtype='float64'))
+    with np.errstate(invalid='ignore'):
+        hour_angle = np.degrees(np.arccos(np.cos(np.radians(zenith)) / (np.cos(lat) * np.cos(declination))
+                                          - np.tan(lat) * np.tan(declination)))
+    utc_minutes = 720 - 4 * (np.asarray(lng, dtype='float64') - hour_angle) - equation_of_time
+    return utc_minutes + utc_offset_minutes(date_time, timezone)
+
+
+def utc_offset_minutes(date_time, timezone='America/Los_Angeles'):
+    '''
+    offset of local clock time from utc on each stop's date (daylight saving included)
+    input: timestamps, time zone
+    output: float array of minutes
+    '''
+    # noon is never skipped or repeated by a daylight saving change
+    noon = pd.DatetimeIndex(date_time).normalize() + pd.Timedelta(hours=12)
+    local = noon.tz_localize(timezone)
+    return ((local.tz_localize(None) - local.tz_convert('UTC').tz_localize(None)) / pd.Timedelta(minutes=1)).to_numpy()
+
+
+def _mantel_haenszel(table):
+    # common odds ratio over clock-time strata; table [..., stratum, dark, minority]
+    a, b = table[..., 1, 1], table[..., 1, 0]
+    c, d = table[..., 0, 1], table[..., 0, 0]
+    n = table.sum(axis=(-2, -1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        n = np.where(n > 0, n, np.nan)
+        return np.nansum(a * d / n, axis=-1) / np.nansum(b * c / n, axis=-1)
+
+
+def _darkness_replicates(data, rng, size):
+    # resampling stops is a multinomial draw over the cells of the stratified table
+    total = data.sum()
+    draws = rng.multinomial(total, data.ravel() / total, size=size)
+    return _mantel_haenszel(draws.reshape((size,) + data.shape))[:, None]
+
+
+def veil_of_darkness(date_time, lng, lat, race, minority='Black', reference='White', window_days=None,
+                     bin_minutes=15, timezone='America/Los_Angeles', n_boot=1000, level=0.95, seed=0, workers=1):
+    '''
+    veil-of-darkness test: odds that a stop is of a minority driver after dark vs in daylight, at the same clock time
+    input: stop timestamps (local), longitude, latitude, race codes (RACE_LABELS index), the two races compared,
+           days either side of a daylight saving change to keep (None keeps the whole year), width of the
+           clock-time strata, time zone, bootstrap settings
+    output: dict with odds_ratio, low, high, stops (stops used) and dark (share of them after dusk)
+
+    only stops in the inter-twilight period are used: clock times that are dark on some dates and light
+    on others. stops between sunset and dusk are dropped. daylight saving moves dusk by an hour overnight,
+    so a narrow window around the change compares the same clock times in light and dark with little else
+    changed. an odds ratio below 1 means minority drivers are a smaller share of stops once it is dark
+    (when officers can see drivers less well), which suggests their stops in daylight were partly based on race.
+    '''
+    date_time = pd.DatetimeIndex(date_time)
+    race = np.asarray(race)
+    keep = np.isin(race, [RACE_LABELS.index(minority), RACE_LABELS.index(reference)]) & ~date_time.isna()
+    if window_days is not None:
+        days = pd.date_range(date_time[keep].min().normalize(), date_time[keep].max().normalize(), freq='D')
+        day_offset = utc_offset_minutes(days, timezone)
+        changes = days[1:][np.diff(day_offset) != 0]
+        near = np.zeros(keep.sum(), dtype=bool)
+        for change in changes:
+            near |= np.abs((date_time[keep] - change) / pd.Timedelta(days=1)) <= window_days
+        keep[keep] = near
+    date_time, lng, lat, race = date_time[keep], np.asarray(lng)[keep], np.asarray(lat)[keep], race[keep]
+    clock = (date_time.hour * 60 + date_time.minute).to_numpy()
+    sunset = sun_times(date_time, lng, lat, SUNSET_ZENITH, timezone)
+    dusk = sun_times(date_time, lng, lat, DUSK_ZENITH, timezone)
+    inter_twilight = (clock >= np.nanmin(dusk)) & (clock <= np.nanmax(dusk)) if len(dusk) else np.zeros(0, dtype=bool)
+    keep = inter_twilight & ~((clock >= sunset) & (clock < dusk))
+    dark = (clock >= dusk)[keep].astype('int64')
+    is_minority = (race[keep] == RACE_LABELS.index(minority)).astype('int64')
+    stratum = clock[keep] // bin_minutes
+    n_strata = 24 * 60 // bin_minutes
+    table = np.bincount((stratum * 2 + dark) * 2 + is_minority, minlength=n_strata * 4).reshape(n_strata, 2, 2)
+    if table.sum() == 0:
+        return {'odds_ratio': float('nan'), 'low': float('nan'), 'high': float('nan'), 'stops': 0, 'dark': float('nan')}
+    low, high = bootstrap(_darkness_replicates, table, n_boot, level, seed, workers)
+    return {
+        'odds_ratio': float(_mantel_haenszel(table)),
+        'low': float(low[0]),
+        'high': float(high[0]),
+        'stops': int(table.sum()),
+        'dark': float(dark.mean()),
+    }
@@ -0,0 +1,281 @@
+'''
+local mirror of the remote source csvs
+
+usage: python fetch.py [NAME ...] [--verify]   fetch (or revalidate) the sources, e.g. as a deploy step
+
+    path, sha256 = fetch.fetch('stops')
+    fetch.fetch_all(['census', 'stops'])
+
+each source in config.SOURCES is streamed into config.RAW_DIR/<name>.csv, next to a sidecar
+(<name>.csv.meta.json) holding the file's sha256 and size and the server's ETag / Last-Modified.
+
+    - for config.REVALIDATE_AFTER seconds after a check the mirror is used without a request; after that
+      a conditional request (If-None-Match / If-Modified-Since) asks whether the source changed, and a
+      304 reuses the mirror
+    - a download goes to <name>.csv.part; a dropped connection is retried with backoff, resuming from the
+      bytes already on disk (Range / If-Range), also after a restart
+    - a finished download must match the size the server announced and, where one is pinned with
+      STOPSTATS_<NAME>_SHA256, that hash, before it replaces the mirror
+    - when the server cannot be reached (or answers with an html page instead of the csv), the mirror is
+      used as it is, with a warning
+
+fetch_all() fetches several sources at once on a thread pool. each source is fetched under a lock file,
+so app processes sharing the data directory never download the same file at the same time.
+'''
+import argparse
+import http.client
+import json
+import logging
+import os
+import re
+import sys
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+import instrument
+import sharedcache
+
+LOGGER = logging.getLogger('stopstats.fetch')
+# attempts per download, and the wait before the first retry (doubled after each)
+RETRIES = 4
+BACKOFF = 0.5
+# seconds a request may go without data
+TIMEOUT = 60
+CHUNK_SIZE = 1 << 20
+# a dropped connection, a timeout, an unreachable host (http errors are sorted by status)
+TRANSIENT = (urllib.error.URLError, http.client.HTTPException, ConnectionError, TimeoutError)
+
+
+class SourceError(ValueError):
+    '''a download that is not the source csv: an html page, a short body or a hash that does not match'''
+
+
+def mirror_path(name):
+    '''
+    where a source is mirrored
+    input: dataset name
+    output: path to the csv under config.RAW_DIR
+    '''
+    return os.path.join(config.RAW_DIR, name + '.csv')
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_json(path, value):
+    tmp_path = sharedcache.tmp_path(path)
+    with open(tmp_path, 'w') as f:
+        json.dump(value, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def _remove(*paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def read_meta(name):
+    '''
+    what is known about a source's mirror
+    input: dataset name
+    output: dict with url, sha256, size, etag, last_modified and checked (unix time of the last check), or
+            None when nothing is mirrored or the csv no longer has the recorded size
+    '''
+    path = mirror_path(name)
+    meta = _read_json(path + '.meta.json')
+    try:
+        if meta is None or os.path.getsize(path) != meta['size']:
+            return None
+    except OSError:
+        return None
+    return meta
+
+
+def _validator(etag, last_modified):
+    # If-Range needs a strong etag, or a date
+    if etag and not etag.startswith('W/'):
+        return etag
+    return last_modified
+
+
+def _expected_size(response, offset):
+    if response.status == 206:
+        match = re.match(r'bytes (\d+)-\d+/(\d+)', response.headers.get('Content-Range', ''))
+        if match is None or int(match.group(1)) != offset:
+            raise SourceError(f"unexpected Content-Range {response.headers.get('Content-Range')!r}")
+        return int(match.group(2))
+    length = response.headers.get('Content-Length')
+    return int(length) if length is not None else None
+
+
+def _download(name, url, meta, sha256=None):
+    '''
+    download a source into <mirror>.part, resuming a partial download of the same version
+    input: dataset name, url, the mirror's meta (its validators make the request conditional), pinned hash
+    output: meta of the new download (not yet moved into place), or None when the mirror is current
+    '''
+    import datastore
+
+    part_path = mirror_path(name) + '.part'
+    partial_path = part_path + '.json'
+    for attempt in range(RETRIES):
+        headers = {'User-Agent': 'stopstats'}
+        if meta is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        partial = _read_json(partial_path) if os.path.exists(part_path) else None
+        offset = 0
+        if partial is not None and partial['url'] == url and partial['validator']:
+            offset = os.path.getsize(part_path)
+            # the server sends the rest if the source is still the version the part came from, else all of it
+            headers['Range'] = f'bytes={offset}-'
+            headers['If-Range'] = partial['validator']
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=TIMEOUT) as response:
+                if response.headers.get_content_type() == 'text/html':
+                    # e.g. google drive's quota or virus scan page
+                    raise SourceError(f'{url} returned an html page, not the csv')
+                if response.status != 206:
+                    offset = 0
+                size = _expected_size(response, offset)
+                etag, last_modified = response.headers.get('ETag'), response.headers.get('Last-Modified')
+                _write_json(partial_path, {'url': url, 'validator': _validator(etag, last_modified)})
+                with open(part_path, 'ab' if offset else 'wb') as f:
+                    for block in iter(lambda: response.read(CHUNK_SIZE), b''):
+                        f.write(block)
+            received = os.path.getsize(part_path)
+            if size is not None and received != size:
+                raise http.client.IncompleteRead(b'', size - received)
+            break
+        except urllib.error.HTTPError as error:
+            if error.code == 304:
+                return None
+            if error.code == 416:
+                # the part is no use against this version
+                _remove(part_path, partial_path)
+            if error.code not in (416, 429) and error.code < 500 or attempt == RETRIES - 1:
+                raise
+            reason = f'http {error.code}'
+        except SourceError:
+            _remove(part_path, partial_path)
+            raise
+        except TRANSIENT as error:
+            if attempt == RETRIES - 1:
+                raise
+            reason = repr(error)
+        LOGGER.warning('%s: attempt %d failed (%s); retrying', name, attempt + 1, reason)
+        time.sleep(BACKOFF * 2 ** attempt)
+
+    digest = datastore.file_hash(part_path)
+    if sha256 and digest != sha256:
+        _remove(part_path, partial_path)
+        raise SourceError(f'{name}: downloaded sha256 {digest} does not match the pinned {sha256}')
+    return {'url': url, 'sha256': digest, 'size': received, 'etag': etag, 'last_modified': last_modified}
+
+
+def fetch(name, url=None, sha256=None, revalidate_after=None):
+    '''
+    the mirrored csv of a source, downloaded or revalidated as needed
+    input: dataset name, url (default: config.SOURCES[name]), pinned sha256 (default: STOPSTATS_<NAME>_SHA256),
+           seconds a checked mirror is used without a request (default: config.REVALIDATE_AFTER; 0 always asks)
+    output: (path, sha256) of the csv
+
+    raises when the source cannot be fetched and nothing is mirrored yet.
+    '''
+    url = url or config.SOURCES[name]
+    sha256 = sha256 or os.environ.get('STOPSTATS_' + name.upper() + '_SHA256')
+    revalidate_after = config.REVALIDATE_AFTER if revalidate_after is None else revalidate_after
+    path = mirror_path(name)
+    os.makedirs(config.RAW_DIR, exist_ok=True)
+    with sharedcache.file_lock(path + '.lock'):
+        meta = read_meta(name)
+        if meta is not None and (meta['url'] != url or sha256 and meta['sha256'] != sha256):
+            # mirrored from another source; fetch it whole
+            meta = None
+        if meta is not None and time.time() - meta['checked'] < revalidate_after:
+            return path, meta['sha256']
+        try:
+            with instrument.stage('fetch', dataset=name) as record:
+                downloaded = _download(name, url, meta, sha256)
+                record['cache'] = 'hit' if downloaded is None else 'miss'
+                record['bytes'] = None if downloaded is None else downloaded['size']
+        except TRANSIENT + (SourceError,) as error:
+            if meta is None:
+                raise
+            LOGGER.warning('%s: %s could not be fetched (%r); using the mirror checked %s', name, url, error,
+                           time.strftime('%Y-%m-%d %H:%M', time.localtime(meta['checked'])))
+            return path, meta['sha256']
+        if downloaded is None:
+            meta['checked'] = time.time()
+        else:
+            meta = {**downloaded, 'checked': time.time()}
+            os.replace(path + '.part', path)
+            _remove(path + '.part.json')
+        _write_json(path + '.meta.json', meta)
+    return path, meta['sha256']
+
+
+def fetch_all(names=None, workers=None, **options):
+    '''
+    fetch several sources at once
+    input: dataset names (default: every source), threads (default: one per source), fetch() options
+    output: dict of name -> (path, sha256)
+    '''
+    names = list(config.SOURCES if names is None else names)
+    with ThreadPoolExecutor(workers or max(len(names), 1)) as executor:
+        return dict(zip(names, executor.map(lambda name: fetch(name, **options), names)))
+
+
+def verify(name):
+    '''
+    check a mirrored csv against the sha256 recorded when it was downloaded
+    input: dataset name
+    output: True when it matches, False when it does not (the sidecar is then removed, so the next fetch
+            downloads it again), None when nothing is mirrored
+    '''
+    import datastore
+
+    meta = read_meta(name)
+    if meta is None:
+        return None
+    path = mirror_path(name)
+    if datastore.file_hash(path) == meta['sha256']:
+        return True
+    _remove(path + '.meta.json')
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fetch (or revalidate) the source csvs into the local mirror.')
+    parser.add_argument('names', nargs='*', help=f"sources (default: all of {', '.join(config.SOURCES)})")
+    parser.add_argument('--verify', action='store_true', help='rehash the mirrored csvs first')
+    parser.add_argument('--revalidate-after', type=float, help='seconds a checked mirror is trusted (default: config)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    names = args.names or list(config.SOURCES)
+    unknown = [name for name in names if name not in config.SOURCES]
+    if unknown:
+        parser.error(f"unknown sources: {' '.join(unknown)}")
+    if args.verify:
+        for name in names:
+            if verify(name) is False:
+                LOGGER.warning('%s: mirror does not match its recorded sha256; downloading it again', name)
+    for name, (path, digest) in fetch_all(names, revalidate_after=args.revalidate_after).items():
+        print(f'{name}: {path} sha256 {digest[:16]} ({os.path.getsize(path) / 1e6:.1f} MB)', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
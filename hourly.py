@@ -0,0 +1,122 @@
+import numpy as np
+from branca.element import Template
+
+from markers import FastMarkerLayer
+
+HOURS = 24
+
+
+class HourPartitions:
+    '''
+    stops grouped by hour of day into contiguous slices
+    input: stop geodataframe, name of the hour column (-1 where the time is missing)
+
+    the frame is sorted by hour once; offsets[h]:offsets[h + 1] is the slice for hour h,
+    so selecting an hour is a positional slice instead of a boolean scan of the whole frame.
+    stops without an hour are left out.
+    '''
+
+    def __init__(self, stop_gdf, column='time_of_day'):
+        hour = stop_gdf[column].to_numpy()
+        known = hour >= 0
+        order = np.flatnonzero(known)[np.argsort(hour[known], kind='stable')]
+        self.frame = stop_gdf.take(order)
+        self.counts = np.bincount(hour[known], minlength=HOURS)
+        self.offsets = np.concatenate([[0], np.cumsum(self.counts)])
+
+    def get(self, hour):
+        '''
+        stops in one hour
+        input: hour (0-23)
+        output: slice of the sorted frame
+        '''
+        return self.frame.iloc[self.offsets[hour]:self.offsets[hour + 1]]
+
+
+class HourlyMarkerPlayer(FastMarkerLayer):
+    '''
+    marker cluster that steps through the hours of the day in the browser
+    input: HourPartitions, list of (label, column) popup fields, starting hour, ms per hour
+
+    all stops are shipped once in hour order along with the partition offsets; the play control
+    swaps the cluster's markers client-side, so animating never goes back to the server.
+    '''
+    _template = Template(u'''
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = (function(){
+                var data = {{ this.payload }};
+                var offsets = {{ this.offsets|tojson }};
+                var map = {{ this._parent.get_name() }};
+                var cluster = L.markerClusterGroup({{ this.options|tojson }});
+                var icon = L.AwesomeMarkers.icon({
+                    icon: {{ this.icon|tojson }}, prefix: 'fa', markerColor: {{ this.color|tojson }}
+                });
+                function popupHtml(i) {
+                    var rows = [];
+                    for (var f = 0; f < data.fields.length; f++) {
+                        var field = data.fields[f];
+                        rows.push('<b>' + field.label + ': </b>' + field.values[field.codes[i]]);
+                    }
+                    return '<div style="width: {{ this.width }}px; max-height: {{ this.height }}px; overflow: auto;">'
+                        + rows.join('<br>') + '</div>';
+                }
+                var byHour = {};
+                function markersFor(hour) {
+                    if (!(hour in byHour)) {
+                        var list = [];
+                        for (var i = offsets[hour]; i < offsets[hour + 1]; i++) {
+                            var marker = L.marker([data.lat[i], data.lng[i]], {icon: icon});
+                            marker.bindPopup(popupHtml.bind(null, i));
+                            list.push(marker);
+                        }
+                        byHour[hour] = list;
+                    }
+                    return byHour[hour];
+                }
+
+                var hour = {{ this.start }};
+                var timer = null;
+                var control = L.control({position: 'topright'});
+                var button, label;
+                control.onAdd = function() {
+                    var div = L.DomUtil.create('div', 'leaflet-bar');
+                    div.style.background = 'white';
+                    div.style.padding = '4px 8px';
+                    button = L.DomUtil.create('a', '', div);
+                    button.href = '#';
+                    button.innerHTML = '&#9654;';
+                    label = L.DomUtil.create('span', '', div);
+                    label.style.marginLeft = '6px';
+                    L.DomEvent.disableClickPropagation(div);
+                    L.DomEvent.on(button, 'click', function(e) {
+                        L.DomEvent.preventDefault(e);
+                        if (timer === null) {
+                            timer = setInterval(function() { show((hour + 1) % 24); }, {{ this.interval }});
+                            button.innerHTML = '&#10074;&#10074;';
+                        } else {
+                            clearInterval(timer);
+                            timer = null;
+                            button.innerHTML = '&#9654;';
+                        }
+                    });
+                    return div;
+                };
+                function show(h) {
+                    hour = h;
+                    cluster.clearLayers();
+                    cluster.addLayers(markersFor(h));
+                    label.innerHTML = (h < 10 ? '0' : '') + h + ':00 (' + (offsets[h + 1] - offsets[h]) + ' stops)';
+                }
+                control.addTo(map);
+                cluster.addTo(map);
+                show(hour);
+                return cluster;
+            })();
+        {% endmacro %}''')
+
+    def __init__(self, partitions, fields, start=0, interval=1000, **kwargs):
+        super().__init__(partitions.frame, fields, **kwargs)
+        self._name = 'HourlyMarkerPlayer'
+        self.offsets = partitions.offsets.tolist()
+        self.start = int(start)
+        self.interval = int(interval)
@@ -0,0 +1,290 @@
+'''
+per-stage timing, memory and payload instrumentation
+
+    with instrument.stage('name'): ...                 time a block
+    @instrument.timed('name')                          time every call of a function
+    @instrument.cached(st.cache_resource)              streamlit cache that also records hit / miss
+
+every finished stage is kept for the current script run (debug_panel() shows them in the sidebar when
+STOPSTATS_DEBUG=1) and logged as one json line on the 'stopstats.perf' logger. STOPSTATS_PERF_LOG sends
+those lines to a file ('-' for stderr).
+
+peak memory is only measured with STOPSTATS_TRACE_MEMORY=1, since tracemalloc slows every allocation in
+the process. its figures are process-wide: they count every thread's allocations, and resetting the peak
+for one stage resets it for all. so a stage's peak_mb is only recorded when no other thread had a stage
+open at any time while it ran (other sessions' script runs, the pre-warm thread); otherwise it is None.
+'''
+import functools
+import inspect
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+
+LOGGER = logging.getLogger('stopstats.perf')
+# stages kept per script run
+MAX_RECORDS = 500
+
+_local = threading.local()
+# threads with a stage open, and how many times one started its outermost stage (see stage)
+_memory_lock = threading.Lock()
+_active_threads = 0
+_outer_starts = 0
+
+
+def _configure_logging():
+    target = os.environ.get('STOPSTATS_PERF_LOG')
+    if not target or LOGGER.handlers:
+        return
+    handler = logging.StreamHandler(sys.stderr) if target == '-' else logging.FileHandler(target)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    LOGGER.addHandler(handler)
+    LOGGER.setLevel(logging.INFO)
+
+
+_configure_logging()
+if os.environ.get('STOPSTATS_TRACE_MEMORY') == '1' and not tracemalloc.is_tracing():
+    tracemalloc.start()
+
+
+def _state():
+    state = _local.__dict__
+    if 'records' not in state:
+        state.update(records=[], stack=[], misses=0, page=None, run=None)
+    return state
+
+
+def start_run(page):
+    '''
+    begin a new script run; stages recorded from here on belong to it
+    input: page name
+    output: none
+    '''
+    state = _state()
+    if state['stack']:
+        # stages left open by an interrupted run
+        _leave_thread()
+    state.update(records=[], stack=[], page=page, run=uuid.uuid4().hex[:12])
+
+
+def records():
+    '''
+    stages finished so far in this script run
+    input: none
+    output: list of dicts (stage, depth, seconds, peak_mb, cache, bytes and any extra fields)
+    '''
+    return [record for record in _state()['records'] if record['seconds'] is not None]
+
+
+def payload_size(value):
+    '''
+    bytes a result would take on the wire, when that is cheap to know
+    input: any value
+    output: int for str / bytes, else None
+    '''
+    if isinstance(value, str):
+        return len(value.encode())
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    return None
+
+
+def observed():
+    '''
+    whether anyone looks at the stages: the debug panel is on or the perf log is written
+    input: none
+    output: bool
+    '''
+    return debug_enabled() or LOGGER.isEnabledFor(logging.INFO)
+
+
+def render_size(figure):
+    '''
+    bytes a folium map or plotly figure sends to the browser
+    input: folium map (its html) or plotly figure (its json)
+    output: int, or None when not observed() (rendering a large map again is not free)
+    '''
+    if not observed():
+        return None
+    if hasattr(figure, 'get_root'):
+        return len(figure.get_root().render().encode())
+    return len(figure.to_json().encode())
+
+
+def _enter_thread():
+    # the first stage a thread opens; returns whether it is alone, and the count to compare on the way out
+    global _active_threads, _outer_starts
+    with _memory_lock:
+        _active_threads += 1
+        _outer_starts += 1
+        return _active_threads == 1, _outer_starts
+
+
+def _leave_thread():
+    global _active_threads
+    with _memory_lock:
+        _active_threads -= 1
+
+
+class stage:
+    '''
+    context manager that records one stage
+    input: stage name, extra fields to log with it
+
+    the yielded dict can be filled in while the stage runs (e.g. record['bytes'] = ...). peak_mb is left
+    None unless this thread was the only one with a stage open from start to end (see the module docstring).
+    '''
+
+    def __init__(self, name, **fields):
+        self.record = {'stage': name, 'seconds': None, 'peak_mb': None, 'cache': None, 'bytes': None, **fields}
+
+    def __enter__(self):
+        state = _state()
+        # listed in start order, nested stages after (and indented under) their parent
+        self.record['depth'] = len(state['stack'])
+        state['records'].append(self.record)
+        del state['records'][:-MAX_RECORDS]
+        if state['stack']:
+            outer = state['stack'][0]
+            frame = {'child_peak': 0, 'alone': outer['alone'] and outer['starts'] == _outer_starts,
+                     'starts': outer['starts']}
+        else:
+            alone, starts = _enter_thread()
+            frame = {'child_peak': 0, 'alone': alone, 'starts': starts}
+        # the peak is only reset while no other thread has a stage open, so one thread's reset never
+        # spoils another's figure
+        if frame['alone'] and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            if state['stack']:
+                # reset_peak() below forgets the enclosing stage's peak so far; keep it for that stage
+                parent = state['stack'][-1]
+                parent['child_peak'] = max(parent['child_peak'], peak)
+            frame['start_memory'] = current
+            tracemalloc.reset_peak()
+        state['stack'].append(frame)
+        self._start = time.perf_counter()
+        return self.record
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self._start
+        state = _state()
+        frame = state['stack'].pop() if state['stack'] else {'child_peak': 0}
+        # no other thread opened a stage since this thread's outermost one started
+        alone = frame.get('starts') == _outer_starts
+        if 'start_memory' in frame and alone and tracemalloc.is_tracing():
+            peak = max(tracemalloc.get_traced_memory()[1], frame['child_peak'])
+            self.record['peak_mb'] = (peak - frame['start_memory']) / 1e6
+            if state['stack']:
+                parent = state['stack'][-1]
+                parent['child_peak'] = max(parent['child_peak'], peak)
+        if 'starts' in frame and not state['stack']:
+            _leave_thread()
+        self.record['seconds'] = seconds
+        if exc_type is not None:
+            self.record['error'] = exc_type.__name__
+        if LOGGER.isEnabledFor(logging.INFO):
+            LOGGER.info(json.dumps({'time': time.time(), 'run': state['run'], 'page': state['page'], **self.record},
+                                   default=str))
+        return False
+
+
+def timed(name=None, size=payload_size):
+    '''
+    decorator recording a stage for every call
+    input: stage name (default: the function name), function giving the result's payload bytes
+    output: decorator
+    '''
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name or fn.__name__) as record:
+                result = fn(*args, **kwargs)
+                record['bytes'] = size(result)
+            return result
+        return wrapper
+    return decorate
+
+
+def cached(cache, name=None, size=payload_size):
+    '''
+    wrap a function in a cache decorator and record each call as a cache hit or miss
+    input: cache decorator (e.g. st.cache_resource or st.cache_resource(max_entries=24)), stage name,
+           function giving the result's payload bytes
+    output: decorator; the result keeps the cache's clear()
+    '''
+    def decorate(fn):
+        @functools.wraps(fn)
+        def compute(*args, **kwargs):
+            _state()['misses'] += 1
+            return fn(*args, **kwargs)
+
+        # streamlit keys a cache by the function's module and name. a page runs as __main__, so key by the
+        # file name instead: an imported copy of the page (see prewarm.py) then fills the same entries
+        compute.__module__ = os.path.splitext(os.path.basename(inspect.unwrap(fn).__code__.co_filename))[0]
+        cached_fn = cache(compute)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            state = _state()
+            with stage(name or fn.__name__) as record:
+                misses = state['misses']
+                result = cached_fn(*args, **kwargs)
+                record['cache'] = 'miss' if state['misses'] > misses else 'hit'
+                record['bytes'] = size(result)
+            return result
+
+        wrapper.clear = cached_fn.clear
+        return wrapper
+    return decorate
+
+
+def max_rss_mb():
+    '''
+    peak resident memory of this process
+    input: none
+    output: megabytes, or None where the resource module is missing
+    '''
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macos, kilobytes elsewhere
+    return rss / 1e6 if sys.platform == 'darwin' else rss / 1e3
+
+
+def debug_enabled():
+    '''
+    whether the debug panel should be drawn: STOPSTATS_DEBUG=1 (a server setting, not one a visitor can
+    switch on from the url)
+    '''
+    return os.environ.get('STOPSTATS_DEBUG') == '1'
+
+
+def debug_panel():
+    '''
+    sidebar table of this run's stages (only when debug_enabled())
+    input: none
+    output: none
+    '''
+    import pandas as pd
+    import streamlit as st
+
+    if not debug_enabled():
+        return
+    with st.sidebar.expander('Performance', expanded=True):
+        stages = records()
+        table = pd.DataFrame(stages, columns=['stage', 'depth', 'seconds', 'peak_mb', 'cache', 'bytes'])
+        total = table.loc[table['depth'] == 0, 'seconds'].sum()
+        # indent nested stages, and name the dataset a data stage worked on
+        table['stage'] = ['\u2003' * record['depth'] + record['stage'] +
+                          (f" [{record['dataset']}]" if record.get('dataset') else '') for record in stages]
+        st.dataframe(table.drop(columns='depth'), hide_index=True)
+        st.caption(f"Total {total:.3f} s in {len(table)} stages; "
+                   f"process peak RSS {max_rss_mb() or float('nan'):,.0f} MB; "
+                   + ('peak_mb is process-wide, blank where other runs overlapped' if tracemalloc.is_tracing()
+                      else 'set STOPSTATS_TRACE_MEMORY=1 for peak_mb'))
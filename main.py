@@ -1,10 +1,15 @@
 import streamlit as st
 
+import prewarm
+
 st.set_page_config(
     page_title="Traffic Stop Analyzer",
     page_icon="🚓",
 )
 
+# fill the data and map caches in the background while the visitor reads this page
+prewarm.start()
+
 # Header
 st.title("Unveiling Insights: Traffic Stop Analyzer")
 st.subheader("Exploring the Dynamics of Traffic Policing through Data")
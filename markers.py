@@ -0,0 +1,98 @@
+import json
+
+import numpy as np
+import pandas as pd
+from branca.element import Template
+from folium.plugins import MarkerCluster
+
+import stoptable
+
+
+def encode_column(series):
+    '''
+    dictionary-encode a column for the client
+    input: series
+    output: list of distinct values (as display strings), list of integer codes per row
+
+    only the distinct values are turned into text, so timestamps are formatted here rather than stored as strings
+    '''
+    codes, uniques = pd.factorize(series, use_na_sentinel=False)
+    return [str(value) for value in uniques], codes.tolist()
+
+
+def marker_payload(stop_gdf, fields, precision=5):
+    '''
+    build the columnar payload for FastMarkerLayer in one pass over the frame
+    input: stop frame (see stoptable), list of (label, column) popup fields, coordinate decimals
+    output: json-serializable dict
+    '''
+    fields_payload = []
+    for label, column in fields:
+        values, codes = encode_column(stop_gdf[column])
+        fields_payload.append({'label': label, 'values': values, 'codes': codes})
+    lng, lat = stoptable.coordinates(stop_gdf)
+    return {
+        'lat': np.round(lat, precision).tolist(),
+        'lng': np.round(lng, precision).tolist(),
+        'fields': fields_payload,
+    }
+
+
+def payload_json(stop_gdf, fields):
+    '''
+    serialized marker payload, safe to embed in a <script> tag
+    input: stop geodataframe (points), list of (label, column) popup fields
+    output: json string
+    '''
+    # keep '</' from closing the tag
+    return json.dumps(marker_payload(stop_gdf, fields), separators=(',', ':')).replace('</', '<\\/')
+
+
+class FastMarkerLayer(MarkerCluster):
+    '''
+    marker cluster built client-side from one columnar payload
+    input: stop geodataframe (points), list of (label, column) popup fields,
+           icon name / colour (font awesome), popup width and height in px,
+           optional payload from payload_json() to reuse instead of rebuilding it
+
+    coordinates and popup fields are shipped as arrays (popup fields dictionary-encoded),
+    and markers and their popups are created in the browser, so no python object is made per stop.
+    '''
+    _template = Template(u'''
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = (function(){
+                var data = {{ this.payload }};
+                var cluster = L.markerClusterGroup({{ this.options|tojson }});
+                var icon = L.AwesomeMarkers.icon({
+                    icon: {{ this.icon|tojson }}, prefix: 'fa', markerColor: {{ this.color|tojson }}
+                });
+                function popupHtml(i) {
+                    var rows = [];
+                    for (var f = 0; f < data.fields.length; f++) {
+                        var field = data.fields[f];
+                        rows.push('<b>' + field.label + ': </b>' + field.values[field.codes[i]]);
+                    }
+                    return '<div style="width: {{ this.width }}px; max-height: {{ this.height }}px; overflow: auto;">'
+                        + rows.join('<br>') + '</div>';
+                }
+                var markers = new Array(data.lat.length);
+                for (var i = 0; i < data.lat.length; i++) {
+                    var marker = L.marker([data.lat[i], data.lng[i]], {icon: icon});
+                    marker.bindPopup(popupHtml.bind(null, i));
+                    markers[i] = marker;
+                }
+                cluster.addLayers(markers);
+                cluster.addTo({{ this._parent.get_name() }});
+                return cluster;
+            })();
+        {% endmacro %}''')
+
+    def __init__(self, stop_gdf, fields, icon='car', color='red', width=200, height=100, payload=None, **kwargs):
+        kwargs.setdefault('chunked_loading', True)
+        super().__init__(**kwargs)
+        self._name = 'FastMarkerLayer'
+        self.payload = payload if payload is not None else payload_json(stop_gdf, fields)
+        self.icon = icon
+        self.color = color
+        self.width = width
+        self.height = height
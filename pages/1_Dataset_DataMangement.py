@@ -1,5 +1,7 @@
 import streamlit as st
 
+import shared_data
+
 def main():
     # Set page title and subtitle
     st.title("Dataset and Data Management Plan")
@@ -41,6 +43,11 @@ def main():
     st.subheader("Limitations")
     st.write("One limitation of the dataset is that Washington State Patrol generally performs traffic stops on highways, which may not be as representative of the population of the tract where the stop occurred compared to stops performed by local police departments on non-highway roads and streets. Additionally, a significant portion of our geospatial analysis was performed via Folium. Folium had limited computational efficiency to plot large datasets, so we chose to limit the data scope for the sake of improved dashboard performance. For the mapping portion, data was reduced to only include census tracts and police stops in King County. We randomly sampled n = 10,000 points from the police stops within King County, which was 20.52% of the King County police stops. Subsequent analysis and visualizations will use this reduced sample.")
     
+    # Add section for memory usage
+    st.subheader("Memory Usage")
+    st.write("Each dataset is loaded once per server process and shared by every page; pages only add their own derived columns. The table shows the resident memory of the datasets loaded so far in this process.")
+    st.dataframe(shared_data.memory_report())
+
     # Add references
     st.subheader("References")
     st.write("The Stanford Open Policing Project. (2020). The Stanford Open Policing Project. [Link](https://openpolicing.stanford.edu/)")
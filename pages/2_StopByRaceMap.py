@@ -1,50 +1,169 @@
-import branca
-import folium
-import geopandas as gpd
-import pandas as pd
-from shapely import wkt
+import numpy as np
 import streamlit as st
-from folium.features import GeoJsonPopup, GeoJsonTooltip
-from folium.plugins import MarkerCluster
-from streamlit_folium import st_folium
 
-@st.cache_resource
+import binning
+import catalog
+import config
+import database
+import datastore
+import instrument
+import shared_data
+import sharedcache
+import stoptable
+import tiles
+
+# folium, branca, shapely and streamlit_folium are imported where they are used, so the page's widgets
+# render before (or without) the map libraries loading
+
+@instrument.timed()
 def get_data():
     '''
     read and format data
     input: none
-    output: census_data, stop_data geodataframes
+    output: census geodataframe, stop frame (views of the shared, once-per-process copies)
     '''
-    # read in
-    census_url = 'https://drive.google.com/file/d/1kt7EPrEK5T22ryGcmanxRY67AIr9Gyjq/view?usp=sharing'
-    census_url='https://drive.google.com/uc?id=' + census_url.split('/')[-2]
-    census_data = pd.read_csv(census_url)
+    return get_census(), get_stops()
 
-    stop_url = 'https://drive.google.com/file/d/1nK5givbyegb7w9rSNLbEr-hdmXxKEnFb/view?usp=sharing'
-    stop_url='https://drive.google.com/uc?id=' + stop_url.split('/')[-2]
-    stop_data = pd.read_csv(stop_url)
-    
-    # convert to gdf
-    census_data["geometry"] = census_data["geometry"].apply(wkt.loads)
-    stop_data["geometry"] = stop_data["geometry"].apply(wkt.loads)
-    census_data = gpd.GeoDataFrame(census_data, geometry=census_data.geometry, crs='EPSG:4326')
-    stop_data = gpd.GeoDataFrame(stop_data, geometry=stop_data.geometry, crs='EPSG:4326')
-    
-    # turn timestamp into string to be json compatible
-    stop_data['date_time'] = stop_data['date_time'].astype(str)
+def get_census():
+    # simplified geometry
+    census_data = shared_data.view('census')
+    census_data['geometry'] = shared_data.derived('census', 'geometry_simplified')
+    return census_data
 
-    # simplify geometry
-    census_data['geometry'] = census_data['geometry'].simplify(0.0001)
+@instrument.timed()
+def get_stops(races=None, selection=None):
+    '''
+    stops, optionally only those of some subject races
+    input: tuple of subject_race values (None for all), (states, years) for the partitioned store (None for all)
+    output: stop frame (a view of the shared copy, or just the matching rows from the database / store)
+    '''
+    if config.BACKEND == 'sqlite':
+        return database.stop_frame(STOP_COLUMNS, races=races)
+    if config.BACKEND == 'partitioned':
+        states, years = selection or (None, None)
+        return catalog.read(states, years=years, columns=STOP_COLUMNS, races=races)
+    # timestamps stay numeric; the marker payload formats them
+    stop_data = shared_data.view('stops')
+    if races is not None:
+        stop_data = stop_data[stop_data['subject_race'].isin(races)]
+    return stop_data
+
+# popup fields for stop markers
+STOP_FIELDS = [
+    ('Subject Race', 'subject_race'),
+    ('Subject Age', 'subject_age'),
+    ('Search Conducted', 'search_conducted'),
+    ('Outcome', 'outcome'),
+]
+# stop columns the markers and bins need
+STOP_COLUMNS = list(dict.fromkeys([column for _, column in STOP_FIELDS] + [column for column, _ in binning.BREAKDOWNS]))
+
+@instrument.cached(st.cache_resource)
+def get_race_options(selection=None):
+    if config.BACKEND == 'sqlite':
+        return [race for race in database.distinct('SubjectRace') if race is not None]
+    if config.BACKEND == 'partitioned':
+        states, years = selection or (None, None)
+        return catalog.distinct('subject_race', states, years=years)
+    return sorted(shared_data.get('stops')['subject_race'].dropna().unique())
+
+@instrument.cached(st.cache_resource)
+@sharedcache.memoize('census')
+def get_tract_geojson():
+    '''
+    tract geometry serialized once per process and shared by every demographic variable
+    output: geojson string
+    '''
+    import choropleth
 
-    return census_data, stop_data
+    return choropleth.tract_geojson(get_census())
 
-@st.cache_resource(experimental_allow_widgets=True)
-def generate_map_for_race(_census_gdf, _stop_gdf, _demographic_var):
+@instrument.cached(st.cache_resource(max_entries=8))
+@sharedcache.memoize('map_stops')
+def get_marker_payload(races=None, selection=None):
     '''
-    generate map with base layer of demographic census data, with police stop cluster marker layer for a specific race.
-    input: census_data, stop_data geodataframes, demographic variable, race
+    stop marker payload, built once per process for each race (and partition) selection
+    output: json string
+    '''
+    import markers
+
+    return markers.payload_json(get_stops(races, selection), STOP_FIELDS)
+
+@instrument.cached(st.cache_resource(max_entries=16))
+@sharedcache.memoize('map_stops')
+def get_bins(bin_shape, bin_resolution, races=None, selection=None):
+    return binning.bin_stops(get_stops(races, selection), bin_shape, bin_resolution)
+
+@instrument.cached(st.cache_resource(max_entries=8))
+def get_stop_index(races=None, selection=None):
+    # grid index the viewport mode queries on every pan and zoom
+    import viewport
+
+    return viewport.StopIndex(get_stops(races, selection))
+
+@instrument.cached(st.cache_resource(max_entries=8))
+@sharedcache.memoize('census', 'map_stops')
+def get_tract_stop_counts(races=None, selection=None):
+    '''
+    number of stops in each tract
+    input: tuple of subject_race values (None for all), (states, years) for the partitioned store
+    output: array aligned with the census rows
+    '''
+    import shapely
+
+    import pipeline
+
+    census_data = shared_data.get('census')
+    if config.BACKEND == 'sqlite':
+        # per-tract counts straight from the HappenIn index
+        return census_data['TractID'].map(database.tract_counts(races=races)).fillna(0).to_numpy()
+    stop_data = get_stops(races, selection)
+    tract = pipeline.assign_tracts(*stoptable.coordinates(stop_data), shapely.STRtree(census_data.geometry.values))
+    return np.bincount(tract[tract >= 0], minlength=len(census_data)).astype('float64')
+
+@instrument.cached(st.cache_resource)
+@sharedcache.memoize('census')
+def get_census_weights():
+    # queen contiguity of the census tracts (full geometry: simplified tracts may no longer touch), built once
+    import spatial
+
+    return spatial.contiguity(shared_data.get('census').geometry.values, 'queen')
+
+@instrument.cached(st.cache_resource(max_entries=32))
+@sharedcache.memoize('census', 'map_stops')
+def get_hotspots(demographic_var, races=None, selection=None):
+    '''
+    Gi* hot spots, LISA clusters and global Moran's I of a tract variable
+    input: demographic variable, and for NumStops the race (and partition) selection the counts are for
+    output: dataframe aligned with the census rows, moran dict (see spatial.autocorrelation)
+    '''
+    import spatial
+
+    if demographic_var == 'NumStops':
+        values = get_tract_stop_counts(races, selection)
+    else:
+        values = shared_data.get('census')[demographic_var].to_numpy(dtype='float64')
+    return spatial.autocorrelation(values, get_census_weights(), workers=None)
+
+def demographic_variables(census_gdf):
+    # tract columns the map can be coloured by; NumStops is counted from the stops on demand
+    return list(census_gdf.columns[2:-1]) + ['NumStops']
+
+@instrument.timed()
+def generate_map_for_race(_census_gdf, _stop_gdf, _demographic_var, stop_layer='clusters', bin_shape='hex', bin_resolution='medium', _geojson=None, _marker_payload=None, _bins=None, _tile_url=None, _hotspots=None):
+    '''
+    generate map with base layer of demographic census data, with police stop cluster marker layer (or binned stop layer) for a specific race.
+    input: census_data, stop_data geodataframes, demographic variable, stop layer ('clusters', 'bins', or 'viewport' for none: the page
+           adds the stops in view), bin shape and resolution,
+           optional pre-built tract geojson / marker payload / bins to reuse, optional vector tile url (tracts and stops from the tile server),
+           optional hot spot frame (see get_hotspots) to draw over the tracts
     output: folium map
     '''
+    import branca
+    import folium
+
+    import choropleth
+
     m = folium.Map(location=[47.4405, -121.8836], zoom_start=9, prefer_canvas=True)
 
     colormap = branca.colormap.LinearColormap(
@@ -54,59 +173,70 @@ def generate_map_for_race(_census_gdf, _stop_gdf, _demographic_var):
     caption=_demographic_var
     )
 
-    generate_choropleth_map(_census_gdf, _demographic_var, colormap).add_to(m)
+    if _tile_url is not None:
+        values = _census_gdf[_demographic_var].to_numpy(dtype='float64')
+        tiles.VectorTileLayer(_tile_url, 'tracts', colors=choropleth.fill_colors(colormap, values)).add_to(m)
+    else:
+        generate_choropleth_map(_census_gdf, _demographic_var, colormap, _geojson).add_to(m)
+    if _hotspots is not None:
+        import spatial
+
+        spatial.hotspot_layer(_geojson or choropleth.tract_geojson(_census_gdf), _hotspots, _demographic_var).add_to(m)
 
     # if pd.isnull(race):  # Check if the selected race is NaN
     #     race_data = stop_gdf[pd.isnull(stop_gdf['subject_race'])]
     # else:
     #     race_data = stop_gdf[stop_gdf['subject_race'] == race]  # Filter by selected race
 
-    generate_marker_cluster(_stop_gdf).add_to(m)
+    if stop_layer == 'viewport':
+        # stops are sent per view by viewport.st_viewport_map
+        pass
+    elif stop_layer == 'bins':
+        if _bins is None:
+            _bins = binning.bin_stops(_stop_gdf, bin_shape, bin_resolution)
+        binning.bins_layer(_bins).add_to(m)
+    elif _tile_url is not None:
+        tiles.VectorTileLayer(_tile_url, 'stops').add_to(m)
+    else:
+        generate_marker_cluster(_stop_gdf, _marker_payload).add_to(m)
 
     colormap.add_to(m)
 
-    with st.form(key='main_map'):
-        st.form_submit_button(disabled=True)
-        return st_folium(m, width=700, height=500)
+    return m
 
 
-def generate_choropleth_map(_census_gdf, _demographic_var, _colormap):
-    popup = GeoJsonPopup(
-    fields=["TractID", _demographic_var],
-    aliases=["Tract", _demographic_var],
-    localize=True,
-    labels=True,
-    style="background-color: yellow;",
-    )
+@instrument.timed()
+def generate_choropleth_map(_census_gdf, _demographic_var, _colormap, _geojson=None):
+    # fill colours for all tracts at once; the tract geometry is serialized once and reused across variables
+    import choropleth
+
+    if _geojson is None:
+        _geojson = choropleth.tract_geojson(_census_gdf)
+    return choropleth.choropleth_layer(_geojson, _census_gdf, _demographic_var, _colormap)
 
-    choro = folium.GeoJson(
-        _census_gdf,
-        style_function=lambda x: {
-            "fillColor": _colormap(x["properties"][_demographic_var])
-            if x["properties"][_demographic_var] is not None
-            else "transparent",
-            "color": "black",
-            "fillOpacity": 0.4,
-        },
-        popup=popup,
-    )
-    return choro
 
+@instrument.timed()
+def generate_marker_cluster(_stop_gdf, _payload=None):
+    # all stops go to the client as one payload; markers and popups are built in the browser
+    import markers
 
-def generate_marker_cluster(_stop_gdf):
-    marker_cluster = MarkerCluster()
-    for i in range(len(_stop_gdf)):
-        iframe = folium.IFrame("<b>Subject Race: </b> " + str(_stop_gdf.iloc[i]['subject_race']) + "<br><b>Subject Age: </b> " + str(_stop_gdf.iloc[i]['subject_age']) + "<br><b>Search Conducted: </b> " + str(_stop_gdf.iloc[i]['search_conducted']) + "<br><b>Outcome: </b> " + str(_stop_gdf.iloc[i]['outcome']), width=200, height=100)
-        marker = folium.Marker(
-            location=[_stop_gdf.iloc[i]['geometry'].y, _stop_gdf.iloc[i]['geometry'].x],
-            icon=folium.Icon(color='red', icon='car', prefix='fa'),
-            popup=folium.Popup(iframe, minwidth=100, maxwidth=100)
-        )
-        marker.add_to(marker_cluster)
-    return marker_cluster
+    return markers.FastMarkerLayer(_stop_gdf, fields=STOP_FIELDS, payload=_payload)
+
+def prewarm():
+    '''
+    fill the caches the default view needs, with the arguments main() passes (see prewarm.py)
+    '''
+    selection = catalog.default_selection() if config.BACKEND == 'partitioned' else None
+    get_census()
+    get_race_options(selection)
+    get_tract_geojson()
+    get_marker_payload(None, selection)
 
 def main():
-    census_gdf, stop_gdf = get_data()
+    instrument.start_run('StopByRaceMap')
+    # fetch and build the datasets side by side (the partitioned backend reads its stops from its own store)
+    datastore.prepare('census', *([] if config.BACKEND == 'partitioned' else ['stops']))
+    census_gdf = get_census()
     demographic_var = "PctBlack"
     
      # Title and subtitle
@@ -115,18 +245,60 @@ def main():
     st.write("Race, age, gender, income and eduation demographics at the census tract level are presented on StopByRaceMap page of this app. High concentrations of BIPOC individuals are located in the Southeast portion of King County, specifically in south Seattle, as well as east of Seattle (Bellevue, Redmond). These areas also display a larger portion of individuals below the poverty level. Interestingly enough, downtown Seattle (Sodo in particular) has more male than female residents.")
 
     st.write("The distribution and count of police stops in King County were also plotted. Washington State Patrol stops are concentrated along major roadways (state highways, interstates, etc.). The census tract with the highest number of police stops is located in the Sodo neighborhood of Seattle. Interestingly enough, this is also the census tract with the highest proportion of male residents. However, stop data is not necessarily reflective of the residents who live in the census tract that they are stopped in, as travelers may be coming from any part of the county. The census tract with the most stops also touches three different major routes–SR-99, I-5, and I-90– as well as land uses which generate many trips (Lumen Field, T-Mobile Park). These transportation network and land use factors may be better explanatory factors for the high amount of stops.")
-    # races = stop_gdf['subject_race'].unique()
-    # selected_race = st.selectbox("Select Race", races)
-    demographic_variables = census_gdf.columns[2:-1]
-    demographic_var = st.selectbox("Select Demographic Variable", demographic_variables)
+    selection = catalog.partition_selector() if config.BACKEND == 'partitioned' else None
+    race_options = get_race_options(selection)
+    selected_races = st.multiselect("Subject Race", race_options, default=race_options, help="Only stops of the selected subject races are mapped and counted per tract.")
+    races = None if set(selected_races) == set(race_options) else tuple(selected_races)
+    demographic_var = st.selectbox("Select Demographic Variable", demographic_variables(census_gdf))
+    if demographic_var == 'NumStops':
+        census_gdf['NumStops'] = get_tract_stop_counts(races, selection)
+    stop_layer = st.radio("Show Stops As", ['clusters', 'bins', 'viewport'], horizontal=True, help="Clusters draw one marker per stop; bins aggregate stops into hexagons or squares, which scales to much larger datasets; viewport loads only the stops in view as you pan and zoom (binned when there are too many to draw).")
+    bin_shape, bin_resolution = 'hex', 'medium'
+    if stop_layer in ('bins', 'viewport'):
+        bin_shape = st.selectbox("Bin Shape", ['hex', 'square'])
+    if stop_layer == 'bins':
+        bin_resolution = st.select_slider("Bin Resolution", options=list(binning.RESOLUTIONS), value='medium')
+    # the tiles are cut from every stop in the shared dataset, so they are only offered when the map shows exactly those
+    use_tiles = (tiles.available() and stop_layer != 'viewport' and config.BACKEND == 'memory' and races is None
+                 and st.checkbox("Use Vector Tiles", help="Serve tracts and stops as vector tiles from a local tile server, so the browser only loads what is in view. Available with every subject race selected, on the default (memory) backend."))
+    show_hotspots = st.checkbox("Show Hotspots", help="Colour the tracts where the selected variable clusters: Getis-Ord Gi* hot spots (red) and cold spots (blue), significant at p < 0.05 over 999 conditional permutations with queen contiguity.")
     
     generate_map_button = st.checkbox("Generate Map")
     map_placeholder = st.empty()  # Placeholder for the map
     
     if generate_map_button:
+        from streamlit_folium import st_folium
+
         st.header(f"Spatial distribution of {demographic_var} and police stops in King County")
-        map_placeholder = generate_map_for_race(census_gdf, stop_gdf, demographic_var)
+        tile_url = tiles.tile_url(tiles.shared_server()) if use_tiles else None
+        hotspots = None
+        if show_hotspots:
+            hotspots, global_moran = get_hotspots(demographic_var, *((races, selection) if demographic_var == 'NumStops' else ()))
+            counts = hotspots['hotspot'].value_counts()
+            st.caption(f"Global Moran's I of {demographic_var}: {global_moran['I']:.3f} (pseudo p = {global_moran['p']:.3f}, {global_moran['n']:,} tracts); "
+                       f"{counts.get('Hot spot', 0):,} hot spot and {counts.get('Cold spot', 0):,} cold spot tracts.")
+        # stops reach the map only through the cached payload / bins (or the tile server), never as a whole frame
+        m = generate_map_for_race(census_gdf, None, demographic_var, stop_layer, bin_shape, bin_resolution,
+                                  _geojson=get_tract_geojson() if show_hotspots or not use_tiles else None,
+                                  _marker_payload=get_marker_payload(races, selection) if stop_layer == 'clusters' and not use_tiles else None,
+                                  _bins=get_bins(bin_shape, bin_resolution, races, selection) if stop_layer == 'bins' else None,
+                                  _tile_url=tile_url, _hotspots=hotspots)
+        if stop_layer == 'viewport':
+            import viewport
+
+            # no form: every pan and zoom reruns the page to send the stops now in view
+            _, shown = viewport.st_viewport_map(m, get_stop_index(races, selection), STOP_FIELDS, key='race_map', shape=bin_shape)
+            st.caption(f"{shown['stops']:,} stops in view" + (' (binned)' if shown['binned'] else ''))
+            instrument.debug_panel()
+            st.stop()
+        with st.form(key='main_map'):
+            st.form_submit_button(disabled=True)
+            with instrument.stage('st_folium') as record:
+                map_placeholder = st_folium(m, width=700, height=500)
+                record['bytes'] = instrument.render_size(m)
+        instrument.debug_panel()
         st.stop()  # Stop execution after generating the map
+    instrument.debug_panel()
 
 if __name__ == "__main__":
     main()
@@ -1,49 +1,79 @@
 import streamlit as st
-import folium
-import branca
-from folium.features import GeoJsonPopup
-from folium.plugins import MarkerCluster
-from streamlit_folium import st_folium
-import geopandas as gpd
+import streamlit.components.v1 as components
 import pandas as pd
-from shapely import wkt
 
-@st.cache_data
+import binning
+import catalog
+import config
+import cube
+import database
+import datastore
+import hourly
+import instrument
+import markers
+import shared_data
+import sharedcache
+import tiles
+
+# popup fields for stop markers
+STOP_FIELDS = [
+    ('Subject Race', 'subject_race'),
+    ('Search Conducted', 'search_conducted'),
+    ('Outcome', 'outcome'),
+    ('Time', 'date_time'),
+]
+
+# stop columns the markers and bins need
+STOP_COLUMNS = list(dict.fromkeys([column for _, column in STOP_FIELDS] + [column for column, _ in binning.BREAKDOWNS]))
+
+@instrument.timed()
 def get_data():
     '''
     Read and format data
     Input: None
-    Output: census_data, stop_data geodataframes
+    Output: census geodataframe, stop frame (views of the shared, once-per-process copies)
     '''
-    # Read in census data
-    census_url = 'https://drive.google.com/file/d/1kt7EPrEK5T22ryGcmanxRY67AIr9Gyjq/view?usp=sharing'
-    census_url = 'https://drive.google.com/uc?id=' + census_url.split('/')[-2]
-    census_data = pd.read_csv(census_url)
-
-    # Read in stop data
-    stop_url = 'https://drive.google.com/file/d/1nK5givbyegb7w9rSNLbEr-hdmXxKEnFb/view?usp=sharing'
-    stop_url = 'https://drive.google.com/uc?id=' + stop_url.split('/')[-2]
-    stop_data = pd.read_csv(stop_url)
-    
-    # Convert to GeoDataFrame
-    census_data["geometry"] = census_data["geometry"].apply(wkt.loads)
-    stop_data["geometry"] = stop_data["geometry"].apply(wkt.loads)
-    census_data = gpd.GeoDataFrame(census_data, geometry=census_data.geometry, crs='EPSG:4326')
-    stop_data = gpd.GeoDataFrame(stop_data, geometry=stop_data.geometry, crs='EPSG:4326')
-    
-    # Turn timestamp into string to be JSON compatible
-    stop_data['date_time'] = pd.to_datetime(stop_data['date_time'])
-    stop_data['time_of_day'] = stop_data['date_time'].dt.hour
+    census_data = shared_data.view('census')
+    stop_data = shared_data.view('stops', 'time_of_day')
 
     return census_data, stop_data
 
-def generate_map(_census_gdf, _stop_gdf, _demographic_var, _time_of_day):
+@instrument.cached(st.cache_resource(max_entries=8))
+def get_partitions(selection=None):
+    '''
+    Stops grouped by hour of day, built once per process
+    Input: (states, years) for the partitioned store (None for all)
+    Output: HourPartitions (or, with the sqlite / partitioned backends, a reader that fetches one hour per call)
+    '''
+    if config.BACKEND == 'sqlite':
+        return database.HourQuery(STOP_COLUMNS)
+    if config.BACKEND == 'partitioned':
+        # the hour filter is pushed down to the hour-sorted parquet files
+        return catalog.HourReader(selection, STOP_COLUMNS)
+    _, stop_data = get_data()
+    return hourly.HourPartitions(stop_data)
+
+@instrument.cached(st.cache_resource(max_entries=8))
+def get_play_partitions(selection=None):
+    '''
+    Every stop in hour order for the client-side player
+    Output: HourPartitions
+    '''
+    # only the popup columns, not the whole stop table
+    if config.BACKEND == 'sqlite':
+        return hourly.HourPartitions(database.stop_frame([column for _, column in STOP_FIELDS]))
+    if config.BACKEND == 'partitioned':
+        states, years = selection or (None, None)
+        return hourly.HourPartitions(catalog.read(states, years=years, columns=[column for _, column in STOP_FIELDS], hours=range(hourly.HOURS)))
+    return get_partitions()
+
+@instrument.timed()
+def generate_map(_census_gdf, _partitions, _demographic_var, _time_of_day, stop_layer='clusters', bin_shape='hex', bin_resolution='medium', _tile_url=None):
     '''
     Generate map with base layer of demographic census data, with police stop cluster marker layer.
     Popup functionality for both.
     '''
-    # Filter stop data based on the selected time of day
-    filtered_stop_data = _stop_gdf[_stop_gdf['time_of_day'] == _time_of_day]
+    import folium
 
     # colormap = branca.colormap.LinearColormap(
     #     vmin=_census_gdf[_demographic_var].quantile(0.0),
@@ -74,29 +104,122 @@ def generate_map(_census_gdf, _stop_gdf, _demographic_var, _time_of_day):
     #     popup=popup,
     # ).add_to(m)
 
-    # Create MarkerCluster for stop data
-    marker_cluster = MarkerCluster()
-    for i in range(0, len(filtered_stop_data)):
-        stop_info = filtered_stop_data.iloc[i]
-        popup_html = f"""
-            <b>Subject Race:</b> {stop_info.subject_race}<br>
-            <b>Search Conducted:</b> {stop_info.search_conducted}<br>
-            <b>Outcome:</b> {stop_info.outcome}<br>
-            <b>Time:</b> {stop_info.date_time}<br>
-            """
-        iframe = folium.IFrame(popup_html, width=200, height=100)
-        marker = folium.Marker(
-            location=[stop_info['geometry'].y, stop_info['geometry'].x],
-            icon=folium.Icon(color='red', icon='car', prefix='fa'),
-            popup=folium.Popup(iframe, minwidth=200, maxwidth=200))
-        marker.add_to(marker_cluster)
-    marker_cluster.add_to(m)
+    if stop_layer == 'viewport':
+        # Stops in view are added by viewport.st_viewport_map
+        pass
+    elif stop_layer == 'bins':
+        # Stops for the selected time of day (contiguous slice of the hour partitions), aggregated into hexagon/square bins
+        binning.bins_layer(binning.bin_stops(_partitions.get(_time_of_day), bin_shape, bin_resolution)).add_to(m)
+    elif _tile_url is not None:
+        # Stops for the hour from the local vector tile server
+        tiles.VectorTileLayer(_tile_url, f'stops_h{_time_of_day:02d}').add_to(m)
+    else:
+        # Marker layer for the hour's stops, built client-side from one payload
+        markers.FastMarkerLayer(_partitions.get(_time_of_day), fields=STOP_FIELDS).add_to(m)
 
     # colormap.add_to(m)
     # with st.form(key='main_map'):
     return m
 
+@instrument.cached(st.cache_resource(max_entries=hourly.HOURS))
+@sharedcache.memoize('map_stops')
+def hour_map_html(_census_gdf, _partitions, demographic_var, time_of_day, stop_layer='clusters', bin_shape='hex', bin_resolution='medium', tile_url=None, selection=None):
+    '''
+    Rendered map for one hour; one entry per hour is kept, so scrubbing the slider is a lookup
+    '''
+    return generate_map(_census_gdf, _partitions, demographic_var, time_of_day, stop_layer, bin_shape, bin_resolution, tile_url).get_root().render()
+
+@instrument.cached(st.cache_resource(max_entries=hourly.HOURS))
+def get_hour_index(time_of_day, selection=None):
+    '''
+    Grid index over one hour's stops, queried by the viewport mode on every pan and zoom
+    Output: viewport.StopIndex
+    '''
+    import viewport
+
+    return viewport.StopIndex(get_partitions(selection).get(time_of_day))
+
+@instrument.timed()
+def generate_play_map(_partitions, _start):
+    '''
+    Map that animates through the hours client-side
+    '''
+    import folium
+
+    m = folium.Map(location=[47.4405, -121.8836], zoom_start=9, prefer_canvas=True)
+    hourly.HourlyMarkerPlayer(_partitions, STOP_FIELDS, start=_start).add_to(m)
+    return m
+
+@instrument.cached(st.cache_resource)
+@sharedcache.memoize('map_stops')
+def play_map_html(_partitions, start, selection=None):
+    return generate_play_map(_partitions, start).get_root().render()
+
+@instrument.cached(st.cache_resource(max_entries=8))
+def get_cube(selection=None):
+    '''
+    Stop counts by tract, hour, day of week, month, race and outcome, built once and kept on disk
+    Input: (states, years) for the partitioned store (None for the shared stop data)
+    Output: TemporalCube
+    '''
+    return cube.shared_cube(selection)
+
+def cube_filters():
+    '''
+    Sidebar race / outcome / month pickers for the cube views
+    Output: filters for TemporalCube.rollup (None where nothing is picked, i.e. everything)
+    '''
+    filters = {}
+    for axis, label in (('race', 'Subject Race'), ('outcome', 'Outcome'), ('month', 'Month')):
+        picked = st.sidebar.multiselect(label, cube.LABELS[axis], placeholder='All')
+        filters[axis] = picked or None
+    return filters
+
+@instrument.timed()
+def show_heatmap(temporal_cube, filters):
+    '''
+    Stops by hour of day and day of week
+    '''
+    import plotly.express as px
+
+    frame = temporal_cube.frame(('hour', 'dow'), **filters)
+    fig = px.imshow(frame, labels=dict(x='Day of Week', y='Hour of Day', color='Stops'), aspect='auto',
+                    color_continuous_scale='Reds')
+    st.plotly_chart(fig)
+
+@instrument.timed()
+def show_tract_profile(temporal_cube, filters):
+    '''
+    Hour and day of week profile of one tract against the whole area
+    '''
+    import plotly.express as px
+
+    totals = pd.Series(temporal_cube.rollup(('tract',), **filters), index=temporal_cube.tract_ids)
+    # busiest tracts first
+    totals = totals.sort_values(ascending=False, kind='stable')
+    tract_id = st.sidebar.selectbox('Tract', totals.index, format_func=lambda tract: f'{tract} ({totals[tract]:,} stops)')
+    st.write(f"Tract {tract_id}: share of its stops in each hour and day, against all tracts.")
+    for axis, labels, title in (('hour', cube.LABELS['hour'], 'Hour of Day'), ('dow', cube.DAYS, 'Day of Week')):
+        tract_counts = temporal_cube.rollup((axis,), tracts=[tract_id], **filters)
+        all_counts = temporal_cube.rollup((axis,), **filters)
+        profile = pd.DataFrame({
+            'Tract': tract_counts / max(tract_counts.sum(), 1),
+            'All Tracts': all_counts / max(all_counts.sum(), 1),
+        }, index=pd.Index(labels, name=title))
+        st.plotly_chart(px.line(profile, markers=True, labels=dict(value='Share of Stops', variable='')))
+
+def prewarm():
+    '''
+    Fill the caches the default view needs, with the arguments main() passes (see prewarm.py)
+    '''
+    selection = catalog.default_selection() if config.BACKEND == 'partitioned' else None
+    hour_map_html(shared_data.view('census'), get_partitions(selection), "PctBlack", 12, 'clusters', 'hex', 'medium', None, selection)
+    get_cube(selection)
+
 def main():
+    instrument.start_run('StopByTimeMap')
+    # fetch and build the datasets side by side (the partitioned backend reads its stops from its own store)
+    datastore.prepare('census', *([] if config.BACKEND == 'partitioned' else ['stops']))
     st.title("Police Stop Data Visualization")
     st.write("""
     This web app visualizes police stop data along with demographic census data.
@@ -117,15 +240,46 @@ def main():
     By examining police stops through a temporal lens, we aim to uncover nuanced patterns that contribute to a deeper understanding of law enforcement dynamics and their intersection with demographic characteristics within King County.
     """)
     
-    census_gdf, stop_gdf = get_data()
+    census_gdf = shared_data.view('census')
     demographic_var = "PctBlack"
     
     # Create Streamlit slider to select time of day
     st.sidebar.title("Settings")
-    time_of_day = st.sidebar.slider('Select Time of Day', 0, 23, 12)
+    selection = catalog.partition_selector() if config.BACKEND == 'partitioned' else None
+    view = st.sidebar.radio('View', ['Map', 'Hour × Day Heatmap', 'Tract Profile'], help='The heatmap and tract profiles are read from a precomputed cube of stop counts, so they redraw instantly.')
+    if view != 'Map':
+        filters = cube_filters()
+        if view == 'Hour × Day Heatmap':
+            show_heatmap(get_cube(selection), filters)
+        else:
+            show_tract_profile(get_cube(selection), filters)
+        instrument.debug_panel()
+        st.stop()
+
+    play = st.sidebar.checkbox('Play through the hours', help='Animate the map hour by hour in the browser (use the play button on the map)')
+    time_of_day = st.sidebar.slider('Select Time of Day', 0, 23, 12, disabled=play)
+    stop_layer = st.sidebar.radio('Show Stops As', ['clusters', 'bins', 'viewport'], disabled=play, help='Clusters draw one marker per stop; bins aggregate stops into hexagons or squares, which scales to much larger datasets; viewport loads only the stops in view as you pan and zoom (binned when there are too many to draw).')
+    bin_shape, bin_resolution = 'hex', 'medium'
+    if stop_layer in ('bins', 'viewport') and not play:
+        bin_shape = st.sidebar.selectbox('Bin Shape', ['hex', 'square'])
+    if stop_layer == 'bins' and not play:
+        bin_resolution = st.sidebar.select_slider('Bin Resolution', options=list(binning.RESOLUTIONS), value='medium')
+    # the tiles are cut from the shared stop dataset, which the sqlite and partitioned backends do not read
+    use_tiles = (tiles.available() and not play and stop_layer != 'viewport' and config.BACKEND == 'memory'
+                 and st.sidebar.checkbox('Use Vector Tiles', help='Serve stops as vector tiles from a local tile server, so the browser only loads what is in view. Available on the default (memory) backend.'))
+    tile_url = tiles.tile_url(tiles.shared_server()) if use_tiles else None
+
+    if play:
+        components.html(play_map_html(get_play_partitions(selection), time_of_day, selection), width=700, height=500)
+    elif stop_layer == 'viewport':
+        import viewport
 
-    m = generate_map(census_gdf, stop_gdf, demographic_var, time_of_day)
-    st_folium(m, width=700, height=500)
+        m = generate_map(census_gdf, None, demographic_var, time_of_day, stop_layer)
+        _, shown = viewport.st_viewport_map(m, get_hour_index(time_of_day, selection), STOP_FIELDS, key='hour_map', shape=bin_shape)
+        st.caption(f"{shown['stops']:,} stops in view" + (' (binned)' if shown['binned'] else ''))
+    else:
+        components.html(hour_map_html(census_gdf, get_partitions(selection), demographic_var, time_of_day, stop_layer, bin_shape, bin_resolution, tile_url, selection), width=700, height=500)
+    instrument.debug_panel()
     st.stop()
 
 if __name__ == "__main__":
@@ -1,84 +1,247 @@
 import streamlit as st
 import pandas as pd
-import geopandas as gpd
-import matplotlib.pyplot as plt
-import seaborn as sns
-from math import ceil
+import numpy as np
 import plotly_express as px
 import plotly.graph_objects as go
 
-@st.cache_resource
-def get_data():
-    # read in
-    scatter_url = 'https://drive.google.com/file/d/1PHSheaSfnMgZ03j76hSf9DU8lUjDZ3ka/view?usp=sharing'
-    scatter_url ='https://drive.google.com/uc?id=' + scatter_url.split('/')[-2]
-    df = pd.read_csv(scatter_url)
+import aggregates
+import disparity
+import instrument
+import regression
+import scatter
+import shared_data
+import sharedcache
+import spatial
+import stoptable
+import summary
+
+# bootstrap replicates behind every confidence interval on the page
+BOOTSTRAP_REPLICATES = 2000
+# races (TractPct<race> / StopsPct<race>) and stop activities (StopsPct<activity>) offered by the plots
+RACE_OPTIONS = ['White', 'Black', 'Hispanic', 'AAPI', 'Other', 'BIPOC']
+ACTIVITY_OPTIONS = ['Searched', 'Frisked', 'ContrabandFound', 'Citation', 'Warning']
+# x-axis ticks for tract percentages
+PERCENT_TICKS = [0, 10, 20, 30, 40, 50, 60, 70, 80, 90, 100]
+
+@instrument.timed()
+def get_data(years=None):
+    # shared, once-per-process copy
+    df = shared_data.view('tracts')
+    if years:
+        # stop percentages for the selected years, derived from the incremental tract counts
+        derived = get_tract_counts().percentages(years).set_index('TractID')
+        for column in derived.columns.intersection(df.columns):
+            df[column] = df['TractID'].map(derived[column]).to_numpy()
     return df
 
-def stats(dataframe):
+@instrument.cached(st.cache_resource)
+def get_tract_counts():
+    # per tract x year x race x activity counts appended with `pipeline.py --append`, if any
+    return aggregates.load_store()
+
+@instrument.cached(st.cache_resource)
+@sharedcache.memoize('tracts', 'tract_counts')
+def get_regression(years=None):
+    # slope, intercept, r^2 and n for every pair of numeric columns, fitted once per dataset
+    return regression.PairwiseOLS(get_data(years))
+
+@instrument.cached(st.cache_resource)
+@sharedcache.memoize('tracts', 'tract_counts')
+def get_summary(years=None):
+    # describe()-style table, computed once; for the full dataset it is kept on disk next to the cached parquet
+    if years:
+        return summary.summarize(get_data(years)).describe()
+    return summary.dataset_summary('tracts', get_data()).describe()
+
+@instrument.cached(st.cache_resource)
+@sharedcache.memoize('tract_counts')
+def get_stop_summary(years=None):
+    # the stops appended with `pipeline.py --append`, merged from one summary per batch and year
+    tract_counts = get_tract_counts()
+    merged = None if tract_counts is None else summary.stop_summary(tract_counts.batches, years)
+    return None if merged is None else merged.describe()
+
+@instrument.cached(st.cache_resource(max_entries=64))
+@sharedcache.memoize('tracts', 'tract_counts')
+def get_slope_interval(x_axis_val, y_axis_val, years=None):
+    # 95% pairs bootstrap interval for a trendline gradient
+    df = get_data(years)
+    return disparity.slope_interval(df[x_axis_val], df[y_axis_val], n_boot=BOOTSTRAP_REPLICATES, workers=None)
+
+@instrument.cached(st.cache_resource)
+@sharedcache.memoize('tracts')
+def get_tract_weights():
+    # queen contiguity of the statewide tracts, built once
+    import shapely
+
+    return spatial.contiguity(shapely.from_wkt(shared_data.get('tracts')['geometry'].to_numpy()), 'queen')
+
+@instrument.cached(st.cache_resource)
+@sharedcache.memoize('tracts')
+def get_tract_shapes():
+    # tract geometry as geojson for the hot spot map, serialized once
+    import geopandas as gpd
+    import shapely
+
+    import choropleth
+
+    tracts = shared_data.get('tracts')
+    return choropleth.tract_geojson(gpd.GeoDataFrame({'TractID': tracts['TractID']}, geometry=shapely.from_wkt(tracts['geometry'].to_numpy()), crs='EPSG:4326'))
+
+def spatial_variables(dataframe):
+    # stop counts, stop race percentages and the residuals of the race plot's trendlines
+    races = [race for race in RACE_OPTIONS if 'StopsPct' + race in dataframe.columns]
+    # the stop count column, by name or at its position in the published csv
+    stops = scatter.resolve_column(dataframe, 'NumStops')
+    return ([] if stops is None else [stops]) + (['StopsPct' + race for race in races]
+            + ['StopsPct' + race + ' residual' for race in races if 'TractPct' + race in dataframe.columns])
+
+def spatial_values(dataframe, fits, variable):
+    '''
+    values of a spatial_variables() entry per tract
+    input: tract dataframe, PairwiseOLS fits, variable ('StopsPct<race> residual' is StopsPct<race> less its OLS fit on TractPct<race>)
+    output: float array (nan where missing)
+    '''
+    if variable.endswith(' residual'):
+        y_axis_val = variable[:-len(' residual')]
+        x_axis_val = y_axis_val.replace('StopsPct', 'TractPct')
+        fit = fits.fit(x_axis_val, y_axis_val)
+        values = dataframe[y_axis_val] - (fit['intercept'] + fit['slope'] * dataframe[x_axis_val])
+    else:
+        values = dataframe[variable]
+    return values.to_numpy(dtype='float64')
+
+@instrument.cached(st.cache_resource(max_entries=64))
+@sharedcache.memoize('tracts', 'tract_counts')
+def get_autocorrelation(variable, years=None):
+    # LISA clusters, Gi* hot spots and global Moran's I of one variable
+    values = spatial_values(get_data(years), get_regression(years), variable)
+    return spatial.autocorrelation(values, get_tract_weights(), workers=None)
+
+@instrument.cached(st.cache_resource)
+@sharedcache.memoize('tracts', 'tract_counts')
+def get_moran_table(years=None):
+    # global Moran's I of every spatial variable
+    df, fits, weights = get_data(years), get_regression(years), get_tract_weights()
+    rows = []
+    for variable in spatial_variables(df):
+        values = spatial_values(df, fits, variable)
+        present = ~np.isnan(values)
+        rows.append({'variable': variable, **spatial.moran(values[present], weights.subset(present), workers=None)})
+    return pd.DataFrame(rows)
+
+@instrument.cached(st.cache_resource)
+def get_stop_groups():
+    # race code and county of every stop (stops are placed in the statewide tracts)
+    import shapely
+
+    import pipeline
+
+    stops = shared_data.get('stops')
+    tracts = shared_data.get('tracts')
+    tract = pipeline.assign_tracts(*stoptable.coordinates(stops), shapely.STRtree(shapely.from_wkt(tracts['geometry'].to_numpy())))
+    county = np.append(tracts['County'].to_numpy(dtype=object), None)[tract]
+    return pipeline.race_codes(stops['subject_race']), county
+
+@instrument.cached(st.cache_resource)
+@sharedcache.memoize('stops', 'tracts')
+def get_hit_rates(by_county=False):
+    stops = shared_data.get('stops')
+    race, county = get_stop_groups()
+    return disparity.hit_rates(stops['search_conducted'], stops['contraband_found'], race,
+                               county if by_county else None, n_boot=BOOTSTRAP_REPLICATES, workers=None)
+
+@instrument.cached(st.cache_resource(max_entries=16))
+@sharedcache.memoize('stops', 'tracts')
+def get_veil_of_darkness(minority, window_days=None):
+    stops = shared_data.get('stops')
+    race, _ = get_stop_groups()
+    lng, lat = stoptable.coordinates(stops)
+    return disparity.veil_of_darkness(stops['date_time'], lng, lat, race,
+                                      minority=minority, window_days=window_days, n_boot=BOOTSTRAP_REPLICATES, workers=None)
+
+def add_trendline(plot, dataframe, x_axis_val, y_axis_val, fit):
+    # draw the precomputed fit across the range of x covered by the pair
+    x = dataframe[x_axis_val].where(dataframe[y_axis_val].notna())
+    x_range = [x.min(), x.max()]
+    plot.add_trace(go.Scatter(x=x_range, y=[fit['intercept'] + fit['slope'] * v for v in x_range],
+                              mode='lines', line=dict(color='white'), name='OLS trendline',
+                              hovertemplate=f"y = {fit['slope']:.5f}x + {fit['intercept']:.5f}<br>R<sup>2</sup>={fit['rsquared']:.6f}<extra></extra>",
+                              showlegend=False))
+
+@instrument.timed()
+def build_plot(dataframe, fits, x_axis_val, y_axis_val, color, tickvals=None):
+    '''
+    tract scatter plot with its OLS trendline (shared by the interactive plots and batch.py)
+    input: tract dataframe, PairwiseOLS fits, x and y columns, marker colour, x-axis tick values (None for automatic)
+    output: plotly figure, number of tracts plotted, fit
+    '''
+    # only the columns the hover text needs are sent to the browser
+    plot, n_points = scatter.build_scatter(dataframe, x_axis_val, y_axis_val)
+    plot.update_traces(marker=dict(color=color))
+    plot.update_xaxes(tickvals=tickvals, showgrid=True, gridcolor='rgb(60,60,60)', gridwidth=1)
+
+    fit = fits.fit(x_axis_val, y_axis_val)
+    add_trendline(plot, dataframe, x_axis_val, y_axis_val, fit)
+    return plot, n_points, fit
+
+@instrument.timed()
+def correlation_heatmap(fits):
+    st.header('Correlation Heatmap')
+    st.write('Pearson correlation between every pair of numeric tract-level variables (pairs use the tracts where both variables are present).')
+    plot = px.imshow(fits.correlation(), zmin=-1, zmax=1, color_continuous_scale='RdBu_r', aspect='auto')
+    plot.update_layout(height=800)
+    with instrument.stage('plotly_chart') as record:
+        st.plotly_chart(plot)
+        record['bytes'] = instrument.render_size(plot)
+
+def stats(statistics, stop_statistics=None):
     st.header('Data Statistics')
-    st.write(dataframe.describe())
+    st.write('Quartiles are approximate (streaming quantile sketch).')
+    st.write(statistics)
+    if stop_statistics is not None:
+        st.subheader('Appended Stops')
+        st.write(stop_statistics)
 
 def data_header(dataframe):
     st.header('Data Header')
     st.write(dataframe.head())
 
-def interactive_race_plot(dataframe):
+@instrument.timed()
+def interactive_race_plot(dataframe, fits, years=None):
     st.write('The interactive scatterplot shows the relationship between two user-selected variables, aggregated by census tract. Each point represents a census tract in Washington state.')
     lock_race = st.checkbox('Lock the x- and y-axis races to be the same (recommended for comparison of traffic stop and tract population percentage for the same race; uncheck to compare different races for traffic stops and tract population)', value=True)
     if lock_race:
-        race_options = ['White', 'Black', 'Hispanic', 'AAPI', 'Other', 'BIPOC']
+        race_options = RACE_OPTIONS
         race_val = st.selectbox('Select race to plot on the x- and y-axes:', options=race_options)
         x_axis_val = 'TractPct' + race_val
         y_axis_val = 'StopsPct' + race_val
     else:
-        race_options = ['White', 'Black', 'Hispanic', 'AAPI', 'Other', 'BIPOC']
+        race_options = RACE_OPTIONS
         x_axis_race = st.selectbox('Select Tract % Race (x-axis)', options=race_options)
         y_axis_race = st.selectbox('Select Traffic Stops % Race (y-axis)', options=race_options)
         x_axis_val = 'TractPct' + x_axis_race
         y_axis_val = 'StopsPct' + y_axis_race
     col = st.color_picker('Select a color for the plot', '#039A3E')
 
-    plot = px.scatter(dataframe, x=x_axis_val, y=y_axis_val, trendline='ols',
-                      trendline_color_override='white',
-                      custom_data=dataframe)
-    
-    plot.data[0]['hovertemplate'] = ('<b>Point Data:</b><br>' +
-                                x_axis_val + ': %{x:.3f}<br>' + y_axis_val + ': %{y:.3f}<br>' +
-                               '----------------------------<br>' +
-                               '<b>Census Tract Data:</b><br>' +
-                               'Tract ID: %{customdata[0]}<br>' + 
-                               'County: %{customdata[20]}<br>' +
-                               'Population: %{customdata[21]}<br>' +
-                               'Median Age: %{customdata[22]}<br>' +
-                               'Median Income: $%{customdata[23]:,}/yr<br>' +
-                               'Number of Police Stops: %{customdata[1]}<br>' +
-                               '<br>'
-                               '% Below Poverty Line: %{customdata[2]:.1f}%<br>' +
-                               '% Bachelors Degree: %{customdata[25]:.1f}%<br>' +
-                               '% Male: %{customdata[19]:.1f}%<br>' +
-                               '<br>' +
-                               '% White: %{customdata[13]:.1f}%<br>' + 
-                               '% Black: %{customdata[14]:.1f}%<br>' + 
-                               '% Hispanic: %{customdata[15]:.1f}%<br>' + 
-                               '% Asian: %{customdata[16]:.1f}%<br>' + 
-                               '% Other: %{customdata[17]:.1f}%<br>' +
-                               '% BIPOC: %{customdata[18]:.1f}%<br><extra></extra>'
-                               )
-    plot.update_traces(marker=dict(color=col))
-    plot.update_xaxes(tickvals=[0, 10, 20, 30, 40, 50, 60, 70, 80, 90, 100], showgrid=True, gridcolor='rgb(60,60,60)', gridwidth=1)
-
-    results = px.get_trendline_results(plot)
+    plot, n_points, fit = build_plot(dataframe, fits, x_axis_val, y_axis_val, col, PERCENT_TICKS)
     
     # show the plot
-    st.plotly_chart(plot)
+    with instrument.stage('plotly_chart') as record:
+        st.plotly_chart(plot)
+        record['bytes'] = instrument.render_size(plot)
+    if n_points < len(dataframe):
+        st.caption(f'Showing a random sample of {n_points:,} of {len(dataframe):,} tracts; the trendline uses all of them.')
     
     # show the trendline equation
-    gradient = results.px_fit_results.iloc[0].params[1]
-    intercept = results.px_fit_results.iloc[0].params[0]
-    rsquared = results.px_fit_results.iloc[0].rsquared
+    gradient = fit['slope']
+    intercept = fit['intercept']
+    rsquared = fit['rsquared']
     st.write('The equation of the trendline is:')
     st.latex(f'y = {gradient:.3f}x + {intercept:.3f}')
+    interval = get_slope_interval(x_axis_val, y_axis_val, years)
+    st.write(f"95% bootstrap confidence interval for the gradient: [{interval['low']:.3f}, {interval['high']:.3f}] "
+             f"({BOOTSTRAP_REPLICATES:,} resamples of the {interval['n']:,} tracts).")
 
     if gradient < 1.0:
         st.write('''The expected gradient for exact proportionality is 1. Since the gradient is less than 1, this suggests that the overall percentage of traffic stops in
@@ -96,53 +259,29 @@ def interactive_race_plot(dataframe):
     st.write('''Despite all gradients in the interactive plot (by race) being less than 1, the variation in gradients suggests that there is still a racial disparity in traffic stop occurrence, with increasingly Black census tracts experiencing unequally increasing numbers of traffic stops for Black subjects, compared to other races. The extremely low gradient for the “Other” race category is also a notable result. One possible explanation for the lower gradient is that the race category predominantly comprises “Two or more races” and “Native American”. The trendline may be strongly influenced by census tracts with high Native American population percentage, which are located near or in tribal reservations, on which state patrols may not hold the same jurisdictional powers compared to tribal police departments.
 
 ''')
-def interactive_stops_plot(dataframe):
+@instrument.timed()
+def interactive_stops_plot(dataframe, fits):
     st.write('The interactive scatterplot shows the relationship between two user-selected variables, aggregated by census tract. Each point represents a census tract in Washington state.')
-    x_options = ['White', 'Black', 'Hispanic', 'AAPI', 'Other', 'BIPOC']
-    y_options = ['Searched', 'Frisked', 'ContrabandFound', 'Citation', 'Warning']
+    x_options = RACE_OPTIONS
+    y_options = ACTIVITY_OPTIONS
     x_axis_race = st.selectbox('Select Tract % Race (x-axis)', options=x_options)
     y_axis_activity = st.selectbox('Select Traffic Stop Activity Type (y-axis)', options=y_options)
     x_axis_val = 'TractPct' + x_axis_race
     y_axis_val = 'StopsPct' + y_axis_activity
     col = st.color_picker('Select a color for the plot', '#1AA5E0')
 
-    plot = px.scatter(dataframe, x=x_axis_val, y=y_axis_val, trendline='ols',
-                      trendline_color_override='white',
-                      custom_data=dataframe)
-    
-    plot.data[0]['hovertemplate'] = ('<b>Point Data:</b><br>' +
-                                x_axis_val + ': %{x:.3f}<br>' + y_axis_val + ': %{y:.3f}<br>' +
-                               '----------------------------<br>' +
-                               '<b>Census Tract Data:</b><br>' +
-                               'Tract ID: %{customdata[0]}<br>' + 
-                               'County: %{customdata[20]}<br>' +
-                               'Population: %{customdata[21]}<br>' +
-                               'Median Age: %{customdata[22]}<br>' +
-                               'Median Income: $%{customdata[23]:,}/yr<br>' +
-                               'Number of Police Stops: %{customdata[1]}<br>' +
-                               '<br>'
-                               '% Below Poverty Line: %{customdata[2]:.1f}%<br>' +
-                               '% Bachelors Degree: %{customdata[25]:.1f}%<br>' +
-                               '% Male: %{customdata[19]:.1f}%<br>' +
-                               '<br>' +
-                               '% White: %{customdata[13]:.1f}%<br>' + 
-                               '% Black: %{customdata[14]:.1f}%<br>' + 
-                               '% Hispanic: %{customdata[15]:.1f}%<br>' + 
-                               '% Asian: %{customdata[16]:.1f}%<br>' + 
-                               '% Other: %{customdata[17]:.1f}%<br>' +
-                               '% BIPOC: %{customdata[18]:.1f}%<br><extra></extra>'
-                               )
-    plot.update_traces(marker=dict(color=col))
-    plot.update_xaxes(tickvals=[0, 10, 20, 30, 40, 50, 60, 70, 80, 90, 100], showgrid=True, gridcolor='rgb(60,60,60)', gridwidth=1)
-
-    results = px.get_trendline_results(plot)
+    plot, n_points, fit = build_plot(dataframe, fits, x_axis_val, y_axis_val, col, PERCENT_TICKS)
     
     # show the plot
-    st.plotly_chart(plot)
+    with instrument.stage('plotly_chart') as record:
+        st.plotly_chart(plot)
+        record['bytes'] = instrument.render_size(plot)
+    if n_points < len(dataframe):
+        st.caption(f'Showing a random sample of {n_points:,} of {len(dataframe):,} tracts; the trendline uses all of them.')
     
     # show the trendline equation
-    gradient = results.px_fit_results.iloc[0].params[1]
-    intercept = results.px_fit_results.iloc[0].params[0]
+    gradient = fit['slope']
+    intercept = fit['intercept']
 
     st.write(f'The equation of the trendline is:')
     st.latex(f'y = {gradient:.5f}x + {intercept:.5f}')
@@ -165,7 +304,8 @@ def interactive_stops_plot(dataframe):
     st.write('''A second type of scatter plot is presented on the interactive plot (by stop activity) section, where the tract population percentage by race is plotted against the percentage of five different stop activities: a search being conducted, a frisk being performed, contraband being found, a citation being issued, and a warning being issued. For equality of outcome, one would expect the trendline gradient to be zero (i.e., no impact of increasing percentage of population of a particular race on traffic stop activity). This is largely the case; gradients are very close to zero for all races and all stop activities, though there are some situations where gradients for the same activity type still differ between two races by an order of magnitude. This means that some amount of racial disparity still exists in whether particular types of activities occur during a traffic stop.
 ''')
 
-def interactive_all_plot(dataframe):
+@instrument.timed()
+def interactive_all_plot(dataframe, fits):
     st.write('The interactive scatterplot shows the relationship between two user-selected variables, aggregated by census tract. Each point represents a census tract in Washington state.')
     options_list = list(dataframe.columns.values)
     options_list.remove('TractID')
@@ -178,75 +318,162 @@ def interactive_all_plot(dataframe):
     y_axis_val = st.selectbox('Select Y-Axis Variable', options=y_options)
     col = st.color_picker('Select a color for the plot', '#E4C41C')
 
-    plot = px.scatter(dataframe, x=x_axis_val, y=y_axis_val, trendline='ols',
-                      trendline_color_override='white',
-                      custom_data=dataframe)
-    
-    plot.data[0]['hovertemplate'] = ('<b>Point Data:</b><br>' +
-                                x_axis_val + ': %{x:.3f}<br>' + y_axis_val + ': %{y:.3f}<br>' +
-                               '----------------------------<br>' +
-                               '<b>Census Tract Data:</b><br>' +
-                               'Tract ID: %{customdata[0]}<br>' + 
-                               'County: %{customdata[20]}<br>' +
-                               'Population: %{customdata[21]}<br>' +
-                               'Median Age: %{customdata[22]}<br>' +
-                               'Median Income: $%{customdata[23]:,}/yr<br>' +
-                               'Number of Police Stops: %{customdata[1]}<br>' +
-                               '<br>'
-                               '% Below Poverty Line: %{customdata[2]:.1f}%<br>' +
-                               '% Bachelors Degree: %{customdata[25]:.1f}%<br>' +
-                               '% Male: %{customdata[19]:.1f}%<br>' +
-                               '<br>' +
-                               '% White: %{customdata[13]:.1f}%<br>' + 
-                               '% Black: %{customdata[14]:.1f}%<br>' + 
-                               '% Hispanic: %{customdata[15]:.1f}%<br>' + 
-                               '% Asian: %{customdata[16]:.1f}%<br>' + 
-                               '% Other: %{customdata[17]:.1f}%<br>' +
-                               '% BIPOC: %{customdata[18]:.1f}%<br><extra></extra>'
-                               )
-    plot.update_traces(marker=dict(color=col))
-    plot.update_xaxes(showgrid=True, gridcolor='rgb(60,60,60)', gridwidth=1)
-
-    results = px.get_trendline_results(plot)
+    plot, n_points, fit = build_plot(dataframe, fits, x_axis_val, y_axis_val, col)
     
     # show the plot
-    st.plotly_chart(plot)
+    with instrument.stage('plotly_chart') as record:
+        st.plotly_chart(plot)
+        record['bytes'] = instrument.render_size(plot)
+    if n_points < len(dataframe):
+        st.caption(f'Showing a random sample of {n_points:,} of {len(dataframe):,} tracts; the trendline uses all of them.')
     
     # show the trendline equation
-    gradient = results.px_fit_results.iloc[0].params[1]
-    intercept = results.px_fit_results.iloc[0].params[0]
+    gradient = fit['slope']
+    intercept = fit['intercept']
 
     st.write(f'The equation of the trendline is:')
     st.latex(f'y = {gradient:.5f}x + {intercept:.5f}')
 
-# Page begins here
-        
-df = get_data()
+@instrument.timed()
+def disparity_tests():
+    st.header('Disparity Tests')
+    st.write('Both tests use the individual stops rather than the tract aggregates. Intervals are 95% bootstrap confidence intervals.')
 
-st.title('Tract-level Aggregate Analysis')
-st.subheader('Correlation Between Traffic Stop Subject and Location')
+    st.subheader('Outcome Test (Search Hit Rates)')
+    st.write('''The hit rate is the share of searches that found contraband. If searches of one race find contraband less often than searches of another,
+                officers may be searching that race on weaker evidence.''')
+    by_county = st.checkbox('Split by county')
+    rates = get_hit_rates(by_county)
+    if by_county:
+        counties = sorted(rates['group'].dropna().unique())
+        picked = st.multiselect('Counties', counties, default=counties[:5])
+        rates = rates[rates['group'].isin(picked)]
+    plot = px.bar(rates, x='race', y='hit_rate', color='group' if by_county else None, barmode='group',
+                  error_y=rates['high'] - rates['hit_rate'], error_y_minus=rates['hit_rate'] - rates['low'],
+                  labels=dict(race='Subject Race', hit_rate='Hit Rate', group='County'),
+                  hover_data=['searches', 'hits'])
+    with instrument.stage('plotly_chart') as record:
+        st.plotly_chart(plot)
+        record['bytes'] = instrument.render_size(plot)
 
-st.write('''
-The correlation between traffic stop subject and location was analyzed using a scatter plot and ordinary least squares regression. The traffic stops data that was aggregated by census tract was plotted against characteristics of the census tract itself, and is presented on the StopScatterPlot page of this app.
-''')
-st.sidebar.title('Navigation')
-
-options = st.sidebar.radio('Page Options', options=[
-'Home', 
-'Data Statistics', 
-'Data Header', 
-'Interactive Plot (by Race)',
-'Interactive Plot (by Stop Activity)',
-'Interactive Plot (All)'
-])
-
-if options == 'Data Statistics':
-    stats(df)
-elif options == 'Data Header':
-    data_header(df)
-elif options == 'Interactive Plot (by Race)':
-    interactive_race_plot(df)
-elif options == 'Interactive Plot (by Stop Activity)':
-    interactive_stops_plot(df)
-elif options == 'Interactive Plot (All)':
-    interactive_all_plot(df)
\ No newline at end of file
+    st.subheader('Veil of Darkness')
+    st.write('''Officers can see a driver's race less easily after dark. Comparing stops made at the same clock time on dates when it is already
+                dark and dates when it is still light, a smaller share of minority drivers after dark suggests race played a part in daylight stops.
+                The comparison is limited to evening clock times that are dark on some dates and light on others; daylight saving moves dusk by an hour overnight.''')
+    minority = st.selectbox('Compare drivers (against White)', ['Black', 'Hispanic', 'AAPI'])
+    window = st.selectbox('Dates used', [None, 14, 30, 60],
+                          format_func=lambda days: 'Whole year' if days is None else f'{days} days either side of a daylight saving change')
+    result = get_veil_of_darkness(minority, window)
+    if result['stops'] == 0:
+        st.write('No stops fall in the comparison window.')
+        return
+    st.write(f"Odds ratio for a stop being of a {minority} driver after dark vs in daylight: **{result['odds_ratio']:.3f}** "
+             f"(95% CI {result['low']:.3f} to {result['high']:.3f}; {result['stops']:,} stops, {result['dark']:.0%} after dusk).")
+    if result['high'] < 1:
+        st.write(f'The interval is below 1: {minority} drivers make up a smaller share of stops once it is dark, consistent with a disparity in daylight stops.')
+    elif result['low'] > 1:
+        st.write(f'The interval is above 1: {minority} drivers make up a larger share of stops after dark.')
+    else:
+        st.write('The interval includes 1, so there is no clear evidence of a difference between light and dark.')
+
+@instrument.timed()
+def spatial_autocorrelation(dataframe, years=None):
+    st.header('Spatial Autocorrelation')
+    st.write(f'''The scatter plots treat tracts as independent points. Moran's I asks whether similar values sit next to each other instead: it is near 0
+                when values are spatially random and positive when they cluster. Tracts are neighbours when they share a boundary (queen contiguity),
+                and p-values come from {spatial.PERMUTATIONS} random permutations of the values across tracts.''')
+    st.dataframe(get_moran_table(years).rename(columns={'expected': 'expected I', 'p': 'pseudo p', 'n': 'tracts'}), hide_index=True)
+
+    variable = st.selectbox('Variable', spatial_variables(dataframe),
+                            help="A residual is the stop percentage less the race plot's OLS trendline; clustered residuals point to places the tract population does not explain.")
+    statistic = st.radio('Local statistic', ['hotspot', 'lisa_cluster'], horizontal=True,
+                         format_func={'hotspot': 'Getis-Ord Gi* hot spots', 'lisa_cluster': 'LISA clusters'}.get)
+    frame, global_moran = get_autocorrelation(variable, years)
+    st.write(f"Global Moran's I: **{global_moran['I']:.3f}** (expected {global_moran['expected']:.3f} without autocorrelation; "
+             f"z = {global_moran['z']:.1f}, pseudo p = {global_moran['p']:.3f}).")
+    st.write(frame[statistic].value_counts().rename('tracts'))
+    if statistic == 'hotspot':
+        st.caption('Red: hot spots, tracts whose neighbourhood (the tract and its neighbours) has unusually high values; blue: cold spots. p < 0.05.')
+    else:
+        st.caption('Red: High-High clusters, blue: Low-Low clusters, orange: high tracts among low neighbours, light blue: low tracts among high neighbours. p < 0.05.')
+
+    import folium
+    from streamlit_folium import st_folium
+
+    m = folium.Map(location=[47.4, -120.5], zoom_start=7, prefer_canvas=True)
+    spatial.hotspot_layer(get_tract_shapes(), frame, variable, statistic).add_to(m)
+    with st.form(key='hotspot_map'):
+        st.form_submit_button(disabled=True)
+        with instrument.stage('st_folium') as record:
+            st_folium(m, width=700, height=500)
+            record['bytes'] = instrument.render_size(m)
+
+    plot = px.scatter(frame.assign(TractID=dataframe['TractID'].to_numpy()), x='value', y='lag', color='lisa_cluster',
+                      color_discrete_map={**spatial.HOTSPOT_COLORS, 'Not significant': 'lightgray'},
+                      labels=dict(value=variable, lag='Mean of neighbouring tracts', lisa_cluster='LISA cluster'),
+                      hover_data=['TractID', 'lisa_p'], title='Moran scatter plot')
+    with instrument.stage('plotly_chart') as record:
+        st.plotly_chart(plot)
+        record['bytes'] = instrument.render_size(plot)
+
+def prewarm():
+    # fill the caches the default view needs, with the arguments main() passes (see prewarm.py)
+    tract_counts = get_tract_counts()
+    # every stop year is selected by default
+    years = tuple(sorted(tract_counts.years)) if tract_counts is not None and tract_counts.years else None
+    get_regression(years)
+    get_summary(years)
+    get_stop_summary(years)
+
+def main():
+    instrument.start_run('StopScatterPlot')
+    tract_counts = get_tract_counts()
+    years = None
+    if tract_counts is not None and tract_counts.years:
+        year_options = sorted(tract_counts.years)
+        years = st.sidebar.multiselect('Stop Years', options=year_options, default=year_options,
+                                       format_func=lambda year: 'Unknown' if year == aggregates.UNKNOWN_YEAR else str(year))
+    years = tuple(years) if years else None
+    df = get_data(years)
+    fits = get_regression(years)
+
+    st.title('Tract-level Aggregate Analysis')
+    st.subheader('Correlation Between Traffic Stop Subject and Location')
+
+    st.write('''
+    The correlation between traffic stop subject and location was analyzed using a scatter plot and ordinary least squares regression. The traffic stops data that was aggregated by census tract was plotted against characteristics of the census tract itself, and is presented on the StopScatterPlot page of this app.
+    ''')
+    st.sidebar.title('Navigation')
+
+    options = st.sidebar.radio('Page Options', options=[
+    'Home', 
+    'Data Statistics', 
+    'Data Header', 
+    'Interactive Plot (by Race)',
+    'Interactive Plot (by Stop Activity)',
+    'Interactive Plot (All)',
+    'Correlation Heatmap',
+    'Spatial Autocorrelation',
+    'Disparity Tests'
+    ])
+
+    if options == 'Data Statistics':
+        stats(get_summary(years), get_stop_summary(years))
+    elif options == 'Data Header':
+        data_header(df)
+    elif options == 'Interactive Plot (by Race)':
+        interactive_race_plot(df, fits, years)
+    elif options == 'Interactive Plot (by Stop Activity)':
+        interactive_stops_plot(df, fits)
+    elif options == 'Interactive Plot (All)':
+        interactive_all_plot(df, fits)
+    elif options == 'Correlation Heatmap':
+        correlation_heatmap(fits)
+    elif options == 'Spatial Autocorrelation':
+        spatial_autocorrelation(df, years)
+    elif options == 'Disparity Tests':
+        disparity_tests()
+    instrument.debug_panel()
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
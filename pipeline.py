@@ -0,0 +1,260 @@
+'''
+build the tract-level aggregate (the scatter page's StopsPct* columns) and the HappenIn relation from raw stops
+
+usage: python pipeline.py STOPS_CSV [--out tracts.csv] [--happen-in happen_in.csv] [--workers N] [--chunk-size N]
+       python pipeline.py STOPS_CSV --append [--store tract_counts.npz]
+'''
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import shapely
+
+import aggregates
+import summary
+from aggregates import RACE_LABELS
+
+# subject_race values -> race label used in the aggregate columns; anything else counts as Other
+RACES = {
+    'white': 'White',
+    'black': 'Black',
+    'hispanic': 'Hispanic',
+    'asian/pacific islander': 'AAPI',
+}
+
+# stop flag columns, in aggregates.ACTIVITY_LABELS order
+ACTIVITIES = {
+    'search_conducted': 'Searched',
+    'frisk_performed': 'Frisked',
+    'contraband_found': 'ContrabandFound',
+    'citation_issued': 'Citation',
+    'warning_issued': 'Warning',
+}
+
+_tree = None
+
+
+def read_stop_chunks(path, chunk_size=200_000):
+    '''
+    stream a raw stop csv
+    input: path, rows per chunk
+    output: iterator of dataframes
+    '''
+    return pd.read_csv(path, chunksize=chunk_size)
+
+
+def stop_coordinates(chunk):
+    '''
+    longitude / latitude of a chunk of stops
+    input: dataframe with lng/lat columns or a wkt geometry column
+    output: lon, lat float arrays
+    '''
+    if 'lng' in chunk.columns and 'lat' in chunk.columns:
+        return chunk['lng'].to_numpy(dtype='float64'), chunk['lat'].to_numpy(dtype='float64')
+    points = shapely.from_wkt(chunk['geometry'].to_numpy())
+    return shapely.get_x(points), shapely.get_y(points)
+
+
+def race_codes(subject_race):
+    '''
+    index into RACE_LABELS for each stop
+    input: subject_race series
+    output: integer array
+    '''
+    lookup = {value: RACE_LABELS.index(label) for value, label in RACES.items()}
+    other = RACE_LABELS.index('Other')
+    # map the distinct values only (works the same for strings and categoricals); missing values are 'Other'
+    codes, uniques = pd.factorize(subject_race)
+    mapped = np.array([lookup.get(value, other) for value in uniques] + [other], dtype='int64')
+    return mapped[codes]
+
+
+def _init_worker(tract_wkb):
+    global _tree
+    _tree = shapely.STRtree(shapely.from_wkb(tract_wkb))
+
+
+def assign_tracts(lon, lat, tree=None):
+    '''
+    tract index for each stop point
+    input: longitude, latitude arrays, STRtree over tract polygons (defaults to the worker's tree)
+    output: integer array, -1 where the stop is outside every tract
+    '''
+    tree = _tree if tree is None else tree
+    points = shapely.points(lon, lat)
+    point_index, tract_index = tree.query(points, predicate='within')
+    out = np.full(len(points), -1, dtype='int64')
+    out[point_index] = tract_index
+    return out
+
+
+def stop_years(chunk):
+    '''
+    year of each stop
+    input: dataframe with a date_time or date column
+    output: integer array, aggregates.UNKNOWN_YEAR where the date is missing or cannot be parsed
+    '''
+    column = 'date_time' if 'date_time' in chunk.columns else 'date'
+    years = pd.to_datetime(chunk[column], errors='coerce').dt.year
+    return years.fillna(aggregates.UNKNOWN_YEAR).to_numpy(dtype='int64')
+
+
+def count_chunk(chunk, n_tracts, tree=None):
+    '''
+    spatially join a chunk of stops and count them per tract, year and race
+    input: dataframe of stops, number of tracts, STRtree (defaults to the worker's tree)
+    output: dict of year -> (n_tracts, races, measures) counts (see aggregates), tract index per stop
+
+    stops without a year are counted under aggregates.UNKNOWN_YEAR.
+    '''
+    tract = assign_tracts(*stop_coordinates(chunk), tree=tree)
+    inside = tract >= 0
+    n_races = len(RACE_LABELS)
+    years, year_index = np.unique(stop_years(chunk)[inside], return_inverse=True)
+    cell = (year_index * n_tracts + tract[inside]) * n_races + race_codes(chunk['subject_race'])[inside]
+    size = len(years) * n_tracts * n_races
+    counts = np.empty((len(years), n_tracts, n_races, len(aggregates.MEASURES)), dtype='int64')
+    counts[..., 0] = np.bincount(cell, minlength=size).reshape(len(years), n_tracts, n_races)
+    for j, column in enumerate(ACTIVITIES, start=1):
+        flags = chunk[column].fillna(False).to_numpy(dtype=bool)[inside]
+        counts[..., j] = np.bincount(cell, weights=flags, minlength=size).reshape(len(years), n_tracts, n_races)
+    return {int(year): counts[i] for i, year in enumerate(years)}, tract
+
+
+def _count_worker(args):
+    chunk, n_tracts = args
+    return count_chunk(chunk, n_tracts)
+
+
+def join_stops(chunks, tract_geometry, workers=None, happen_in=None):
+    '''
+    spatially join streamed stops to tracts on several cores
+    input: iterator of stop dataframes, tract geometry array, number of processes,
+           optional callback(chunk, tract index per stop) for writing the HappenIn relation
+    output: dict of year -> (n_tracts, races, measures) counts
+
+    at most two chunks per worker are in flight, so memory stays flat however many stops there are.
+    '''
+    workers = workers or os.cpu_count() or 1
+    n_tracts = len(tract_geometry)
+    total = {}
+    tract_wkb = shapely.to_wkb(np.asarray(tract_geometry))
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(tract_wkb,)) as executor:
+        pending = []
+        for chunk in chunks:
+            pending.append((chunk, executor.submit(_count_worker, (chunk, n_tracts))))
+            if len(pending) >= 2 * workers:
+                _add_counts(total, _collect(pending.pop(0), happen_in))
+        while pending:
+            _add_counts(total, _collect(pending.pop(0), happen_in))
+    return total
+
+
+def _add_counts(total, counts):
+    for year, array in counts.items():
+        if year in total:
+            total[year] += array
+        else:
+            total[year] = array
+
+
+def _collect(item, happen_in):
+    chunk, future = item
+    counts, tract = future.result()
+    if happen_in is not None:
+        happen_in(chunk, tract)
+    return counts
+
+
+def build_tract_aggregate(chunks, census_gdf, workers=None, happen_in=None):
+    '''
+    tract aggregate for a stream of stops
+    input: iterator of stop dataframes, census tract geodataframe, processes, HappenIn callback
+    output: census tract attributes joined with the stop percentages
+    '''
+    counts = aggregates.TractCounts(census_gdf['TractID'].to_numpy())
+    counts.merge(join_stops(chunks, census_gdf.geometry.values, workers=workers, happen_in=happen_in))
+    stops = counts.percentages()
+    return stops.merge(census_gdf.drop(columns='geometry'), on='TractID', how='left')
+
+
+def append_batch(chunks, census_gdf, batch_id, path=aggregates.STORE_PATH, workers=None, happen_in=None):
+    '''
+    merge a new batch of stops (e.g. another year or department) into the persisted tract counts
+    input: iterator of stop dataframes, census tract geodataframe, batch id, store path, processes, HappenIn callback
+    output: TractCounts, or None if the batch was already merged
+
+    only the new stops are joined and counted; the existing counts are just added to. the batch's numeric
+    stop columns are summarized per year on the way (summary.append_to_summary), for the Data Statistics page.
+    '''
+    store = aggregates.load_store(path)
+    if store is None:
+        store = aggregates.TractCounts(census_gdf['TractID'].to_numpy())
+    elif batch_id in store.batches:
+        return None
+    chunks = summary.append_to_summary(chunks, batch_id, stop_years, path)
+    store.merge(join_stops(chunks, census_gdf.geometry.values, workers=workers, happen_in=happen_in), batch_id)
+    store.save(path)
+    return store
+
+
+def happen_in_writer(path, tract_ids):
+    '''
+    callback that appends (StopID, TractID) rows for every joined chunk
+    input: output csv path, tract ids
+    output: callback for join_stops
+
+    StopID is the stop's row number in the source file.
+    '''
+    state = {'offset': 0}
+    if os.path.exists(path):
+        os.remove(path)
+
+    def write(chunk, tract):
+        stop_ids = np.arange(state['offset'], state['offset'] + len(chunk))
+        state['offset'] += len(chunk)
+        inside = tract >= 0
+        pairs = pd.DataFrame({'StopID': stop_ids[inside], 'TractID': tract_ids[tract[inside]]})
+        pairs.to_csv(path, mode='a', header=not os.path.exists(path), index=False)
+
+    return write
+
+
+def main():
+    import datastore
+
+    parser = argparse.ArgumentParser(description='Build the tract-level stop aggregate from raw stops.')
+    parser.add_argument('stops', help='raw stop csv (lng/lat columns or wkt geometry)')
+    parser.add_argument('--out', default='tracts.csv', help='output csv for the tract aggregate')
+    parser.add_argument('--happen-in', help='optional output csv for the HappenIn relation')
+    parser.add_argument('--workers', type=int, default=None, help='processes (default: all cores)')
+    parser.add_argument('--chunk-size', type=int, default=200_000, help='stops per chunk')
+    parser.add_argument('--append', action='store_true', help='merge the stops into the tract count store instead of writing --out')
+    parser.add_argument('--store', default=aggregates.STORE_PATH, help='tract count store used by --append')
+    args = parser.parse_args()
+
+    census_gdf = datastore.load('census')
+    happen_in = None
+    if args.happen_in:
+        happen_in = happen_in_writer(args.happen_in, census_gdf['TractID'].to_numpy())
+    chunks = read_stop_chunks(args.stops, args.chunk_size)
+    if args.append:
+        store = append_batch(chunks, census_gdf, datastore.file_hash(args.stops), args.store,
+                             workers=args.workers, happen_in=happen_in)
+        if store is None:
+            print('batch already merged')
+            return
+        print(f'years in store: {sorted(store.years)}')
+        unknown = int(store.total([aggregates.UNKNOWN_YEAR])[..., 0].sum())
+        if unknown:
+            print(f'stops without a readable date (counted under year {aggregates.UNKNOWN_YEAR}): {unknown:,}')
+        return
+    aggregate = build_tract_aggregate(chunks, census_gdf,
+                                      workers=args.workers, happen_in=happen_in)
+    aggregate.to_csv(args.out, index=False)
+
+
+if __name__ == '__main__':
+    main()
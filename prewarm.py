@@ -0,0 +1,116 @@
+'''
+fill the app's caches before the first visitor does
+
+usage: python prewarm.py                     build the on-disk caches (downloads, parquet, summaries, cube,
+                                             database) and exit, e.g. as a deploy step
+       python prewarm.py --serve [ARGS ...]  run the app (`streamlit run main.py ARGS`) in this process and warm
+                                             its in-memory caches in the background from server start
+
+warming imports the map and plotting libraries, loads the shared datasets with their derived columns, and
+calls each page's prewarm(), which fills that page's caches for its default view. main.py also calls
+start(), so a plain `streamlit run main.py` warms up while the first visitor reads the home page.
+'''
+import argparse
+import importlib
+import importlib.util
+import logging
+import os
+import sys
+import threading
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+LOGGER = logging.getLogger('stopstats.prewarm')
+
+# pages with a prewarm() function, in the order they are warmed
+PAGES = ['2_StopByRaceMap.py', '3_StopByTimeMap.py', '4_StopScatterPlot.py']
+# libraries the pages import on first use
+MODULES = ['folium', 'branca', 'streamlit_folium', 'plotly.express', 'shapely', 'pyarrow.parquet']
+
+_thread = None
+_lock = threading.Lock()
+
+
+def load_page(filename, module_name=None):
+    '''
+    import a streamlit page as a module (its main() is not run)
+    input: file name under pages/, module name to register it as (default: from the file name)
+    output: module
+    '''
+    module_name = module_name or 'page_' + os.path.splitext(filename)[0].lower()
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(ROOT, 'pages', filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def warm(pages=PAGES):
+    '''
+    fill the caches, in this process and on disk
+    input: page file names whose prewarm() to call
+    output: none
+    '''
+    import datastore
+    import instrument
+    import shared_data
+
+    with instrument.stage('prewarm'):
+        with instrument.stage('imports'):
+            for name in MODULES:
+                try:
+                    importlib.import_module(name)
+                except ImportError:
+                    pass
+        # downloads and parquet builds overlap
+        datastore.prepare(*shared_data.DERIVED)
+        for name, columns in shared_data.DERIVED.items():
+            shared_data.get(name)
+            for column in columns:
+                shared_data.derived(name, column)
+        for filename in pages:
+            with instrument.stage('prewarm_page', page=filename):
+                load_page(filename).prewarm()
+
+
+def _warm_in_background():
+    try:
+        warm()
+    except Exception:
+        # the pages build whatever is missing on demand, so a failed warm-up only costs time
+        LOGGER.exception('pre-warming failed')
+
+
+def start():
+    '''
+    warm the caches from a background thread, once per process
+    input: none
+    output: the warming thread
+    '''
+    global _thread
+    with _lock:
+        if _thread is None:
+            _thread = threading.Thread(target=_warm_in_background, name='prewarm', daemon=True)
+            _thread.start()
+    return _thread
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fill the app's caches before the first visitor.")
+    parser.add_argument('--serve', action='store_true',
+                        help='run the app in this process and warm it in the background; other arguments go to `streamlit run`')
+    args, streamlit_args = parser.parse_known_args()
+
+    if not args.serve:
+        if streamlit_args:
+            parser.error(f"unrecognized arguments: {' '.join(streamlit_args)}")
+        warm()
+        return
+
+    from streamlit.web import cli
+
+    start()
+    sys.argv = ['streamlit', 'run', os.path.join(ROOT, 'main.py'), *streamlit_args]
+    sys.exit(cli.main())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+
+
+class PairwiseOLS:
+    '''
+    simple linear regression of every numeric column on every other, in one pass
+    input: dataframe (non-numeric columns are ignored)
+
+    sums of x, y, x^2, y^2 and xy over the rows where both columns are present come from a few
+    matrix products with the missing-value mask, so NaNs are dropped pairwise exactly as fitting
+    each pair separately would. results are looked up with fit(x, y).
+    '''
+
+    def __init__(self, dataframe):
+        numeric = dataframe.select_dtypes('number')
+        self.columns = list(numeric.columns)
+        self._index = {column: i for i, column in enumerate(self.columns)}
+        values = numeric.to_numpy(dtype='float64')
+        present = ~np.isnan(values)
+        # centre each column first to keep the sums well conditioned
+        means = np.nanmean(np.where(present.any(axis=0), values, 0.0), axis=0)
+        centred = np.where(present, values - means, 0.0)
+        mask = present.astype('float64')
+
+        n = mask.T @ mask
+        sx = centred.T @ mask            # [i, j]: sum of column i where i and j are both present
+        sxx = (centred ** 2).T @ mask
+        sxy = centred.T @ centred
+        sy, syy = sx.T, sxx.T
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            cov = n * sxy - sx * sy
+            var_x = n * sxx - sx ** 2
+            var_y = n * syy - sy ** 2
+            slope = cov / var_x
+            # intercept back in the original (uncentred) units
+            intercept = (sy - slope * sx) / n + means[None, :] - slope * means[:, None]
+            r = cov / np.sqrt(var_x * var_y)
+
+        self.n = n.astype('int64')
+        self.slope = slope
+        self.intercept = intercept
+        self.r = np.clip(r, -1.0, 1.0)
+
+    def fit(self, x, y):
+        '''
+        regression of y on x
+        input: column names
+        output: dict with slope, intercept, rsquared and n
+        '''
+        i, j = self._index[x], self._index[y]
+        return {
+            'slope': float(self.slope[i, j]),
+            'intercept': float(self.intercept[i, j]),
+            'rsquared': float(self.r[i, j] ** 2),
+            'n': int(self.n[i, j]),
+        }
+
+    def correlation(self):
+        '''
+        pairwise pearson correlation matrix
+        input: none
+        output: dataframe indexed by column on both axes
+        '''
+        return pd.DataFrame(self.r, index=self.columns, columns=self.columns)
@@ -0,0 +1,106 @@
+import re
+
+import plotly_express as px
+
+import instrument
+
+# hover text for tract scatter plots; {Column} / {Column:format} are filled from that tract's row
+HOVER_LINES = [
+    '<b>Census Tract Data:</b>',
+    'Tract ID: {TractID}',
+    'County: {County}',
+    'Population: {Population}',
+    'Median Age: {MedianAge}',
+    'Median Income: ${MedianIncome:,}/yr',
+    'Number of Police Stops: {NumStops}',
+    '',
+    '% Below Poverty Line: {PctPoverty:.1f}%',
+    '% Bachelors Degree: {PctBachelors:.1f}%',
+    '% Male: {PctMale:.1f}%',
+    '',
+    '% White: {TractPctWhite:.1f}%',
+    '% Black: {TractPctBlack:.1f}%',
+    '% Hispanic: {TractPctHispanic:.1f}%',
+    '% Asian: {TractPctAAPI:.1f}%',
+    '% Other: {TractPctOther:.1f}%',
+    '% BIPOC: {TractPctBIPOC:.1f}%',
+]
+
+# where the published tract aggregate csv keeps the columns it does not name as above
+LEGACY_POSITIONS = {
+    'NumStops': 1,
+    'PctPoverty': 2,
+    'PctMale': 19,
+    'County': 20,
+    'Population': 21,
+    'MedianAge': 22,
+    'MedianIncome': 23,
+    'PctBachelors': 25,
+}
+
+# above this many points plots switch to webgl (scattergl)
+WEBGL_THRESHOLD = 5_000
+# above this many points plots are downsampled (0 disables)
+MAX_POINTS = 50_000
+
+_PLACEHOLDER = re.compile(r'\{(\w+)(:[^}]*)?\}')
+
+
+def resolve_column(dataframe, name):
+    '''
+    actual column for a hover field
+    input: dataframe, field name
+    output: the column of that name, else the column at its legacy position, else None
+    '''
+    if name in dataframe.columns:
+        return name
+    position = LEGACY_POSITIONS.get(name)
+    if position is not None and position < len(dataframe.columns):
+        return dataframe.columns[position]
+    return None
+
+
+def hover_template(dataframe, x_axis_val, y_axis_val, lines=HOVER_LINES):
+    '''
+    hover template with customdata indices resolved from column names
+    input: dataframe, x and y columns, hover lines
+    output: hovertemplate string, list of columns to send as custom_data (in customdata order)
+
+    lines whose columns cannot be found are left out.
+    '''
+    columns = []
+    body = []
+    for line in lines:
+        names = [match.group(1) for match in _PLACEHOLDER.finditer(line)]
+        resolved = {name: resolve_column(dataframe, name) for name in names}
+        if None in resolved.values():
+            continue
+        for column in resolved.values():
+            if column not in columns:
+                columns.append(column)
+        body.append(_PLACEHOLDER.sub(
+            lambda match: '%{customdata[' + str(columns.index(resolved[match.group(1)])) + ']' + (match.group(2) or '') + '}',
+            line))
+    body = '<br>'.join(body)
+    template = ('<b>Point Data:</b><br>' +
+                x_axis_val + ': %{x:.3f}<br>' + y_axis_val + ': %{y:.3f}<br>' +
+                '----------------------------<br>' +
+                body + '<br><extra></extra>')
+    return template, columns
+
+
+@instrument.timed()
+def build_scatter(dataframe, x_axis_val, y_axis_val, max_points=MAX_POINTS, webgl_threshold=WEBGL_THRESHOLD):
+    '''
+    tract scatter plot that only ships the columns its hover text uses
+    input: dataframe, x and y columns, downsampling limit (0 for none), point count above which to use webgl
+    output: plotly figure, number of tracts plotted
+    '''
+    template, columns = hover_template(dataframe, x_axis_val, y_axis_val)
+    data = dataframe[list(dict.fromkeys([x_axis_val, y_axis_val] + columns))]
+    if max_points and len(data) > max_points:
+        data = data.sample(max_points, random_state=0)
+    plot = px.scatter(data, x=x_axis_val, y=y_axis_val, custom_data=columns,
+                      render_mode='webgl' if len(data) > webgl_threshold else 'svg')
+    plot.data[0]['hovertemplate'] = template
+    return plot, len(data)
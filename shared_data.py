@@ -0,0 +1,95 @@
+import threading
+
+import pandas as pd
+
+import datastore
+import instrument
+
+# views handed to pages are shallow copies; copy-on-write keeps a page's edits out of the shared frame
+# (always on from pandas 3, where the option is deprecated)
+if int(pd.__version__.split('.')[0]) < 3:
+    pd.set_option('mode.copy_on_write', True)
+
+# per-page derived columns, computed on first request and then shared
+DERIVED = {
+    'census': {
+        'geometry_simplified': lambda df: df['geometry'].simplify(0.0001),
+    },
+    'stops': {
+        'time_of_day': lambda df: df['date_time'].dt.hour.fillna(-1).astype('int8'),
+    },
+    'tracts': {},
+}
+
+_frames = {}
+_derived = {}
+_locks = {name: threading.Lock() for name in DERIVED}
+
+
+def get(name):
+    '''
+    load a dataset once per process
+    input: dataset name ('census', 'stops' or 'tracts')
+    output: the shared (geo)dataframe; do not modify it, use view() instead
+    '''
+    frame = _frames.get(name)
+    if frame is None:
+        with _locks[name]:
+            frame = _frames.get(name)
+            if frame is None:
+                with instrument.stage('load', dataset=name):
+                    frame = datastore.load(name)
+                _frames[name] = frame
+    return frame
+
+
+def derived(name, column):
+    '''
+    get a derived column of a dataset, computing it on first use
+    input: dataset name, derived column name (see DERIVED)
+    output: series aligned with the shared frame
+    '''
+    key = (name, column)
+    series = _derived.get(key)
+    if series is None:
+        frame = get(name)
+        with _locks[name]:
+            series = _derived.get(key)
+            if series is None:
+                with instrument.stage('derive', dataset=name, column=column):
+                    series = DERIVED[name][column](frame)
+                _derived[key] = series
+    return series
+
+
+def view(name, *columns):
+    '''
+    read-only view of a dataset with extra derived columns attached
+    input: dataset name, names of derived columns to add
+    output: shallow copy of the shared frame (no data is copied)
+    '''
+    frame = get(name).copy(deep=False)
+    for column in columns:
+        frame[column] = derived(name, column)
+    return frame
+
+
+def memory_report():
+    '''
+    resident memory of every dataset loaded in this process
+    input: none
+    output: dataframe with rows, base frame bytes and derived column bytes per dataset
+    '''
+    rows = []
+    for name, frame in list(_frames.items()):
+        derived_bytes = sum(int(series.memory_usage(deep=True))
+                            for (dataset, _), series in list(_derived.items()) if dataset == name)
+        frame_bytes = int(frame.memory_usage(deep=True).sum())
+        rows.append({
+            'dataset': name,
+            'rows': len(frame),
+            'frame_mb': frame_bytes / 1e6,
+            'derived_mb': derived_bytes / 1e6,
+            'total_mb': (frame_bytes + derived_bytes) / 1e6,
+        })
+    return pd.DataFrame(rows, columns=['dataset', 'rows', 'frame_mb', 'derived_mb', 'total_mb'])
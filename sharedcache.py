@@ -0,0 +1,259 @@
+'''
+results shared by every app process on the host, kept on disk
+
+    @instrument.cached(st.cache_resource)
+    @sharedcache.memoize('census', 'map_stops')
+    def get_tract_stop_counts(races=None, selection=None): ...
+
+streamlit's caches live inside one process, so every replica would otherwise rebuild each map, payload
+and fit for itself. memoize() keeps results under config.SHARED_CACHE_DIR, addressed by the sha256 of
+the function, its arguments, the backend and the version of every dataset it reads. a result any process
+computed is then read back by the others, and by the next deploy while the data is unchanged.
+
+    - entries are pickles written to a temporary file and renamed into place, so concurrent writers never
+      leave a partial entry and readers never see one
+    - a hit touches the entry's mtime; once the directory grows past config.SHARED_CACHE_MB the least
+      recently used entries are deleted, down to EVICT_TO of the bound
+    - arguments with a leading underscore are left out of the key, as with streamlit's caches; the others
+      must have a stable repr (strings, numbers, tuples, None)
+
+file_lock() and tmp_path() are what the on-disk builders (datasets, database, cube) use to stay safe when
+several processes build at once.
+'''
+import functools
+import hashlib
+import inspect
+import logging
+import os
+import pickle
+import threading
+import time
+
+import config
+import instrument
+
+LOGGER = logging.getLogger('stopstats.sharedcache')
+# share of the size bound left after an eviction pass
+EVICT_TO = 0.8
+# temporary files older than this (seconds) were left by a crashed writer
+STALE_AFTER = 3600
+# part of every key; change it when the entry format changes
+FORMAT = 1
+
+_versions = {}
+_versions_lock = threading.Lock()
+
+
+def tmp_path(path):
+    '''
+    name to write a file under before renaming it into place
+    input: final path
+    output: path in the same directory, unique to this process and thread
+    '''
+    return f'{path}.{os.getpid()}-{threading.get_ident()}.part'
+
+
+class file_lock:
+    '''
+    exclusive lock held across every process (and thread) on the host; a no-op where fcntl is missing
+    input: lock file path
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._file = open(self.path, 'a')
+        try:
+            import fcntl
+        except ImportError:
+            return self
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # closing the file releases the lock
+        self._file.close()
+        return False
+
+
+def _source_version(name):
+    import datastore
+
+    if name == 'map_stops':
+        # the stops the map pages read: the partitioned store, else the stop dataset (which the database is built from)
+        name = 'catalog' if config.BACKEND == 'partitioned' else 'stops'
+    if name in datastore.DATASETS:
+        # named by the source csv's hash
+        return os.path.basename(datastore.parquet_path(name))
+    if name == 'catalog':
+        import catalog
+
+        path = catalog.CATALOG_PATH
+    elif name == 'tract_counts':
+        import aggregates
+
+        path = aggregates.STORE_PATH
+    else:
+        raise ValueError(f'unknown dataset: {name}')
+    return datastore.file_hash(path)[:16] if os.path.exists(path) else None
+
+
+def dataset_version(name):
+    '''
+    version of a dataset, looked up once per process (as shared_data loads each dataset once)
+    input: 'census', 'stops', 'tracts', 'catalog' (the partitioned store), 'tract_counts' (aggregates'
+           store) or 'map_stops' (whichever stops the map pages read under config.BACKEND)
+    output: string, or None where the dataset does not exist
+    '''
+    with _versions_lock:
+        if name not in _versions:
+            _versions[name] = _source_version(name)
+        return _versions[name]
+
+
+def key(name, arguments, datasets=()):
+    '''
+    content address of a result
+    input: function name, dict of arguments, names of the datasets it reads
+    output: hex digest
+    '''
+    parts = (FORMAT, name, config.BACKEND, sorted(arguments.items()),
+             [(dataset, dataset_version(dataset)) for dataset in datasets])
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+
+def _entry_path(digest):
+    return os.path.join(config.SHARED_CACHE_DIR, digest[:2], digest + '.pkl')
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        # already evicted by another process (or, on windows, still open there)
+        pass
+
+
+def get(digest):
+    '''
+    read a result
+    input: key()
+    output: (found, value)
+    '''
+    path = _entry_path(digest)
+    try:
+        with open(path, 'rb') as f:
+            value = pickle.load(f)
+    except FileNotFoundError:
+        return False, None
+    except Exception:
+        # unreadable, e.g. pickled from a class that has since changed; recompute it
+        LOGGER.warning('dropping unreadable shared cache entry %s', path, exc_info=True)
+        _remove(path)
+        return False, None
+    try:
+        # most recently used
+        os.utime(path)
+    except OSError:
+        pass
+    return True, value
+
+
+def put(digest, value):
+    '''
+    store a result, then evict if the cache has grown past its bound
+    input: key(), value (values that cannot be pickled, or larger than the bound, are not stored)
+    output: bytes written, or None
+    '''
+    try:
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        LOGGER.warning('%s cannot be pickled; not shared', type(value).__name__)
+        return None
+    if len(data) > config.SHARED_CACHE_MB * 1e6 * EVICT_TO:
+        return None
+    path = _entry_path(digest)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    part_path = tmp_path(path)
+    with open(part_path, 'wb') as f:
+        f.write(data)
+    os.replace(part_path, path)
+    evict()
+    return len(data)
+
+
+def evict(limit_mb=None):
+    '''
+    delete least recently used entries once the cache is over its bound
+    input: bound in megabytes (default: config.SHARED_CACHE_MB)
+    output: number of entries deleted
+
+    processes evicting at the same time may together delete a little more than needed; nothing breaks.
+    '''
+    limit = (config.SHARED_CACHE_MB if limit_mb is None else limit_mb) * 1e6
+    entries = []
+    now = time.time()
+    try:
+        directories = [entry.path for entry in os.scandir(config.SHARED_CACHE_DIR) if entry.is_dir()]
+    except FileNotFoundError:
+        return 0
+    for directory in directories:
+        try:
+            files = list(os.scandir(directory))
+        except FileNotFoundError:
+            continue
+        for entry in files:
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if entry.name.endswith('.pkl'):
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+            elif entry.name.endswith('.part') and now - stat.st_mtime > STALE_AFTER:
+                _remove(entry.path)
+    total = sum(size for _, size, _ in entries)
+    if total <= limit:
+        return 0
+    entries.sort()
+    removed = 0
+    for _, size, path in entries:
+        if total <= limit * EVICT_TO:
+            break
+        _remove(path)
+        total -= size
+        removed += 1
+    return removed
+
+
+def memoize(*datasets, name=None):
+    '''
+    decorator keeping a function's results in the shared cache
+    input: names of the datasets its result depends on (see dataset_version), key name (default: the
+           function's file and name, so a page imported by prewarm.py or batch.py shares its entries)
+    output: decorator
+    '''
+    def decorate(fn):
+        signature = inspect.signature(fn)
+        key_name = name or os.path.splitext(os.path.basename(fn.__code__.co_filename))[0] + '.' + fn.__qualname__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if config.SHARED_CACHE_MB <= 0:
+                return fn(*args, **kwargs)
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = {arg: value for arg, value in bound.arguments.items() if not arg.startswith('_')}
+            digest = key(key_name, arguments, datasets)
+            with instrument.stage('shared_cache', function=fn.__name__) as record:
+                found, value = get(digest)
+                record['cache'] = 'hit' if found else 'miss'
+            if found:
+                return value
+            value = fn(*args, **kwargs)
+            with instrument.stage('shared_cache_put', function=fn.__name__) as record:
+                record['bytes'] = put(digest, value)
+            return value
+        return wrapper
+    return decorate
@@ -0,0 +1,247 @@
+'''
+spatial autocorrelation of tract values
+
+    weights = spatial.contiguity(census_gdf.geometry.values, 'queen')
+    frame, global_moran = spatial.autocorrelation(values, weights)
+
+    contiguity()       sparse queen (shared boundary point) or rook (shared edge) weights, from an STRtree
+    moran()            global Moran's I: do similar values sit next to each other?
+    local_moran()      LISA: High-High / Low-Low clusters and High-Low / Low-High outliers, per tract
+    getis_ord()        Gi*: hot and cold spots, per tract
+    hotspot_layer()    the clusters or hot spots as a map layer over the tract geojson
+
+inference is by permutation. a global replicate shuffles every value at once; a local replicate is
+conditional: tract i keeps its value and its neighbours are replaced by a random draw of the other tracts.
+a batch of replicates is one (replicates, tracts) array operation, and batches run on disparity's seeded
+process pool, so results do not depend on the number of workers. pseudo p-values are folded (two-sided):
+(min(extremes above, extremes below) + 1) / (permutations + 1).
+'''
+import math
+
+import numpy as np
+import pandas as pd
+
+import disparity
+
+# permutations behind every pseudo p-value
+PERMUTATIONS = 999
+SIGNIFICANCE = 0.05
+# fill colours of the map layer; anything else is left transparent
+HOTSPOT_COLORS = {
+    'Hot spot': '#d7191c',
+    'Cold spot': '#2c7bb6',
+    'High-High': '#d7191c',
+    'Low-Low': '#2c7bb6',
+    'High-Low': '#fdae61',
+    'Low-High': '#abd9e9',
+}
+
+
+class Weights:
+    '''
+    sparse binary contiguity between areas, used row-standardized
+    input: number of areas, neighbour pairs (areas rows[k] and cols[k] are neighbours; both directions listed)
+
+    pairs are kept sorted by row, as two integer arrays; lag() sums over them with one bincount, for a
+    single array of values or for a whole batch of permuted ones.
+    '''
+
+    def __init__(self, n, rows, cols):
+        rows, cols = np.asarray(rows, dtype='int64'), np.asarray(cols, dtype='int64')
+        order = np.lexsort((cols, rows))
+        self.n = int(n)
+        self.rows, self.cols = rows[order], cols[order]
+        self.cardinality = np.bincount(self.rows, minlength=self.n)
+
+    @property
+    def islands(self):
+        # areas without a neighbour
+        return self.cardinality == 0
+
+    def lag(self, values, standardize=True):
+        '''
+        spatial lag: the mean (or sum) of each area's neighbours' values
+        input: (n,) or (k, n) array, whether to average (row-standardize) rather than sum
+        output: array of the same shape (0 for islands)
+        '''
+        values = np.asarray(values, dtype='float64')
+        batch = values.reshape(-1, self.n)
+        # one bincount over every row of the batch, each offset into its own block of n
+        index = (self.rows + self.n * np.arange(len(batch))[:, None]).ravel()
+        sums = np.bincount(index, weights=batch[:, self.cols].ravel(), minlength=batch.size).reshape(batch.shape)
+        if standardize:
+            sums = np.divide(sums, self.cardinality, out=np.zeros_like(sums), where=self.cardinality > 0)
+        return sums.reshape(values.shape)
+
+    def subset(self, keep):
+        '''
+        weights among some of the areas (e.g. those with a value)
+        input: boolean mask over the areas
+        output: Weights, areas renumbered in order
+        '''
+        keep = np.asarray(keep, dtype=bool)
+        position = np.cumsum(keep) - 1
+        pairs = keep[self.rows] & keep[self.cols]
+        return Weights(int(keep.sum()), position[self.rows[pairs]], position[self.cols[pairs]])
+
+
+def contiguity(geometries, kind='queen'):
+    '''
+    contiguity weights of polygons
+    input: array of shapely polygons (None for none), 'queen' (any shared boundary point) or 'rook' (a
+           shared edge)
+    output: Weights
+    '''
+    import shapely
+
+    if kind not in ('queen', 'rook'):
+        raise ValueError(f'unknown contiguity: {kind}')
+    geometries = np.asarray(geometries, dtype=object)
+    rows, cols = shapely.STRtree(geometries).query(geometries, predicate='intersects')
+    # each pair once, then mirrored
+    once = rows < cols
+    rows, cols = rows[once], cols[once]
+    if kind == 'rook':
+        shared = shapely.intersection(shapely.boundary(geometries[rows]), shapely.boundary(geometries[cols]))
+        edge = shapely.length(shared) > 0
+        rows, cols = rows[edge], cols[edge]
+    return Weights(len(geometries), np.concatenate([rows, cols]), np.concatenate([cols, rows]))
+
+
+def _pseudo_p(permuted, observed):
+    # folded: the smaller tail, counting the observed value as one of the permutations
+    above = (permuted >= observed).sum(axis=0)
+    extreme = np.minimum(above, len(permuted) - above)
+    return (extreme + 1) / (len(permuted) + 1)
+
+
+def _moran_replicates(data, rng, size):
+    # every value shuffled at once, one row per replicate
+    z, weights = data
+    shuffled = rng.permuted(np.broadcast_to(z, (size, len(z))), axis=1)
+    return (shuffled * weights.lag(shuffled)).sum(axis=1, keepdims=True)
+
+
+def _conditional_replicates(data, rng, size):
+    # sum over k_i random other areas for every area i: each replicate draws one ordering of the other
+    # n - 1 areas, and area i takes its first k_i (indices at or past i shifted by one, to skip i itself)
+    values, cardinality = data
+    n = len(values)
+    draws = rng.permuted(np.broadcast_to(np.arange(n - 1), (size, n - 1)), axis=1)[:, :cardinality.max()]
+    positions = np.arange(n)
+    sums = np.zeros((size, n))
+    for k in range(draws.shape[1]):
+        other = draws[:, k, None]
+        other = other + (other >= positions)
+        sums += np.where(k < cardinality, values[other], 0.0)
+    return sums
+
+
+def moran(values, weights, permutations=PERMUTATIONS, seed=0, workers=1):
+    '''
+    global Moran's I with row-standardized weights
+    input: values per area (no missing values; see autocorrelation()), Weights, permutations, seed,
+           processes (None for every core)
+    output: dict with I, expected (its value without autocorrelation), z (against the permutations), p
+            (pseudo p-value) and n
+    '''
+    values = np.asarray(values, dtype='float64')
+    z = values - values.mean()
+    n, s0 = len(z), int((~weights.islands).sum())
+    # with row-standardized weights S0 is the number of areas that have neighbours
+    scale = n / s0 / (z * z).sum() if s0 and (z * z).sum() > 0 else float('nan')
+    statistic = float(scale * (z * weights.lag(z)).sum())
+    result = {'I': statistic, 'expected': -1 / (n - 1), 'z': float('nan'), 'p': float('nan'), 'n': n}
+    if math.isnan(statistic) or not permutations:
+        return result
+    permuted = scale * disparity.replicates(_moran_replicates, (z, weights), permutations, seed, workers)
+    result['z'] = float((statistic - permuted.mean()) / permuted.std())
+    result['p'] = float(_pseudo_p(permuted, statistic)[0])
+    return result
+
+
+def local_moran(values, weights, permutations=PERMUTATIONS, significance=SIGNIFICANCE, seed=0, workers=1):
+    '''
+    local Moran's I (LISA) of every area
+    input: values per area (no missing values), Weights, permutations, significance level, seed, processes
+    output: dataframe with lag (mean of the neighbours), local_i, lisa_p and lisa_cluster ('High-High',
+            'Low-Low', 'High-Low', 'Low-High' where lisa_p <= significance, else 'Not significant')
+    '''
+    values = np.asarray(values, dtype='float64')
+    z = values - values.mean()
+    m2 = (z * z).mean()
+    lag = weights.lag(z)
+    statistic = z * lag / m2
+    p = np.full(len(z), np.nan)
+    if permutations and weights.cardinality.any():
+        sums = disparity.replicates(_conditional_replicates, (z, weights.cardinality), permutations, seed, workers)
+        permuted = z * np.divide(sums, weights.cardinality, out=np.zeros_like(sums), where=weights.cardinality > 0) / m2
+        p = np.where(weights.islands, np.nan, _pseudo_p(permuted, statistic))
+    quadrant = np.select([(z > 0) & (lag > 0), (z < 0) & (lag < 0), (z > 0) & (lag < 0), (z < 0) & (lag > 0)],
+                         ['High-High', 'Low-Low', 'High-Low', 'Low-High'], 'Not significant')
+    return pd.DataFrame({
+        'lag': lag + values.mean(),
+        'local_i': statistic,
+        'lisa_p': p,
+        'lisa_cluster': np.where(p <= significance, quadrant, 'Not significant'),
+    })
+
+
+def getis_ord(values, weights, permutations=PERMUTATIONS, significance=SIGNIFICANCE, seed=0, workers=1):
+    '''
+    Getis-Ord Gi* of every area: is the sum over the area and its neighbours unusually high or low?
+    input: values per area (no missing values), Weights, permutations, significance level, seed, processes
+    output: dataframe with gi_z (the analytical z-score), gi_p (pseudo p-value) and hotspot ('Hot spot',
+            'Cold spot' where gi_p <= significance, else 'Not significant')
+    '''
+    values = np.asarray(values, dtype='float64')
+    n = len(values)
+    # binary weights with the area itself included
+    local_sum = values + weights.lag(values, standardize=False)
+    w = weights.cardinality + 1.0
+    mean, std = values.mean(), values.std()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z = (local_sum - mean * w) / (std * np.sqrt((n * w - w ** 2) / (n - 1)))
+    p = np.full(n, np.nan)
+    if permutations and weights.cardinality.any():
+        sums = disparity.replicates(_conditional_replicates, (values, weights.cardinality), permutations, seed, workers)
+        p = np.where(weights.islands, np.nan, _pseudo_p(values + sums, local_sum))
+    significant = p <= significance
+    return pd.DataFrame({
+        'gi_z': z,
+        'gi_p': p,
+        'hotspot': np.select([significant & (z > 0), significant & (z < 0)], ['Hot spot', 'Cold spot'], 'Not significant'),
+    })
+
+
+def autocorrelation(values, weights, permutations=PERMUTATIONS, significance=SIGNIFICANCE, seed=0, workers=1):
+    '''
+    global Moran's I, LISA clusters and Gi* hot spots of a tract variable
+    input: values per area (areas with a missing value are left out, with the weights among the others),
+           Weights, permutations, significance level, seed, processes (None for every core)
+    output: dataframe with one row per area (value plus the columns of local_moran() and getis_ord();
+            'No data' clusters where the value is missing), moran() dict
+    '''
+    values = np.asarray(values, dtype='float64')
+    present = ~np.isnan(values)
+    kept, subset = values[present], weights.subset(present)
+    local = pd.concat([local_moran(kept, subset, permutations, significance, seed, workers),
+                       getis_ord(kept, subset, permutations, significance, seed + 1, workers)], axis=1)
+    frame = pd.DataFrame({'value': values}).join(local.set_index(np.flatnonzero(present)))
+    frame[['lisa_cluster', 'hotspot']] = frame[['lisa_cluster', 'hotspot']].fillna('No data')
+    return frame, moran(kept, subset, permutations, seed + 2, workers)
+
+
+def hotspot_layer(geojson, frame, variable, statistic='hotspot'):
+    '''
+    hot spots or LISA clusters over the tracts (everything else transparent)
+    input: geojson string from choropleth.tract_geojson() (same row order as frame), autocorrelation()
+           frame, name of the variable, 'hotspot' (Gi*) or 'lisa_cluster'
+    output: choropleth.StyledGeoJson layer; its popup shows the Gi* z-score or local Moran's I
+    '''
+    import choropleth
+
+    colors = frame[statistic].map(HOTSPOT_COLORS).fillna('transparent').to_numpy()
+    value = 'gi_z' if statistic == 'hotspot' else 'local_i'
+    label = f'{variable} (Gi* z)' if statistic == 'hotspot' else f"{variable} (local Moran's I)"
+    return choropleth.StyledGeoJson(geojson, colors, frame[value].to_numpy(dtype='float64'), label)
@@ -0,0 +1,68 @@
+'''
+compact in-memory layout of the stop table
+
+    lng, lat                              float32 (about a metre at these longitudes)
+    date_time                             datetime64 (an int64 epoch; text only when rendered)
+    subject_race, subject_sex, outcome    categorical
+    search / frisk / contraband / citation / warning flags
+                                          bool (nullable boolean only where a value is missing)
+    subject_age                           float32
+
+the shared stop dataset and the sqlite and partitioned backends all hand pages frames in this layout.
+there is no geometry column: shapely points cost far more than the two floats they hold, so code that
+needs points builds them from coordinates() for the rows it is working on.
+'''
+import pandas as pd
+
+CATEGORY_COLUMNS = ['subject_race', 'subject_sex', 'outcome']
+FLAG_COLUMNS = ['search_conducted', 'frisk_performed', 'contraband_found', 'citation_issued', 'warning_issued']
+
+
+def coordinates(frame):
+    '''
+    stop coordinates
+    input: stop frame with lng/lat columns, a geometry column (points, wkb or wkt), or Longitude/Latitude columns
+    output: longitude, latitude float64 arrays
+    '''
+    import shapely
+
+    if 'lng' in frame.columns:
+        return frame['lng'].to_numpy(dtype='float64'), frame['lat'].to_numpy(dtype='float64')
+    if 'Longitude' in frame.columns:
+        return frame['Longitude'].to_numpy(dtype='float64'), frame['Latitude'].to_numpy(dtype='float64')
+    geometry = frame['geometry']
+    if hasattr(geometry, 'x'):
+        return geometry.x.to_numpy(), geometry.y.to_numpy()
+    values = geometry.to_numpy()
+    points = shapely.from_wkb(values) if len(values) and isinstance(values[0], bytes) else shapely.from_wkt(values)
+    return shapely.get_x(points), shapely.get_y(points)
+
+
+def compact(frame):
+    '''
+    convert a stop frame to the compact layout
+    input: stop (geo)dataframe as read from csv, parquet, the database or the partitioned store
+    output: dataframe with lng/lat and the compact column types (other columns are kept as they are)
+    '''
+    lng, lat = coordinates(frame)
+    out = pd.DataFrame({'lng': lng.astype('float32'), 'lat': lat.astype('float32')}, index=frame.index)
+    for column in frame.columns:
+        if column in ('lng', 'lat', 'Longitude', 'Latitude', 'geometry'):
+            continue
+        values = frame[column]
+        if column == 'date_time':
+            values = pd.to_datetime(values, errors='coerce')
+        elif column in CATEGORY_COLUMNS:
+            values = values.astype('category')
+        elif column in FLAG_COLUMNS:
+            values = values.astype('boolean')
+            # plain bools take half the memory of the nullable type; keep the mask only where it is needed
+            if not values.isna().any():
+                values = values.astype(bool)
+        elif column == 'subject_age':
+            values = pd.to_numeric(values, errors='coerce').astype('float32')
+        elif column == 'time_of_day':
+            # -1 where the time is missing
+            values = values.fillna(-1).astype('int8')
+        out[column] = values
+    return out
@@ -0,0 +1,262 @@
+import math
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+import aggregates
+import sharedcache
+
+STATISTICS = ['count', 'mean', 'std', 'min', '25%', '50%', '75%', 'max']
+
+
+class QuantileSketch:
+    '''
+    mergeable approximate quantile sketch (KLL style)
+    input: accuracy parameter k (rank error is roughly 1.7 / k), random seed
+
+    level h keeps items that each stand for 2^h values; a full level is sorted and every other
+    item (from a random offset) is promoted to the next level, so memory stays O(k log(n / k)).
+    '''
+
+    def __init__(self, k=200, seed=0):
+        self.k = k
+        self.levels = [np.empty(0)]
+        self._rng = np.random.default_rng(seed)
+
+    def _capacity(self, h):
+        return max(2, int(math.ceil(self.k * (2.0 / 3.0) ** (len(self.levels) - 1 - h))))
+
+    def _compress(self):
+        h = 0
+        while h < len(self.levels):
+            if len(self.levels[h]) > self._capacity(h):
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                items = np.sort(self.levels[h])
+                # an odd item out stays on this level
+                keep = items[:len(items) % 2]
+                items = items[len(keep):]
+                promoted = items[self._rng.integers(2)::2]
+                self.levels[h] = keep
+                self.levels[h + 1] = np.concatenate([self.levels[h + 1], promoted])
+            h += 1
+
+    def update(self, values):
+        '''
+        add values (nans are ignored)
+        input: array-like
+        output: none
+        '''
+        values = np.asarray(values, dtype='float64')
+        self.levels[0] = np.concatenate([self.levels[0], values[~np.isnan(values)]])
+        self._compress()
+
+    def merge(self, other):
+        '''
+        fold another sketch into this one
+        input: QuantileSketch
+        output: self
+        '''
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for h, items in enumerate(other.levels):
+            self.levels[h] = np.concatenate([self.levels[h], items])
+        self._compress()
+        return self
+
+    def quantile(self, q):
+        '''
+        approximate quantiles
+        input: quantile or array of quantiles in [0, 1]
+        output: value(s), nan if the sketch is empty
+        '''
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(items), 2.0 ** h) for h, items in enumerate(self.levels)])
+        if len(items) == 0:
+            return np.full(np.shape(q), np.nan) if np.ndim(q) else np.nan
+        order = np.argsort(items)
+        items, cumulative = items[order], np.cumsum(weights[order])
+        rank = np.asarray(q) * cumulative[-1]
+        index = np.minimum(np.searchsorted(cumulative, rank, side='left'), len(items) - 1)
+        return items[index]
+
+
+class ColumnSummary:
+    '''
+    count, mean, std, min, max and quantiles of one column, updatable and mergeable
+    input: sketch accuracy parameter
+    '''
+
+    def __init__(self, k=200):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.nan
+        self.max = np.nan
+        self.sketch = QuantileSketch(k)
+
+    def _combine(self, count, mean, m2, lo, hi):
+        # chan et al. parallel update of mean / sum of squared deviations
+        if count == 0:
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta ** 2 * self.count * count / total
+        self.count = total
+        self.min = lo if np.isnan(self.min) else min(self.min, lo)
+        self.max = hi if np.isnan(self.max) else max(self.max, hi)
+
+    def update(self, values):
+        values = np.asarray(values, dtype='float64')
+        values = values[~np.isnan(values)]
+        if len(values):
+            mean = values.mean()
+            self._combine(len(values), mean, ((values - mean) ** 2).sum(), values.min(), values.max())
+            self.sketch.update(values)
+
+    def merge(self, other):
+        self._combine(other.count, other.mean, other.m2, other.min, other.max)
+        self.sketch.merge(other.sketch)
+        return self
+
+    def statistics(self):
+        std = math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else np.nan
+        quartiles = self.sketch.quantile([0.25, 0.5, 0.75]) if self.count else [np.nan] * 3
+        return [self.count, self.mean if self.count else np.nan, std, self.min, *quartiles, self.max]
+
+
+class DatasetSummary:
+    '''
+    streaming describe() for the numeric columns of a dataset
+    input: sketch accuracy parameter
+
+    update() once per chunk or appended batch; two summaries of disjoint data merge into the
+    summary of both.
+    '''
+
+    def __init__(self, k=200):
+        self.k = k
+        self.columns = {}
+
+    def update(self, frame):
+        '''
+        add a chunk of rows
+        input: dataframe (numeric and boolean columns are summarised)
+        output: self
+        '''
+        for column in frame.select_dtypes(include=['number', 'bool']).columns:
+            if column not in self.columns:
+                self.columns[column] = ColumnSummary(self.k)
+            self.columns[column].update(frame[column].to_numpy(dtype='float64', na_value=np.nan))
+        return self
+
+    def merge(self, other):
+        for column, summary in other.columns.items():
+            if column in self.columns:
+                self.columns[column].merge(summary)
+            else:
+                self.columns[column] = summary
+        return self
+
+    def describe(self):
+        '''
+        same layout as DataFrame.describe()
+        input: none
+        output: dataframe indexed by statistic, one column per summarised column
+        '''
+        return pd.DataFrame({column: summary.statistics() for column, summary in self.columns.items()},
+                            index=STATISTICS)
+
+    def save(self, path):
+        _dump(path, self)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+
+def _dump(path, value):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = sharedcache.tmp_path(path)
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(value, f)
+    os.replace(tmp_path, path)
+
+
+def summarize(frame, chunk_size=1_000_000):
+    '''
+    summary of a frame, computed chunk by chunk
+    input: dataframe, rows per chunk
+    output: DatasetSummary
+    '''
+    summary = DatasetSummary()
+    for start in range(0, len(frame), chunk_size):
+        summary.update(frame.iloc[start:start + chunk_size])
+    return summary
+
+
+def dataset_summary(name, frame):
+    '''
+    summary of a cached dataset, stored next to its parquet file and keyed by the same content hash
+    input: dataset name, the loaded dataset
+    output: DatasetSummary
+    '''
+    import datastore
+
+    path = os.path.splitext(datastore.parquet_path(name))[0] + '.summary.pkl'
+    try:
+        return DatasetSummary.load(path)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        pass
+    summary = summarize(frame)
+    summary.save(path)
+    return summary
+
+
+def batch_summary_path(batch_id, store_path=aggregates.STORE_PATH):
+    '''
+    where the stop summaries of an appended batch are kept
+    input: batch id, path of the tract count store the batch was merged into
+    output: path of a pickle next to the store
+    '''
+    return os.path.join(os.path.splitext(store_path)[0] + '_summaries', batch_id + '.pkl')
+
+
+def append_to_summary(chunks, batch_id, years, store_path=aggregates.STORE_PATH):
+    '''
+    pass chunks of stops through while summarizing them, one summary per year
+    input: iterator of stop dataframes, batch id, function giving each stop's year (-1 where unknown),
+           path of the tract count store the batch goes into
+    output: iterator over the same chunks (the batch's summaries are saved once they are exhausted)
+    '''
+    summaries = {}
+    for chunk in chunks:
+        year = years(chunk)
+        for value in np.unique(year):
+            summaries.setdefault(int(value), DatasetSummary()).update(chunk[year == value])
+        yield chunk
+    _dump(batch_summary_path(batch_id, store_path), summaries)
+
+
+def stop_summary(batch_ids, years=None, store_path=aggregates.STORE_PATH):
+    '''
+    summary of the stops in appended batches, merged on read from their per-year summaries
+    input: ids of the batches to include (e.g. TractCounts.batches), years to include (default: all, with
+           the stops that have no year), path of the tract count store
+    output: DatasetSummary, or None when none of the batches has a summary
+    '''
+    merged = None
+    for batch_id in batch_ids:
+        try:
+            with open(batch_summary_path(batch_id, store_path), 'rb') as f:
+                by_year = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            continue
+        for year, part in sorted(by_year.items()):
+            if years is None or year in years:
+                merged = part if merged is None else merged.merge(part)
+    return merged
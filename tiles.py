@@ -0,0 +1,324 @@
+'''
+local mapbox vector tile server for census tracts and stop points
+
+usage: python tiles.py [--host 127.0.0.1] [--port 8765]   (sidecar)
+       tiles.start_server(pyramid) from inside the app         (in-process, background thread)
+
+needs the optional mapbox-vector-tile package.
+'''
+import argparse
+import errno
+import importlib.util
+import logging
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import shapely
+from branca.element import Template
+from folium.elements import JSCSSMixin
+from folium.map import Layer
+
+import config
+import sharedcache
+import stoptable
+
+LOGGER = logging.getLogger('stopstats.tiles')
+TILE_DIR = os.path.join(config.CACHE_DIR, 'tiles')
+EXTENT = 4096
+# web mercator half-width in metres
+ORIGIN = 20037508.342789244
+# below this zoom stops are thinned to one point per tile pixel
+STOP_DETAIL_ZOOM = 13
+TILE_PIXELS = 256
+
+
+def tile_bounds(z, x, y):
+    '''
+    web mercator bounds of a tile
+    input: zoom, column, row (xyz scheme)
+    output: (minx, miny, maxx, maxy) in metres
+    '''
+    size = 2 * ORIGIN / (1 << z)
+    return (-ORIGIN + x * size, ORIGIN - (y + 1) * size, -ORIGIN + (x + 1) * size, ORIGIN - y * size)
+
+
+def mercator(lng, lat):
+    '''
+    web mercator coordinates
+    input: longitude, latitude arrays (degrees)
+    output: x, y arrays (metres)
+    '''
+    x = np.radians(lng) * ORIGIN / np.pi
+    y = np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)) * ORIGIN / np.pi
+    return x, y
+
+
+def pixel_size(z):
+    return 2 * ORIGIN / (TILE_PIXELS << z)
+
+
+class TilePyramid:
+    '''
+    per-zoom geometry for tract and stop tiles
+    input: census geodataframe, stop frame (see stoptable), zoom range, on-disk cache key (see data_cache_key())
+
+    tracts are projected to web mercator once and simplified to about half a pixel at each zoom;
+    every tile is cut from that zoom's geometry through an STRtree and cached on disk as .pbf.
+    layers are 'tracts', 'stops' and, when the stops have a time_of_day column, 'stops_hHH' for one hour.
+    '''
+
+    def __init__(self, census_gdf, stop_gdf, min_zoom=6, max_zoom=16, cache_key='default', id_column='TractID'):
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.cache_dir = os.path.join(TILE_DIR, cache_key)
+        tracts = census_gdf.to_crs(3857)
+        self.tract_ids = tracts[id_column].to_numpy()
+        base = tracts.geometry.values
+        self.tracts = {}
+        for z in range(min_zoom, max_zoom + 1):
+            geometry = shapely.simplify(np.asarray(base), pixel_size(z) / 2, preserve_topology=True)
+            self.tracts[z] = (geometry, shapely.STRtree(geometry))
+        self.stop_x, self.stop_y = mercator(*stoptable.coordinates(stop_gdf))
+        self.stop_tree = shapely.STRtree(shapely.points(self.stop_x, self.stop_y))
+        self.stop_hour = stop_gdf['time_of_day'].to_numpy() if 'time_of_day' in stop_gdf.columns else None
+
+    def _tract_features(self, z, bounds):
+        geometry, tree = self.tracts[z]
+        # a little margin so polygon edges do not show at tile seams
+        pad = pixel_size(z) * 4
+        box = shapely.box(bounds[0] - pad, bounds[1] - pad, bounds[2] + pad, bounds[3] + pad)
+        index = tree.query(box, predicate='intersects')
+        clipped = shapely.clip_by_rect(geometry[index], *box.bounds)
+        return [{'geometry': shape, 'properties': {'i': int(i), 'TractID': str(self.tract_ids[i])}}
+                for i, shape in zip(index, clipped) if not shape.is_empty]
+
+    def _stop_features(self, z, bounds, hour=None):
+        index = self.stop_tree.query(shapely.box(*bounds))
+        if hour is not None:
+            index = index[self.stop_hour[index] == hour]
+        x, y = self.stop_x[index], self.stop_y[index]
+        if z >= STOP_DETAIL_ZOOM:
+            return [{'geometry': shapely.Point(px, py), 'properties': {'count': 1}} for px, py in zip(x, y)]
+        # one point per pixel cell, carrying how many stops it stands for
+        size = pixel_size(z)
+        cells = np.stack([np.floor(x / size), np.floor(y / size)], axis=1)
+        cells, counts = np.unique(cells, axis=0, return_counts=True)
+        return [{'geometry': shapely.Point((cx + 0.5) * size, (cy + 0.5) * size), 'properties': {'count': int(n)}}
+                for (cx, cy), n in zip(cells, counts)]
+
+    def tile(self, layer, z, x, y):
+        '''
+        encoded tile, from the disk cache when possible
+        input: layer ('tracts', 'stops' or 'stops_hHH'), zoom, column, row
+        output: protobuf bytes (empty for zooms outside the pyramid)
+        '''
+        hour = None
+        if layer.startswith('stops_h') and self.stop_hour is not None:
+            hour = int(layer[len('stops_h'):])
+        elif layer not in ('tracts', 'stops'):
+            raise KeyError(layer)
+        if not self.min_zoom <= z <= self.max_zoom:
+            return b''
+        path = os.path.join(self.cache_dir, layer, str(z), str(x), f'{y}.pbf')
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:
+            pass
+        import mapbox_vector_tile
+
+        bounds = tile_bounds(z, x, y)
+        features = self._tract_features(z, bounds) if layer == 'tracts' else self._stop_features(z, bounds, hour)
+        data = mapbox_vector_tile.encode(
+            {'name': layer, 'features': features},
+            default_options={'quantize_bounds': bounds, 'extents': EXTENT},
+        )
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = sharedcache.tmp_path(path)
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return data
+
+
+def available():
+    '''
+    whether the optional mapbox-vector-tile package is installed
+    '''
+    return importlib.util.find_spec('mapbox_vector_tile') is not None
+
+
+def data_cache_key():
+    '''
+    tile cache key for the current census and stop data
+    input: none
+    output: string that changes whenever either source csv changes
+    '''
+    import datastore
+
+    names = [os.path.splitext(os.path.basename(datastore.parquet_path(name)))[0] for name in ('census', 'stops')]
+    return '_'.join(names)
+
+
+def _handler(pyramid):
+    class TileHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            # /<layer>/<z>/<x>/<y>.pbf
+            parts = self.path.split('?')[0].strip('/').split('/')
+            try:
+                layer, z, x, y = parts[0], int(parts[1]), int(parts[2]), int(parts[3].split('.')[0])
+                data = pyramid.tile(layer, z, x, y)
+            except (IndexError, ValueError, KeyError):
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-protobuf')
+            self.send_header('Content-Length', str(len(data)))
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Cache-Control', 'max-age=3600')
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return TileHandler
+
+
+def start_server(pyramid, host='127.0.0.1', port=8765):
+    '''
+    serve tiles from a background thread in this process
+    input: TilePyramid, host, port (0 picks a free port)
+    output: the running ThreadingHTTPServer (server.server_address has the bound port)
+    '''
+    server = ThreadingHTTPServer((host, port), _handler(pyramid))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='tile-server', daemon=True).start()
+    return server
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_pyramid():
+    '''
+    pyramid over the shared census and stop datasets
+    input: none
+    output: TilePyramid (tract feature i is row i of shared_data's census frame)
+    '''
+    import shared_data
+
+    census_gdf, stop_gdf = shared_data.view('census'), shared_data.view('stops', 'time_of_day')
+    return TilePyramid(census_gdf, stop_gdf, cache_key=data_cache_key())
+
+
+def shared_server():
+    '''
+    in-process tile server for the shared datasets, started once per process
+    input: none
+    output: running server (port from STOPSTATS_TILE_PORT, default 8765, or a free port when that one is
+            taken, e.g. by another app process), or None when STOPSTATS_TILE_URL names a server to use instead
+    '''
+    global _shared
+    if os.environ.get('STOPSTATS_TILE_URL'):
+        return None
+    with _shared_lock:
+        if _shared is None:
+            pyramid = shared_pyramid()
+            port = int(os.environ.get('STOPSTATS_TILE_PORT', 8765))
+            try:
+                _shared = start_server(pyramid, port=port)
+            except OSError as error:
+                if error.errno != errno.EADDRINUSE:
+                    raise
+                _shared = start_server(pyramid, port=0)
+                LOGGER.info('tile port %d is in use; serving tiles on port %d', port, _shared.server_address[1])
+    return _shared
+
+
+def tile_url(server=None):
+    '''
+    url template the browser should request tiles from
+    input: running server (optional)
+    output: '<base>/{layer}/{z}/{x}/{y}.pbf' style template with {layer} left for the caller
+
+    STOPSTATS_TILE_URL overrides the base when the server sits behind a proxy or runs as a sidecar.
+    '''
+    base = os.environ.get('STOPSTATS_TILE_URL')
+    if base is None:
+        host, port = server.server_address[:2] if server is not None else ('127.0.0.1', 8765)
+        base = f'http://{host}:{port}'
+    return base.rstrip('/') + '/{layer}/{z}/{x}/{y}.pbf'
+
+
+class VectorTileLayer(JSCSSMixin, Layer):
+    '''
+    leaflet.vectorgrid layer for one tile layer
+    input: url template from tile_url(), layer name ('tracts', 'stops' or 'stops_hHH'), fill colours per tract
+           (tracts only, indexed by the tract's row position), stop colour
+
+    the browser only requests the tiles in view at the current zoom.
+    '''
+    _template = Template(u'''
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = (function(){
+                var colors = {{ this.colors|tojson }};
+                var styles = {
+                    tracts: function(properties) {
+                        return {fill: true, fillColor: colors[properties.i] || 'transparent', fillOpacity: 0.4,
+                                color: 'black', weight: 1};
+                    },
+                    stops: function(properties, zoom) {
+                        return {radius: Math.min(2 + Math.log2(properties.count || 1), 8), fill: true, fillOpacity: 0.7,
+                                color: {{ this.stop_color|tojson }}, weight: 0};
+                    }
+                };
+                var layerStyles = {};
+                layerStyles[{{ this.layer|tojson }}] = styles[{{ this.kind|tojson }}];
+                var layer = L.vectorGrid.protobuf({{ this.url|tojson }}, {
+                    rendererFactory: L.canvas.tile,
+                    interactive: true,
+                    maxNativeZoom: {{ this.max_native_zoom }},
+                    vectorTileLayerStyles: layerStyles
+                });
+                layer.on('click', function(e) {
+                    var p = e.layer.properties;
+                    var html = p.TractID !== undefined ? '<b>Tract:</b> ' + p.TractID : '<b>Stops:</b> ' + p.count;
+                    L.popup().setLatLng(e.latlng).setContent(html).openOn({{ this._parent.get_name() }});
+                });
+                layer.addTo({{ this._parent.get_name() }});
+                return layer;
+            })();
+        {% endmacro %}''')
+
+    default_js = [
+        ('leaflet.vectorgrid', 'https://unpkg.com/leaflet.vectorgrid@1.3.0/dist/Leaflet.VectorGrid.bundled.js'),
+    ]
+
+    def __init__(self, url, layer, colors=None, stop_color='red', max_native_zoom=16, name=None, **kwargs):
+        super().__init__(name=name or layer, **kwargs)
+        self._name = 'VectorTileLayer'
+        self.url = url.replace('{layer}', layer)
+        self.layer = layer
+        self.kind = 'tracts' if layer == 'tracts' else 'stops'
+        self.colors = [] if colors is None else np.asarray(colors).tolist()
+        self.stop_color = stop_color
+        self.max_native_zoom = max_native_zoom
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve census tract and stop vector tiles.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), _handler(shared_pyramid()))
+    print(f'serving tiles on {tile_url(server)}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+'''
+stops for the part of a map that is in view
+
+    index = viewport.StopIndex(stop_frame)
+    value, shown = viewport.st_viewport_map(m, index, STOP_FIELDS, key='race_map')
+
+st_folium reports the map's bounds and zoom after every pan or zoom. in viewport mode the map pages send
+only the stops inside those bounds, as a layer that st_folium swaps in without redrawing the base map.
+StopIndex is a uniform grid over the stop coordinates (stops sorted by cell, with an offset per cell), so a
+bounds query reads only the runs of stops in the cells it covers. when more than MAX_POINTS stops are in
+view they are binned instead (binning.py), at a cell size that follows the zoom, so the browser holds a
+bounded number of markers or bins however large the dataset is.
+'''
+import math
+import threading
+
+import numpy as np
+
+import binning
+import stoptable
+
+# grid cells along each axis of a StopIndex
+GRID_CELLS = 512
+# above this many stops in view, bins are sent instead of markers
+MAX_POINTS = 2_000
+# candidates (stops in the grid cells covered) beyond which a query gives up without the exact test
+CANDIDATE_FACTOR = 8
+# on-screen size of a bin, in pixels
+BIN_PIXELS = 24
+# zoom levels bins are built for (others are clamped to these)
+MIN_ZOOM, MAX_ZOOM = 4, 18
+# binning.Binner's default reference latitude
+REF_LAT = 47.5
+
+
+def bin_size(zoom):
+    '''
+    bin cell size (degrees of latitude, as binning.Binner takes it) that spans about BIN_PIXELS on screen
+    input: map zoom level
+    output: degrees
+    '''
+    # web mercator: 256 px tiles, 2**zoom of them around the world
+    return BIN_PIXELS * 360.0 / (256 * 2 ** zoom) * math.cos(math.radians(REF_LAT))
+
+
+def view_bounds(center, zoom, width=700, height=500):
+    '''
+    bounds a leaflet map shows before it reports its own
+    input: (lat, lng) centre, zoom level, map size in pixels
+    output: (west, south, east, north)
+    '''
+    scale = 256 * 2 ** zoom
+    lat, lng = center
+    x = (lng + 180.0) / 360.0 * scale
+    sin_lat = math.sin(math.radians(lat))
+    y = (0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * scale
+
+    def to_lat(y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / scale))))
+
+    return ((x - width / 2) / scale * 360.0 - 180.0, to_lat(y + height / 2),
+            (x + width / 2) / scale * 360.0 - 180.0, to_lat(y - height / 2))
+
+
+def parse_bounds(bounds):
+    '''
+    bounds as st_folium returns them
+    input: {'_southWest': {'lat', 'lng'}, '_northEast': {'lat', 'lng'}} (or None)
+    output: (west, south, east, north), or None when missing
+    '''
+    try:
+        south_west, north_east = bounds['_southWest'], bounds['_northEast']
+        values = (south_west['lng'], south_west['lat'], north_east['lng'], north_east['lat'])
+    except (KeyError, TypeError):
+        return None
+    return None if None in values else tuple(float(value) for value in values)
+
+
+class StopIndex:
+    '''
+    uniform grid over stop coordinates, for bounds queries
+    input: stop frame (see stoptable), grid cells along each axis
+
+    stops are ordered by cell (row by row), with the offset of each cell's first stop, so the stops of the
+    cells a query covers in one grid row are one contiguous run. binned views (bins()) are built once per
+    zoom level and kept.
+    '''
+
+    def __init__(self, stop_frame, cells=GRID_CELLS):
+        lng, lat = stoptable.coordinates(stop_frame)
+        valid = np.isfinite(lng) & np.isfinite(lat)
+        self.frame = stop_frame
+        self.cells = cells
+        self.n = int(valid.sum())
+        if self.n:
+            self.west, self.east = float(lng[valid].min()), float(lng[valid].max())
+            self.south, self.north = float(lat[valid].min()), float(lat[valid].max())
+        else:
+            self.west = self.east = self.south = self.north = 0.0
+        self._dx = max(self.east - self.west, 1e-9) / cells
+        self._dy = max(self.north - self.south, 1e-9) / cells
+        # stops without coordinates sort after every cell and are dropped
+        cell = np.full(len(lng), cells * cells, dtype='int64')
+        cell[valid] = self._row(lat[valid]) * cells + self._column(lng[valid])
+        order = np.argsort(cell, kind='stable')
+        self.starts = np.searchsorted(cell[order], np.arange(cells * cells + 1))
+        self.order = order[:self.n]
+        self.lng = lng[self.order].astype('float32')
+        self.lat = lat[self.order].astype('float32')
+        self._bins = {}
+        self._lock = threading.Lock()
+
+    def _column(self, lng):
+        return np.clip(np.floor((np.asarray(lng) - self.west) / self._dx), 0, self.cells - 1).astype('int64')
+
+    def _row(self, lat):
+        return np.clip(np.floor((np.asarray(lat) - self.south) / self._dy), 0, self.cells - 1).astype('int64')
+
+    def query(self, bounds, limit=None):
+        '''
+        stops inside bounds
+        input: (west, south, east, north), most stops wanted (None for no limit)
+        output: positions (for iloc) of the stops in the frame, or None when more than limit are in view
+        '''
+        west, south, east, north = bounds
+        if not self.n or east < self.west or west > self.east or north < self.south or south > self.north:
+            return np.empty(0, dtype='int64')
+        rows = np.arange(self._row(south), self._row(north) + 1) * self.cells
+        begin = self.starts[rows + self._column(west)]
+        end = self.starts[rows + self._column(east) + 1]
+        # the covered cells hold at least every stop in view, so a crowded view is known before the exact test
+        if limit is not None and (end - begin).sum() > CANDIDATE_FACTOR * limit:
+            return None
+        candidates = np.concatenate([np.arange(b, e) for b, e in zip(begin, end)])
+        lng, lat = self.lng[candidates], self.lat[candidates]
+        found = candidates[(lng >= west) & (lng <= east) & (lat >= south) & (lat <= north)]
+        if limit is not None and len(found) > limit:
+            return None
+        return self.order[found]
+
+    def bins(self, zoom, shape='hex'):
+        '''
+        every stop binned for a zoom level, built once per level
+        input: zoom level (clamped to MIN_ZOOM..MAX_ZOOM), bin shape
+        output: BinAggregate
+        '''
+        zoom = int(min(max(round(zoom), MIN_ZOOM), MAX_ZOOM))
+        with self._lock:
+            if (zoom, shape) not in self._bins:
+                binner = binning.Binner(shape, bin_size(zoom), REF_LAT)
+                frame = self.frame if self.n == len(self.frame) else self.frame.iloc[self.order]
+                self._bins[zoom, shape] = binning.BinAggregate(binner).add_frame(frame)
+            return self._bins[zoom, shape]
+
+
+def bins_in_view(aggregate, bounds):
+    '''
+    the bins of an aggregate that overlap bounds
+    input: BinAggregate, (west, south, east, north)
+    output: BinAggregate
+    '''
+    west, south, east, north = bounds
+    binner = aggregate.binner
+    lng, lat = binner.centers(*binning.unpack(aggregate.keys))
+    # a bin whose centre is just outside still shows its edge
+    pad_lng, pad_lat = binner.size / binner.kx, binner.size
+    return aggregate.subset((lng >= west - pad_lng) & (lng <= east + pad_lng) & (lat >= south - pad_lat) & (lat <= north + pad_lat))
+
+
+def stops_layer(index, bounds, zoom, fields, shape='hex', max_points=MAX_POINTS):
+    '''
+    the stops in view, as markers, or as bins when there are more than max_points
+    input: StopIndex, (west, south, east, north), zoom level, popup fields, bin shape, most markers to send
+    output: folium FeatureGroup, dict with the number of stops in view and whether they were binned
+    '''
+    import folium
+
+    import markers
+
+    layer = folium.FeatureGroup(name='Stops in view')
+    positions = index.query(bounds, limit=max_points)
+    if positions is not None:
+        if len(positions):
+            markers.FastMarkerLayer(index.frame.iloc[positions], fields=fields).add_to(layer)
+        return layer, {'stops': len(positions), 'binned': False}
+    aggregate = bins_in_view(index.bins(zoom, shape), bounds)
+    if len(aggregate.keys):
+        binning.bins_layer(aggregate).add_to(layer)
+    return layer, {'stops': int(aggregate.counts.sum()), 'binned': True}
+
+
+def st_viewport_map(m, index, fields, key, width=700, height=500, shape='hex'):
+    '''
+    show a map whose stop layer follows the view
+    input: folium map without a stop layer, StopIndex, popup fields, widget key, size in pixels, bin shape
+    output: st_folium's return value, dict of what was sent (see stops_layer)
+
+    the bounds and zoom of the last interaction are in st.session_state[key]; until the map has reported
+    them they are worked out from its centre and zoom.
+    '''
+    import streamlit as st
+    from streamlit_folium import st_folium
+
+    import instrument
+
+    state = st.session_state.get(key) or {}
+    zoom = state.get('zoom') or m.options['zoom']
+    bounds = parse_bounds(state.get('bounds')) or view_bounds(m.location, zoom, width, height)
+    with instrument.stage('viewport_query') as record:
+        layer, shown = stops_layer(index, bounds, zoom, fields, shape)
+        record['stops'] = shown['stops']
+    with instrument.stage('st_folium') as record:
+        value = st_folium(m, width=width, height=height, key=key, feature_group_to_add=layer,
+                          returned_objects=['bounds', 'zoom'])
+        record['bytes'] = instrument.render_size(m)
+    return value, shown